@@ -0,0 +1,545 @@
+import asyncio
+import functools
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import os
+import signal
+import weakref
+
+import aiohttp
+from aiohttp import web
+from telegram import Bot as TelegramBot, Update, User
+from telegram.error import TelegramError, RetryAfter, NetworkError, TimedOut
+
+from bot import Bot
+from config import get_settings
+from conversation import TermStore
+from locale_catalog import LocaleCatalog
+from async_term_collection import AsyncTermCollection
+from media_ingest import MediaIngestor
+from media_store import MediaStore
+from outbox import AsyncOutbox
+from term_graph import TermGraph
+from state_store import create_state_store, MemoryStateStore, PersistentConversations, PersistentUserData
+from webhook import SECRET_HEADER, parse_updates
+
+
+logger = logging.getLogger(__name__)
+
+# getting asyncio mode parameters from config file
+settings = get_settings()
+
+
+class TelegramClient:
+    """
+    Minimal asyncio client of the Telegram Bot API on a pooled aiohttp session
+    """
+
+    API_URL = 'https://api.telegram.org'
+
+    def __init__(self, token, connections=100, timeout=30):
+        """
+        :param connections: maximum number of simultaneous HTTP connections to the Bot API
+        """
+        self.token = token
+        self.connections = connections
+        self.timeout = timeout
+        self.session = None
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        await self.session.close()
+
+    async def call(self, method, request_timeout=None, **data):
+        """
+        Calls the Bot API method. The errors are raised like python-telegram-bot raises them, so the outbox
+        waits out the flood waits (RetryAfter) and retries after network errors, see Outbox.
+        :param request_timeout: seconds to wait for the answer instead of the default timeout
+        :return: the result of the method
+        """
+        data = {name: value for name, value in data.items() if value is not None}
+        if 'reply_markup' in data:
+            data['reply_markup'] = data['reply_markup'].to_dict()
+        if request_timeout:
+            request_timeout = aiohttp.ClientTimeout(total=request_timeout)
+
+        try:
+            async with self.session.post(f'{self.API_URL}/bot{self.token}/{method}', json=data,
+                                         timeout=request_timeout) as response:
+                answer = await response.json()
+        except asyncio.TimeoutError:
+            raise TimedOut()
+        except aiohttp.ClientError as e:
+            raise NetworkError(str(e))
+        return self._result(method, answer)
+
+    @staticmethod
+    def _result(method, answer):
+        """
+        :param answer: the decoded answer of the Bot API
+        :return: the result of the method
+        """
+        if answer.get('ok'):
+            return answer['result']
+        retry_after = answer.get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            raise RetryAfter(retry_after)
+        raise TelegramError(answer.get('description', f'{method} failed'))
+
+    async def upload(self, method, field, path, filename=None, **data):
+        """
+        Calls the Bot API method with the file at the path uploaded as the field, e.g. sendPhoto with photo
+        :param filename: name of the uploaded file, the name of the path by default
+        :return: the result of the method
+        """
+        form = aiohttp.FormData()
+        for name, value in data.items():
+            if value is not None:
+                form.add_field(name, json.dumps(value.to_dict()) if name == 'reply_markup' else str(value))
+        with open(path, 'rb') as file:
+            form.add_field(field, file, filename=filename or os.path.basename(path))
+            try:
+                async with self.session.post(f'{self.API_URL}/bot{self.token}/{method}', data=form) as response:
+                    answer = await response.json()
+            except asyncio.TimeoutError:
+                raise TimedOut()
+            except aiohttp.ClientError as e:
+                raise NetworkError(str(e))
+        return self._result(method, answer)
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def get_updates(self, offset=None, timeout=30):
+        # the long polling request is answered after up to `timeout` seconds
+        return await self.call('getUpdates', request_timeout=timeout + self.timeout, offset=offset, timeout=timeout)
+
+    async def download(self, file_id, chunk_size=64 * 1024):
+        """
+        Streams the file sent by a user
+        :return: path of the file on the Telegram server and an async iterator of its chunks
+        """
+        telegram_file = await self.call('getFile', file_id=file_id)
+        file_path = telegram_file['file_path']
+
+        async def chunks():
+            async with self.session.get(f'{self.API_URL}/file/bot{self.token}/{file_path}') as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+
+        return file_path, chunks()
+
+
+class AsyncTermStore(TermStore):
+    """
+    TermStore of the asyncio mode: the terms are read and written by AsyncTermCollection,
+    the queries of the term graph run in the default executor
+    """
+
+    async def get(self, term_id):
+        return await self.term_collection.get(term_id)
+
+    async def get_page(self, after=None, before=None, limit=20, order_by='name'):
+        return await self.term_collection.get_page(after=after, before=before, limit=limit, order_by=order_by)
+
+    async def search(self, query, limit=10):
+        return await self.term_collection.search(query, limit=limit)
+
+    async def profile(self, term_id):
+        return await self.term_collection.profile(term_id)
+
+    async def create(self, term_name):
+        return await self.term_collection.create(term_name)
+
+    async def update(self, term_id, dictionary):
+        return await self.term_collection.update(term_id, dictionary)
+
+    async def link(self, term_id, words, kind):
+        linked = await self.term_collection.add_synonyms_similars(term_id, words=words, table=kind)
+        self.graph.add_links(term_id, linked, kind)
+        return linked
+
+    async def related(self, term_id, hops):
+        return await asyncio.get_running_loop().run_in_executor(None, self.graph.profile, term_id, hops)
+
+
+class AsyncBot(Bot):
+    """
+    The bot in the asyncio mode: the handlers of the conversation are awaited on an event loop instead of running
+    on the dispatcher threads of python-telegram-bot, the database is accessed through asyncpg and the replies
+    are sent by a pooled HTTP client through the outbox. The conversation is declared once,
+    in Bot.conversation_handler, and its handlers are shared with the threaded mode, see Conversation.
+    """
+
+    # kind of media: (Bot API method, field of the file)
+    MEDIA_METHODS = {'image': ('sendPhoto', 'photo'), 'audio': ('sendAudio', 'audio'), 'video': ('sendVideo', 'video')}
+
+    def __init__(self):
+        self.client = TelegramClient(settings.bot.token, connections=settings.async_mode.connections)
+        # parses the updates and gives the command handlers the bot username, it makes no requests itself
+        self.telegram_bot = TelegramBot(settings.bot.token)
+        self.term_collection = AsyncTermCollection(min_size=settings.async_mode.db_pool_min,
+                                                   max_size=settings.async_mode.db_pool_max)
+        # the graph queries run on the in-memory index, only its loading blocks, so they go to the executor
+        self.graph = TermGraph(in_memory=True, refresh_interval=settings.graph.refresh_interval)
+        self.terms = AsyncTermStore(self.term_collection, self.graph)
+        self.routes = {self.START_MENU: {}, self.CHOOSE_OPTION: {}, self.POS: {}}
+        self.locales = LocaleCatalog(on_load=self.update_state_handlers)
+        self.conversation = self.conversation_handler()
+
+        max_sessions = settings.sessions.max_sessions
+        self.state_store = create_state_store(settings.state.backend, sqlite_path=settings.state.sqlite_path,
+                                              max_sessions=max_sessions)
+        self.conversations = PersistentConversations(self.state_store, on_end=self.end_session,
+                                                     max_sessions=max_sessions)
+        self.user_data = PersistentUserData(self.state_store, max_sessions=max_sessions)
+        # updates of one conversation are handled one after another, in the order they came
+        self.conversation_locks = weakref.WeakValueDictionary()
+        # timers ending the idle conversations, see conversation_timeout in config.ini
+        self.timeouts = {}
+
+        media = settings.media
+        self.media_store = MediaStore(media.directory)
+        self.media_slots = asyncio.Semaphore(settings.workers.media)
+        self.media_queue_size = media.queue_size
+        self.media_retries = media.retries
+        self.media_retry_delay = media.retry_delay
+        self.media_chunk_size = media.chunk_size
+        self.media_jobs = set()
+
+        outbox = settings.outbox
+        self.outbox = AsyncOutbox(self.client,
+                                  rate=outbox.rate,
+                                  burst=outbox.burst,
+                                  chat_rate=outbox.chat_rate,
+                                  chat_burst=outbox.chat_burst,
+                                  queue_size=outbox.queue_size,
+                                  workers=settings.workers.outbox,
+                                  retries=outbox.retries)
+
+        self.handler_slots = asyncio.Semaphore(settings.workers.concurrency)
+        self.queue_size = settings.async_mode.queue_size
+        self.tasks = set()
+        self.stopping = None
+
+    def callback(self, handler):
+        """
+        The handlers are awaited by process_update as they are
+        """
+        return handler
+
+    async def blocking(self, function, *args):
+        """
+        Runs a call of the state store in the default executor, unless the store is in memory
+        """
+        if isinstance(self.state_store, MemoryStateStore):
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def end_session(self, key):
+        """
+        Forgets the user's session when the conversation ends, see Bot.end_session.
+        Called by the state store calls, in the executor unless the store is in memory.
+        """
+        if not self.conversations.user_active(key[1]):
+            self.user_data.expire(key[1])
+
+    def spawn(self, coroutine, tasks):
+        task = asyncio.ensure_future(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def handle(self, data):
+        """
+        Handles one update dictionary, at most `concurrency` updates at once
+        """
+        async with self.handler_slots:
+            try:
+                await self.process_update(Update.de_json(data, self.telegram_bot))
+            except Exception:
+                logger.exception('Update "%s" caused an error.', data)
+
+    async def process_update(self, update):
+        """
+        Finds the handler of the update in the state of the conversation, like ConversationHandler does,
+        awaits its callback and moves the conversation to the returned state
+        """
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None or user is None:
+            return
+        key = (chat.id, user.id)
+
+        async with self.conversation_lock(key):
+            state = await self.blocking(self.conversations.get, key)
+            if state is None:
+                handlers = self.conversation.entry_points
+            else:
+                handlers = self.conversation.states.get(state, []) + self.conversation.fallbacks
+            handler = next((handler for handler in handlers if handler.check_update(update)), None)
+            if handler is None:
+                return
+
+            user_data = await self.blocking(self.user_data.__getitem__, user.id)
+            kwargs = {}
+            if handler.pass_user_data:
+                kwargs['user_data'] = user_data
+            if getattr(handler, 'pass_args', False):
+                kwargs['args'] = update.message.text.split()[1:]
+
+            new_state = handler.callback(self.client, update, **kwargs)
+            if inspect.isawaitable(new_state):
+                new_state = await new_state
+
+            if new_state == self.END:
+                self.cancel_timeout(key)
+                await self.blocking(self.conversations.pop, key, None)
+            else:
+                if new_state is not None:
+                    await self.blocking(self.conversations.__setitem__, key, new_state)
+                self.schedule_timeout(key)
+            await self.blocking(self.user_data.flush, user.id)
+
+    def conversation_lock(self, key):
+        """
+        :param key: (chat id, user id) of the conversation
+        :return: the lock the updates of the conversation are handled under
+        """
+        lock = self.conversation_locks.get(key)
+        if lock is None:
+            lock = self.conversation_locks[key] = asyncio.Lock()
+        return lock
+
+    def schedule_timeout(self, key):
+        """
+        Ends the conversation after conversation_timeout seconds without updates, like the timeout
+        of ConversationHandler in the threaded mode, so the session of an idle user is forgotten
+        """
+        timeout = settings.sessions.timeout
+        if timeout:
+            self.cancel_timeout(key)
+            self.timeouts[key] = asyncio.get_running_loop().call_later(
+                timeout, lambda: self.spawn(self.end_idle_conversation(key), self.tasks))
+
+    def cancel_timeout(self, key):
+        timer = self.timeouts.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    async def end_idle_conversation(self, key):
+        async with self.conversation_lock(key):
+            timer = self.timeouts.get(key)
+            if timer is None or timer.when() > asyncio.get_running_loop().time():
+                # an update came while the lock was awaited, it has scheduled a new timeout
+                return
+            del self.timeouts[key]
+            await self.blocking(self.conversations.pop, key, None)
+
+    def send_media(self, update, kind, key, file_id=None):
+        """
+        Queues the media file of the term to the chat of the update, see Conversation.send_media
+        """
+        send = functools.partial(self.send_file, kind=kind, key=key, file_id=file_id)
+        self.outbox.send_media(update.effective_chat.id, send)
+
+    async def send_file(self, client, chat_id, reply_markup=None, kind='image', key=None, file_id=None):
+        """
+        Sends the blob by its Telegram file id, or uploads it from the media store if the id is unknown
+        or not accepted, like MediaSender does in the threaded mode; the signature fits AsyncOutbox.send_media.
+        Flood waits and network errors are raised for the outbox to retry.
+        """
+        method, field = self.MEDIA_METHODS[kind]
+        if file_id is None:
+            file_id = await self.term_collection.media_file_id(key)
+        if file_id:
+            try:
+                await client.call(method, chat_id=chat_id, reply_markup=reply_markup, **{field: file_id})
+                return
+            except (RetryAfter, NetworkError):
+                raise
+            except TelegramError as e:
+                logger.info('File id of the blob %s was not accepted, uploading the file: %s', key, e)
+
+        try:
+            filename = MediaStore.file_name(key, await self.term_collection.media_extension(key))
+            message = await client.upload(method, field, self.media_store.path(key), filename=filename,
+                                          chat_id=chat_id, reply_markup=reply_markup)
+        except OSError as e:
+            logger.warning('The %s %s can\'t be sent: %s', kind, key, e)
+            return
+        sent = message.get(field)
+        if isinstance(sent, list):
+            # the sizes of the photo, the largest one is the uploaded file
+            sent = sent[-1] if sent else None
+        if sent:
+            await self.term_collection.set_media_file_id(key, sent['file_id'], sent.get('file_unique_id'))
+
+    def submit_media(self, job):
+        """
+        Starts downloading the file in the background, at most queue_size of the [media] section at once
+        """
+        if len(self.media_jobs) >= self.media_queue_size:
+            return False
+        self.spawn(self.ingest_media(job), self.media_jobs)
+        return True
+
+    async def ingest_media(self, job):
+        """
+        Downloads the file into the media store with retries, like MediaIngestor does on its worker threads
+        """
+        error = None
+        async with self.media_slots:
+            for attempt in range(self.media_retries + 1):
+                try:
+                    key, size, extension = await self.save_media(job)
+                    await self.term_collection.set_media(job.term_id, MediaIngestor.KINDS[job.kind][1], key, size,
+                                                         extension, file_id=job.file_id,
+                                                         file_unique_id=job.file_unique_id)
+                    error = None
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError, OSError) as e:
+                    error = e
+                    logger.warning('Attempt %s to save the %s for the term %s failed: %s',
+                                   attempt + 1, job.kind, job.term_id, e)
+                    if attempt < self.media_retries:
+                        await asyncio.sleep(self.media_retry_delay * 2 ** attempt)
+                except Exception as e:
+                    error = e
+                    logger.exception('Saving the %s for the term %s failed.', job.kind, job.term_id)
+                    break
+
+        try:
+            self.media_saved(job, error)
+        except Exception:
+            logger.exception('Reply about the %s for the term %s failed.', job.kind, job.term_id)
+
+    async def save_media(self, job):
+        """
+        Streams the file into the media store while computing its content hash
+        :return: key of the blob, its size in bytes and the extension of the file
+        """
+        file_path, chunks = await self.client.download(job.file_id, self.media_chunk_size)
+        extension = os.path.splitext(file_path)[1].lower() or MediaIngestor.KINDS[job.kind][0]
+
+        digest = hashlib.sha256()
+        size = 0
+        with self.media_store.temporary_file() as tmp:
+            try:
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+
+        return self.media_store.put(tmp.name, digest.hexdigest()), size, extension
+
+    async def webhook(self, request):
+        """
+        Receives the updates from Telegram, see WebhookHandler of the threaded mode
+        """
+        secret = settings.webhook.secret
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret):
+            logger.warning('Webhook request from %s with a wrong secret token.', request.remote)
+            return web.Response(status=403)
+
+        try:
+            updates = parse_updates(await request.json())
+        except ValueError:
+            updates = None
+        if updates is None:
+            return web.Response(status=400)
+
+        if len(self.tasks) + len(updates) > self.queue_size:
+            # Telegram retries the delivery later
+            return web.Response(status=503, headers={'Retry-After': '1'})
+        for update in updates:
+            self.spawn(self.handle(update), self.tasks)
+        return web.Response()
+
+    async def poll(self, timeout=30):
+        """
+        Receives the updates by long polling. Stops asking for more while queue_size updates are in progress.
+        """
+        await self.client.call('deleteWebhook')
+        offset = None
+        while True:
+            try:
+                updates = await self.client.get_updates(offset=offset, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError) as e:
+                logger.warning('Getting updates failed: %s', e)
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.spawn(self.handle(update), self.tasks)
+            while len(self.tasks) >= self.queue_size:
+                await asyncio.sleep(0.1)
+
+    async def serve(self):
+        """
+        Starts the bot on the running event loop and serves the updates until SIGINT or SIGTERM
+        """
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stopping.set)
+
+        await self.client.open()
+        self.outbox.start()
+        await self.term_collection.connect()
+        await self.term_collection.listen_for_invalidations()
+        self.telegram_bot.bot = User.de_json(await self.client.call('getMe'), self.telegram_bot)
+
+        if settings.bot.preload_locales:
+            self.locales.warmup()
+
+        runner = None
+        webhook = settings.webhook
+        if settings.bot.mode == 'webhook':
+            app = web.Application(client_max_size=1024 * 1024)
+            app.router.add_post(webhook.path, self.webhook)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, webhook.listen, webhook.port).start()
+            if webhook.url:
+                await self.client.call('setWebhook', url=webhook.url, max_connections=webhook.max_connections,
+                                       secret_token=webhook.secret)
+            logger.info('Listening to webhook updates on port %s.', webhook.port)
+            receiver = None
+        else:
+            receiver = asyncio.ensure_future(self.poll())
+
+        await self.stopping.wait()
+
+        if receiver:
+            receiver.cancel()
+        if runner:
+            await runner.cleanup()
+        for timer in self.timeouts.values():
+            timer.cancel()
+        # the updates in progress and the downloads are finished and the replies are sent
+        # before the connections are closed
+        await asyncio.gather(*self.tasks, *self.media_jobs, return_exceptions=True)
+        await self.outbox.stop()
+        await self.term_collection.close()
+        await self.client.close()
+
+
+async def main():
+    # the bot is created on the running loop, which its semaphores and locks belong to
+    await AsyncBot().serve()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,397 @@
+import asyncio
+import json
+import logging
+import uuid
+
+import asyncpg
+
+from cache import LRUCache
+from config import get_settings
+from database import Term, POS_BY_CODE, TERM_DOCUMENT, database_url, pos_code
+from term_collection import TermCollection, TermPage, TermProfile, MediaRef, NOTIFY_CHUNK
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class AsyncTermCollection:
+    """
+    Variant of TermCollection for the asyncio mode (async_bot.py). The queries run on asyncpg with its own
+    connection pool, so a handler waiting for the database doesn't hold a thread. PostgreSQL only.
+    The methods return the same values as the methods of TermCollection with the same names.
+    """
+    ORDER_COLUMNS = {'name': 'name', 'id': 'id'}
+    LINK_TABLES = {'syn': ('synonyms', 'synonym_id'), 'sim': ('similar_words', 'similar_word_id')}
+    UPDATABLE_COLUMNS = TermCollection.UPDATABLE_COLUMNS
+    MEDIA_COLUMNS = TermCollection.MEDIA_COLUMNS
+
+    # the query of TermCollection.SEARCH_SQL with asyncpg placeholders: $1 query, $2 prefix pattern, $3 limit
+    SEARCH_SQL = f"""
+        SELECT id, name,
+               greatest(similarity(name, $1),
+                        ts_rank({TERM_DOCUMENT}, plainto_tsquery('simple', $1))) AS rank
+        FROM terms
+        WHERE name % $1
+           OR name LIKE $2
+           OR {TERM_DOCUMENT} @@ plainto_tsquery('simple', $1)
+        ORDER BY name LIKE $2 DESC, rank DESC, name
+        LIMIT $3
+    """
+
+    # the profile of TermCollection.profile in one query: the term, the file ids of its media blobs
+    # and its synonyms and similar words as JSON arrays of [id, name] pairs ordered by name
+    PROFILE_SQL = """
+        SELECT terms.id, terms.name, terms.pos_tag, terms.description,
+               terms.image, image_blob.file_id AS image_file_id,
+               terms.audiofile, audio_blob.file_id AS audiofile_file_id,
+               terms.videofile, video_blob.file_id AS videofile_file_id,
+               (SELECT coalesce(json_agg(json_build_array(linked.id, linked.name) ORDER BY linked.name), '[]')
+                FROM synonyms JOIN terms AS linked ON linked.id = synonyms.synonym_id
+                WHERE synonyms.term_id = terms.id) AS synonyms,
+               (SELECT coalesce(json_agg(json_build_array(linked.id, linked.name) ORDER BY linked.name), '[]')
+                FROM similar_words JOIN terms AS linked ON linked.id = similar_words.similar_word_id
+                WHERE similar_words.term_id = terms.id) AS similars
+        FROM terms
+        LEFT JOIN media_blobs AS image_blob ON image_blob.key = terms.image
+        LEFT JOIN media_blobs AS audio_blob ON audio_blob.key = terms.audiofile
+        LEFT JOIN media_blobs AS video_blob ON video_blob.key = terms.videofile
+        WHERE terms.id = $1
+    """
+
+    def __init__(self, connection_string=None, min_size=2, max_size=20):
+        """
+        :param connection_string: None for the database of config.ini
+        :param min_size: number of connections opened at start
+        :param max_size: maximum number of connections of the pool
+        """
+        self.connection_string = connection_string or database_url()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+        cache_settings = get_settings().cache
+        self.terms_cache = LRUCache(maxsize=cache_settings.term_cache_size, ttl=cache_settings.ttl)
+        self.pages_cache = LRUCache(maxsize=cache_settings.page_cache_size, ttl=cache_settings.ttl)
+
+        # invalidations sent by this instance are already applied, the listener skips them
+        self.origin = uuid.uuid4().hex
+        self.notify_channel = cache_settings.notify_channel
+        self.listener = None
+        self.reconnecting = None
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(self.connection_string, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        if self.listener is not None:
+            self.listener.remove_termination_listener(self._on_listener_lost)
+            await self.listener.close()
+            self.listener = None
+        await self.pool.close()
+
+    def cache_stats(self):
+        """
+        :return: dictionary with hit/miss/eviction counters of every cache
+        """
+        return {'terms': self.terms_cache.stats(), 'pages': self.pages_cache.stats()}
+
+    def invalidate(self, term_ids=(), pages=False):
+        """
+        Drops the cached terms, and optionally all cached pages of the term list
+        """
+        for term_id in term_ids:
+            self.terms_cache.pop(term_id)
+        if pages:
+            self.pages_cache.clear()
+
+    async def listen_for_invalidations(self):
+        """
+        Applies the invalidations of other bot processes, threaded or asyncio, sent to the NOTIFY channel
+        set by notify_channel in the [cache] section of config.ini. The listener has its own connection.
+        """
+        if self.notify_channel and self.listener is None:
+            listener = await asyncpg.connect(self.connection_string)
+            await listener.add_listener(self.notify_channel, self._on_notification)
+            listener.add_termination_listener(self._on_listener_lost)
+            self.listener = listener
+            # the notifications sent while the listener was disconnected are lost
+            self.clear_caches()
+
+    def clear_caches(self):
+        """
+        Drops everything cached, e.g. when invalidations of other processes may have been missed
+        """
+        self.terms_cache.clear()
+        self.pages_cache.clear()
+
+    def _on_listener_lost(self, connection):
+        self.listener = None
+        self.reconnecting = asyncio.ensure_future(self._reconnect_listener())
+
+    async def _reconnect_listener(self, delay=5):
+        while self.listener is None:
+            try:
+                await self.listen_for_invalidations()
+            except (OSError, asyncpg.PostgresError) as e:
+                logger.warning('Cache invalidation listener of "%s" failed: %s', self.notify_channel, e)
+                await asyncio.sleep(delay)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        payload = json.loads(payload)
+        if payload.get('origin') != self.origin:
+            self.invalidate(payload.get('terms', ()), payload.get('pages', False))
+
+    async def _notify(self, connection, term_ids=(), pages=False):
+        """
+        Notifies the other bot processes about the write. Must be called inside the transaction of the write,
+        so the notification is delivered only if the write is committed. The ids are sent in chunks,
+        see TermCollection._write_done.
+        """
+        if self.notify_channel:
+            term_ids = list(term_ids)
+            for i in range(0, max(len(term_ids), 1), NOTIFY_CHUNK):
+                payload = json.dumps({'origin': self.origin, 'terms': term_ids[i:i + NOTIFY_CHUNK],
+                                      'pages': pages and i == 0})
+                await connection.execute('SELECT pg_notify($1, $2)', self.notify_channel, payload)
+
+    async def get_terms(self, after=None, before=None, limit=20, order_by='name'):
+        """
+        Fetches (id, name) pairs of the terms using keyset pagination, see TermCollection.get_terms
+        :return: list of (id, name) tuples in ascending order
+        """
+        key = (after, before, limit, order_by)
+        # the pages read while a write invalidated the cache are not cached, see LRUCache
+        generation = self.pages_cache.generation
+        terms = self.pages_cache.get(key)
+        if terms is not None:
+            return terms
+
+        column = self.ORDER_COLUMNS[order_by]
+        async with self.pool.acquire() as connection:
+            if before is not None:
+                rows = await connection.fetch(
+                    f'SELECT id, name FROM terms WHERE {column} < $1 ORDER BY {column} DESC LIMIT $2', before, limit)
+                rows.reverse()
+            elif after is not None:
+                rows = await connection.fetch(
+                    f'SELECT id, name FROM terms WHERE {column} > $1 ORDER BY {column} LIMIT $2', after, limit)
+            else:
+                rows = await connection.fetch(f'SELECT id, name FROM terms ORDER BY {column} LIMIT $1', limit)
+
+        terms = [(row['id'], row['name']) for row in rows]
+        self.pages_cache.set(key, terms, generation)
+        return terms
+
+    async def get_page(self, after=None, before=None, limit=20, order_by='name'):
+        """
+        Fetches one page of the term list. One extra row is requested to find out whether the list goes on.
+        :return: TermPage
+        """
+        terms = await self.get_terms(after=after, before=before, limit=limit + 1, order_by=order_by)
+        more = len(terms) > limit
+
+        if before is not None:
+            return TermPage(terms[-limit:] if more else terms, has_prev=more, has_next=True)
+        return TermPage(terms[:limit], has_prev=after is not None, has_next=more)
+
+    async def search(self, query, limit=10):
+        """
+        Finds terms by a part of the name or the description, ranked by trigram similarity and full-text rank
+        :return: list of (id, name) pairs, the best matches first
+        """
+        query = ' '.join(query.lower().split())
+        if not query:
+            return []
+
+        prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(self.SEARCH_SQL, query, prefix, limit)
+        return [(row['id'], row['name']) for row in rows]
+
+    async def get(self, term_id):
+        """
+        :return: the term, read through the cache. The instance is shared, it must not be modified
+        """
+        generation = self.terms_cache.generation
+        term = self.terms_cache.get(term_id)
+        if term is not None:
+            return term
+
+        async with self.pool.acquire() as connection:
+            row = await connection.fetchrow(
+                'SELECT id, name, pos_tag, description, image, audiofile, videofile FROM terms WHERE id = $1', term_id)
+        if row is None:
+            return None
+
+        values = dict(row)
+        if values['pos_tag'] is not None:
+            values['pos_tag'] = POS_BY_CODE[values['pos_tag']]
+        term = Term(**values)
+        self.terms_cache.set(term_id, term, generation)
+        return term
+
+    async def profile(self, term_id):
+        """
+        Reads the term with its media and the terms linked with it in one query, see TermCollection.profile
+        :return: TermProfile, None if there is no such term
+        """
+        async with self.pool.acquire() as connection:
+            row = await connection.fetchrow(self.PROFILE_SQL, term_id)
+        if row is None:
+            return None
+
+        media = {}
+        for kind, column in TermCollection.MEDIA_KINDS.items():
+            if row[column]:
+                media[kind] = MediaRef(row[column], row[f'{column}_file_id'])
+        pos_tag = POS_BY_CODE[row['pos_tag']] if row['pos_tag'] is not None else None
+        return TermProfile(id=row['id'], name=row['name'], pos_tag=pos_tag, description=row['description'],
+                           media=media,
+                           synonyms=[tuple(linked) for linked in json.loads(row['synonyms'])],
+                           similars=[tuple(linked) for linked in json.loads(row['similars'])])
+
+    async def media_file_id(self, key):
+        """
+        :return: the Telegram file id of the blob, None if the file has never been sent or received by the bot
+        """
+        async with self.pool.acquire() as connection:
+            return await connection.fetchval('SELECT file_id FROM media_blobs WHERE key = $1', key)
+
+    async def media_extension(self, key):
+        """
+        :return: extension of the blob file, e.g. '.jpg', None if it is unknown
+        """
+        async with self.pool.acquire() as connection:
+            return await connection.fetchval('SELECT extension FROM media_blobs WHERE key = $1', key)
+
+    async def set_media_file_id(self, key, file_id, file_unique_id=None):
+        """
+        Keeps the Telegram file id of the blob, e.g. after the file was uploaded again
+        """
+        async with self.pool.acquire() as connection:
+            await connection.execute('UPDATE media_blobs SET file_id = $2, file_unique_id = $3 WHERE key = $1',
+                                     key, file_id, file_unique_id)
+
+    async def create(self, term_name):
+        """
+        Adds the term unless a term with this name exists, in one statement
+        :return: id of the new term, None if the term already existed
+        """
+        names = TermCollection.normalize_words([term_name])
+        if not names:
+            return None
+
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                term_id = await connection.fetchval(
+                    "INSERT INTO terms (id, name) VALUES (nextval('terms_id_seq'), $1) "
+                    "ON CONFLICT (name) DO NOTHING RETURNING id", names[0])
+                if term_id is not None:
+                    await self._notify(connection, pages=True)
+
+        if term_id is not None:
+            self.invalidate(pages=True)
+        return term_id
+
+    async def update(self, term_id, dictionary):
+        """
+        Updates the columns of the term with one UPDATE statement
+        :param dictionary: {column: value}, only the columns from UPDATABLE_COLUMNS are allowed
+        :return: number of updated rows
+        """
+        unknown = set(dictionary) - self.UPDATABLE_COLUMNS
+        if unknown:
+            raise ValueError(f'Columns {", ".join(sorted(unknown))} of the term can\'t be updated')
+
+        columns = list(dictionary)
+        if 'pos_tag' in dictionary:
+            dictionary = dict(dictionary, pos_tag=pos_code(dictionary['pos_tag']))
+        assignments = ', '.join(f'{column} = ${i + 2}' for i, column in enumerate(columns))
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                status = await connection.execute(f'UPDATE terms SET {assignments} WHERE id = $1',
+                                                  term_id, *(dictionary[column] for column in columns))
+                await self._notify(connection, term_ids=[term_id])
+
+        self.invalidate([term_id])
+        # the status of the command is 'UPDATE <rows>'
+        return int(status.split()[-1])
+
+    async def set_media(self, term_id, column, key, size, extension=None, file_id=None, file_unique_id=None):
+        """
+        Points the media column of the term to the blob of the media store and moves the reference
+        from the previous blob of the column to the new one in the same transaction
+        :param column: 'image', 'audiofile' or 'videofile'
+        :param extension: extension of the uploaded file, kept with a new blob
+        :param file_id: Telegram id of the file, kept with the blob to send the file again without uploading it
+        :return: key of the previous blob, None if there was none
+        :raise ValueError: the term doesn't exist, nothing is changed
+        """
+        if column not in self.MEDIA_COLUMNS:
+            raise ValueError(f'Column {column} of the term doesn\'t keep media')
+
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                row = await connection.fetchrow(f'SELECT {column} FROM terms WHERE id = $1 FOR UPDATE', term_id)
+                if row is None:
+                    # the term was deleted, the transaction is rolled back by the exception
+                    raise ValueError(f'Term {term_id} doesn\'t exist')
+                previous = row[column]
+                if previous == key:
+                    if file_id:
+                        await connection.execute('UPDATE media_blobs SET file_id = $2, file_unique_id = $3 '
+                                                 'WHERE key = $1', key, file_id, file_unique_id)
+                    return previous
+
+                # the file id of the blob is replaced only by a known one
+                await connection.execute(
+                    'INSERT INTO media_blobs (key, size, refcount, file_id, file_unique_id, extension) '
+                    'VALUES ($1, $2, 1, $3, $4, $5) '
+                    'ON CONFLICT (key) DO UPDATE SET refcount = media_blobs.refcount + 1, '
+                    'file_id = coalesce(excluded.file_id, media_blobs.file_id), '
+                    'file_unique_id = coalesce(excluded.file_unique_id, media_blobs.file_unique_id), '
+                    'extension = coalesce(media_blobs.extension, excluded.extension)',
+                    key, size, file_id, file_unique_id, extension)
+                await connection.execute(f'UPDATE terms SET {column} = $2 WHERE id = $1', term_id, key)
+                if previous:
+                    await connection.execute('UPDATE media_blobs SET refcount = refcount - 1 WHERE key = $1', previous)
+                await self._notify(connection, term_ids=[term_id])
+
+        self.invalidate([term_id])
+        return previous
+
+    async def add_synonyms_similars(self, term_id, words, table='syn'):
+        """
+        Links the term with the words as synonyms ('syn') or similar words ('sim').
+        Missing words are added as new terms, with the same three statements as TermCollection.add_synonyms_similars.
+        :return: ids of the linked terms
+        """
+        link_table, link_column = self.LINK_TABLES[table]
+        words = TermCollection.normalize_words(words)
+        if not words:
+            return []
+
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                rows = await connection.fetch(
+                    "INSERT INTO terms (id, name) SELECT nextval('terms_id_seq'), name FROM unnest($1::text[]) name "
+                    "ON CONFLICT (name) DO NOTHING RETURNING id, name", words)
+                ids = {row['name']: row['id'] for row in rows}
+
+                missing = [word for word in words if word not in ids]
+                if missing:
+                    rows = await connection.fetch('SELECT id, name FROM terms WHERE name = ANY($1::text[])', missing)
+                    ids.update((row['name'], row['id']) for row in rows)
+
+                linked = [ids[word] for word in words if ids[word] != term_id]
+                if linked:
+                    await connection.execute(
+                        f'INSERT INTO {link_table} (term_id, {link_column}) SELECT $1, unnest($2::int[]) '
+                        f'ON CONFLICT DO NOTHING', term_id, linked)
+                await self._notify(connection, term_ids=[term_id] + linked, pages=True)
+
+        self.invalidate([term_id] + linked, pages=True)
+        return linked
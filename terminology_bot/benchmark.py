@@ -0,0 +1,293 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from fake_telegram import FakeTelegram
+
+
+TOKEN = '123456:benchmark'
+TERM_NAME = 'term {:07d}'
+POS_TAGS = ['noun', 'verb', 'adjective']
+
+
+def percentile(values, q):
+    """
+    :param values: sorted list
+    :param q: percentile from 0 to 100
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def seed_records(size):
+    """
+    Yields the glossary records of the benchmark database, every tenth term has a synonym
+    """
+    for i in range(size):
+        yield {'name': TERM_NAME.format(i), 'pos_tag': POS_TAGS[i % 3], 'description': f'Description of the term {i}.',
+               'synonyms': [TERM_NAME.format(i + 1)] if i % 10 == 0 and i + 1 < size else []}
+
+
+def message_update(update_id, user_id, text=None, photo=None):
+    """
+    :return: update dictionary of a private message as sent by Telegram
+    """
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private', 'first_name': f'User {user_id}'},
+               'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'language_code': 'en'}}
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if photo is not None:
+        message['photo'] = [{'file_id': photo, 'width': 640, 'height': 480}]
+    return {'update_id': update_id, 'message': message}
+
+
+def user_flow(user, size, page_size):
+    """
+    One conversation: start, the second page of the list, choosing a term, its description, synonyms and image,
+    the related terms, the profile card and a search
+    :return: list of (step name, message keyword arguments)
+    """
+    return [
+        ('start', {'text': '/start'}),
+        ('list', {'text': 'Get list of terms'}),
+        ('next_page', {'text': '/next'}),
+        ('choose', {'text': str(page_size + 1 + user % page_size)}),
+        ('description_option', {'text': 'Description'}),
+        ('description', {'text': f'Description written by the user {user}.'}),
+        ('synonyms_option', {'text': 'Synonyms'}),
+        ('synonyms', {'text': f'alias {user} a, alias {user} b, {TERM_NAME.format(user * 7 % size)}'}),
+        ('image_option', {'text': 'Image'}),
+        ('image', {'photo': f'photo-{user}'}),
+        ('related', {'text': '/related'}),
+        ('show', {'text': '/show'}),
+        ('search', {'text': f'/search {TERM_NAME.format(user * 13 % size)[:-2]}'}),
+        ('cancel', {'text': '/cancel'}),
+    ]
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed by the thread handling the updates, see the before_cursor_execute event
+    """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread() is self.thread:
+            self.count += 1
+
+    def take(self):
+        count, self.count = self.count, 0
+        return count
+
+
+def run_worker(database_url, size, users):
+    """
+    Seeds the database with `size` terms and passes the conversations of `users` users through the dispatcher
+    of the bot, one update at a time. The bot talks to a local FakeTelegram.
+    :return: dictionary with the latency and the number of SQL statements of every step
+    """
+    fake = FakeTelegram(TOKEN)
+    fake.start()
+    media_dir = tempfile.mkdtemp(prefix='benchmark-media-')
+    os.environ.update({
+        'TERMINOLOGY_BOT_TOKEN': TOKEN,
+        'TERMINOLOGY_BOT_BASE_URL': fake.base_url,
+        'TERMINOLOGY_BOT_BASE_FILE_URL': fake.base_file_url,
+        'TERMINOLOGY_BOT_MULTIMEDIA_DIR': media_dir,
+        'TERMINOLOGY_POSTGRESQL_URL': database_url,
+        'TERMINOLOGY_STATE_BACKEND': 'memory',
+    })
+
+    # the modules of the bot read the configuration when they are imported
+    from sqlalchemy import event
+    from telegram import Update
+    import database
+    import metrics
+    import migrations
+    from bot import Bot, settings
+    from glossary_io import GlossaryImporter
+    logging.getLogger().setLevel(logging.WARNING)
+
+    engine = database.get_engine()
+    database.Base.metadata.drop_all(engine)
+    migrations.schema_migrations.drop(engine, checkfirst=True)
+    database.create_tables()
+
+    started = time.perf_counter()
+    GlossaryImporter(batch_size=10000).run(seed_records(size))
+    seed_seconds = time.perf_counter() - started
+    rss_seeded = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    timer = metrics.StartupTimer()
+    with timer.phase('init'):
+        bot = Bot()
+    with timer.phase('setup'):
+        bot.setup()
+    bot.warmup(timer)
+    startup = timer.report()
+    telegram_bot = bot.updater.bot
+    telegram_bot.get_me()
+    page_size = settings.bot.terms_page_size
+
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+
+    steps = {}
+    update_id = 0
+    started = time.perf_counter()
+    for user in range(users):
+        for step, message in user_flow(user, size, page_size):
+            update_id += 1
+            update = Update.de_json(message_update(update_id, 1000 + user, **message), telegram_bot)
+            counter.take()
+            step_started = time.perf_counter()
+            bot.dispatcher.process_update(update)
+            latency = time.perf_counter() - step_started
+            step_stats = steps.setdefault(step, {'latencies': [], 'queries': 0})
+            step_stats['latencies'].append(latency)
+            step_stats['queries'] += counter.take()
+    run_seconds = time.perf_counter() - started
+
+    bot.media.stop()
+    bot.outbox.stop()
+    fake.stop()
+    shutil.rmtree(media_dir, ignore_errors=True)
+
+    def summary(latencies, queries):
+        latencies = sorted(latencies)
+        return {'count': len(latencies),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'queries': queries / len(latencies)}
+
+    all_latencies = [latency for stats in steps.values() for latency in stats['latencies']]
+    return {
+        'backend': engine.dialect.name,
+        'size': size,
+        'users': users,
+        'seed_seconds': seed_seconds,
+        'updates_per_second': len(all_latencies) / run_seconds,
+        'steps': {step: summary(stats['latencies'], stats['queries']) for step, stats in steps.items()},
+        'total': summary(all_latencies, sum(stats['queries'] for stats in steps.values())),
+        'startup_seconds': startup,
+        'max_rss_kb': {'seeded': rss_seeded, 'end': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'telegram_calls': dict(fake.calls),
+        'outbox': bot.outbox.stats(),
+        'reads': database.get_router().stats(),
+        'sessions': bot.dispatcher.user_data.memory_report(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(backends, sizes, users, postgresql_url=None):
+    """
+    Runs every backend and size in its own process, so the runs don't share caches, engines or memory
+    :return: dictionary of the results
+    """
+    results = {'commit': git_commit(), 'created_at': datetime.now(timezone.utc).isoformat(),
+               'python': platform.python_version(), 'runs': []}
+    for backend in backends:
+        for size in sizes:
+            directory = tempfile.mkdtemp(prefix='benchmark-db-')
+            url = f'sqlite:///{directory}/benchmark.db' if backend == 'sqlite' else postgresql_url
+            try:
+                print(f'Running {backend} with {size} terms...', file=sys.stderr)
+                command = [sys.executable, os.path.abspath(__file__), 'worker', url, str(size), str(users)]
+                output = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+                result = json.loads(output.decode('utf-8').splitlines()[-1])
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+            results['runs'].append(result)
+            total = result['total']
+            print(f'{backend:>10} {size:>8} terms: p50 {total["p50_ms"]:.2f} ms, p99 {total["p99_ms"]:.2f} ms, '
+                  f'{total["queries"]:.1f} queries per update, {result["updates_per_second"]:.0f} updates/s',
+                  file=sys.stderr)
+    return results
+
+
+def compare(old, new):
+    """
+    Prints the change of the latency and of the number of queries of every step between two result files
+    """
+    old_runs = {(run_result['backend'], run_result['size']): run_result for run_result in old['runs']}
+    print(f'{old.get("commit") or "?"} -> {new.get("commit") or "?"}')
+    for result in new['runs']:
+        previous = old_runs.get((result['backend'], result['size']))
+        if previous is None:
+            continue
+        print(f'\n{result["backend"]}, {result["size"]} terms')
+        for step, stats in list(result['steps'].items()) + [('total', result['total'])]:
+            before = previous['total'] if step == 'total' else previous['steps'].get(step)
+            if before is None:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p99_ms', 'queries'):
+                change = f' ({(stats[key] / before[key] - 1) * 100:+.0f}%)' if before[key] else ''
+                changes.append(f'{key} {before[key]:.2f} -> {stats[key]:.2f}{change}')
+            changes = ' '.join(changes)
+            print(f'  {step:<20} {changes}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of the conversation handlers on a fake Telegram server')
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help='run the benchmark and save the results')
+    run_parser.add_argument('--backends', nargs='+', choices=['sqlite', 'postgresql'], default=['sqlite'])
+    run_parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000, 1000000],
+                            help='numbers of terms in the database')
+    run_parser.add_argument('--users', type=int, default=50, help='number of conversations per run')
+    run_parser.add_argument('--postgresql', help='URL of a scratch PostgreSQL database, its tables are dropped')
+    run_parser.add_argument('--output', default='benchmark.json', help='JSON file of the results')
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('database_url')
+    worker_parser.add_argument('size', type=int)
+    worker_parser.add_argument('users', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        print(json.dumps(run_worker(args.database_url, args.size, args.users)))
+    elif args.command == 'run':
+        if 'postgresql' in args.backends and not args.postgresql:
+            parser.error('--postgresql URL is required for the postgresql backend')
+        results = run(args.backends, args.sizes, args.users, args.postgresql)
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f'Results saved to {args.output}.', file=sys.stderr)
+    elif args.command == 'compare':
+        with open(args.old, encoding='utf-8') as old, open(args.new, encoding='utf-8') as new:
+            compare(json.load(old), json.load(new))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,28 @@
+import functools
 import logging
-import hashlib
-import gettext
-import os
-from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
+import signal
+import threading
+import time
+from telegram import Bot as TelegramBot, ReplyKeyboardRemove, Update
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, RegexHandler,
-                          ConversationHandler)
-
-from config import get_config
+                          ConversationHandler, BaseFilter, TypeHandler)
+from telegram.utils.request import Request
+
+import metrics
+import migrations
+from config import get_settings
+from conversation import Conversation, TermStore, run_sync
+import database
+from database import database_url, get_engine
 from term_collection import TermCollection
-from database import POSEnum
+from locale_catalog import LocaleCatalog
+from media_ingest import MediaIngestor
+from media_sender import MediaSender
+from media_store import MediaStore
+from outbox import Outbox
+from term_graph import TermGraph
+from state_store import create_state_store, PersistentConversations, PersistentUserData
+from webhook import DispatcherSink, WebhookServer
 
 
 # logging settings
@@ -17,476 +31,431 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 # getting bot parameters from config file
-params = get_config(section='bot')
-
+settings = get_settings()
 
-class Bot:
-    START_MENU, CHOOSE_TERM, NEW_TERM, CHOOSE_OPTION, \
-    POS, DESCRIPTION, SYNONYMS, SIMILARS, IMAGE, AUDIO, VIDEO = range(11)
 
-    def __init__(self):
-        self.updater = Updater(token=params['token'])
-        self.dispatcher = self.updater.dispatcher
-        self.term_collection = TermCollection()
-        self.cur_term = {}
-
-    def set_language_and_options(self, lang_code):
-        """Sets language, UI-elements and button handlers according to lang_code"""
-        locale_path = 'data/locale/'
-        language = gettext.translation('bot', locale_path, ['en'])
-
-        try:
-            language = gettext.translation('bot', locale_path, [lang_code])
-        except IOError:
-            logger.info('No translation files for "%s" were found. English was set by default.', lang_code)
-        finally:
-            _ = language.gettext
-            options = {
-                'new_term': _('Add new term'),
-                'list_term': _('Get list of terms'),
-                'pos_tag': _('POS-tag'),
-                'description': _('Description'),
-                'synonyms': _('Synonyms'),
-                'similars': _('Similar words'),
-                'image': _('Image'),
-                'audio': _('Audio'),
-                'video': _('Video'),
-            }
-            pos_tags = {_(member.value): member.value for name, member in POSEnum.__members__.items()}
-
-            start_btn, term_btn, pos_btn = self.set_keyboard(options, pos_tags.keys())
-            self.update_state_handlers(options, pos_tags.keys())
-
-            return language, options, pos_tags, start_btn, term_btn, pos_btn
-
-    def set_keyboard(self, options, tags):
-        """Sets keyboard according to user's language. Default is English."""
-        start_btn = [[options['new_term']], [options['list_term']]]
-        term_btn = [[options['pos_tag'], options['description']],
-                    [options['synonyms'], options['similars']],
-                    [options['image'], options['audio'], options['video']]]
-        pos_btn = [tags]
-        return start_btn, term_btn, pos_btn
-
-    def update_state_handlers(self, options, tags):
-        """Adds Regular Expression Handlers according to user's language."""
-        self.dispatcher.handlers[0][0].states[self.START_MENU].extend([
-            RegexHandler(f"^{options['new_term']}$", self.new_term_option, pass_user_data=True),
-            RegexHandler(f"^{options['list_term']}$", self.list_of_terms_option, pass_user_data=True)
-        ])
-        self.dispatcher.handlers[0][0].states[self.CHOOSE_OPTION].append(
-            RegexHandler(f"^({options['pos_tag']}|{options['description']}|{options['synonyms']}|"
-                         f"{options['similars']}|{options['image']}|{options['audio']}|{options['video']})$",
-                         self.choose_menu_option, pass_user_data=True)
-        )
-        self.dispatcher.handlers[0][0].states[self.POS].append(
-            RegexHandler(f"^({'|'.join(tags)})$", self.pos_tag, pass_user_data=True)
-        )
-
-    def start(self, bot, update, user_data):
-        """
-        Sends the greeting message with the start menu: 'Add new term' and 'Get list of terms' options
-        :return: the state START_MENU
-        """
-        lang_code = update.message.from_user.language_code
-        lang, options, pos_tags, start_btn, term_btn, pos_btn = self.set_language_and_options(lang_code)
-        user_data.update({'lang': lang, 'options': options, 'pos_tags': pos_tags,
-                          'start_btn': start_btn, 'term_btn': term_btn, 'pos_btn': pos_btn})
-
-        _ = user_data['lang'].gettext
-        update.message.reply_text(_('Hello! I am Terminology Bot. Send /cancel to stop talking to me.'),
-                                  reply_markup=ReplyKeyboardMarkup(keyboard=user_data['start_btn'],
-                                                                   resize_keyboard=True, one_time_keyboard=True))
-        return self.START_MENU
-
-    def new_term_option(self, bot, update, user_data):
-        """
-        Callback function for the user choosing 'Add new term' option
-        :return: the state NEW_TERM
-        """
-        _ = user_data['lang'].gettext
-        update.message.reply_text(_('Type in the term.'))
-        return self.NEW_TERM
-
-    def add_new_term(self, bot, update, user_data):
-        """
-        Adds new term to DB from the user input
-        :return: the state START_MENU
-        """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-        term_name = update.message.text
-
-        logger.info('User %s added the term "%s"', user.first_name, term_name)
-
-        self.term_collection.create(term_name)
-
-        update.message.reply_text(_('I\'ll remember this term.'), reply_markup=ReplyKeyboardMarkup(
-            keyboard=user_data['start_btn'], resize_keyboard=True, one_time_keyboard=True))
-
-        return self.START_MENU
-
-    def list_of_terms_option(self, bot, update, user_data):
-        """
-        Callback function for the user choosing 'Get list of terms' option.
-        Sends the message with the list of terms from DB.
-        :return: the state CHOOSE_TERM
-        """
-        _ = user_data['lang'].gettext
+class LabelFilter(BaseFilter):
+    """Passes the messages which text is a button label registered for the conversation state"""
 
-        terms = self.term_collection.get_terms()
-        user_data['terms'] = {i+1: terms[i] for i in range(len(terms))}
-        terms_list = [f'{key}. {term.name}' for key, term in user_data['terms'].items()]
+    def __init__(self, routes, state):
+        self.routes = routes
+        self.state = state
 
-        text_list = [_('These are the terms I know:')]
-        text_list.extend(terms_list)
-        text_list.append(_('\nPlease, choose one of them.'))
+    def filter(self, message):
+        return message.text in self.routes[self.state]
 
-        text = '\n'.join(text_list)
 
-        update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+class Bot(Conversation):
+    """
+    The bot in the threaded mode: the handlers of the conversation run on the dispatcher threads
+    of python-telegram-bot, the replies are sent by the worker threads of the outbox
+    """
 
-        return self.CHOOSE_TERM
-
-    def choose_term(self, bot, update, user_data):
-        """
-        Sets the current term for future editing based on the user input
-        :return: the state CHOOSE_OPTION
-        """
-        _ = user_data['lang'].gettext
-        user = update.message.from_user
-        try:
-            index = int(update.message.text)
-            id = user_data['terms'][index].id
-            user_data['cur_term'] = self.term_collection.get(id)
-
-            del user_data['terms']
-
-            logger.info('User %s chose the term "%s"', user.first_name, user_data['cur_term'].name)
-
-            _ = user_data['lang'].gettext
-
-            text = _('Let\'s make the profile of the term "%s".\n'
-                     'Feel free to go back to the /menu and to the list of /terms.') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                             resize_keyboard=True))
-
-            return self.CHOOSE_OPTION
-
-        except (IndexError, ValueError):
-            text = _('Please choose an index number of a term from the list above.')
-            update.message.reply_text(text)
-            return self.CHOOSE_TERM
-
-    def choose_menu_option(self, bot, update, user_data):
-        """
-        Directs the user for futher actions based on the option he chose from the menu
-        :return: the state depending on the user input
-        """
-        _ = user_data['lang'].gettext
-
-        option = update.message.text
-        if option == _('POS-tag'):
-            text = _('Choose the part-of-speech tag for the term "%s".') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(user_data['pos_btn'],
-                                                                             one_time_keyboard=True,
-                                                                             resize_keyboard=True))
-            return self.POS
-
-        elif option == _('Description'):
-            text = _('Give a description to the term "%s".') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.DESCRIPTION
-
-        elif option == _('Synonyms'):
-            text = _('List synonyms of the term "%s" separating them with comma.') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.SYNONYMS
-
-        elif option == _('Similar words'):
-            text = _('List words similar with the term "%s" separating them with comma.') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.SIMILARS
-
-        elif option == _('Image'):
-            text = _('Let\'s upload an image for the term "%s".') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.IMAGE
-
-        elif option == _('Audio'):
-            text = _('Let\'s upload an audiofile for the term "%s".') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.AUDIO
-
-        elif option == _('Video'):
-            text = _('Let\'s upload a video for the term "%s".') % user_data['cur_term'].name
-            update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
-            return self.VIDEO
+    # keyboard removal markup is the same for everyone, so there is no need to build it for every reply
+    REMOVE_KEYBOARD = ReplyKeyboardRemove()
 
+    def __init__(self):
+        workers = settings.workers.dispatcher
+        if settings.bot.base_url:
+            # another Bot API server, e.g. a local one or the fake server of benchmark.py
+            telegram_bot = TelegramBot(settings.bot.token, base_url=settings.bot.base_url,
+                                       base_file_url=settings.bot.base_file_url,
+                                       request=Request(con_pool_size=workers + 4))
+            self.updater = Updater(bot=telegram_bot, workers=workers)
         else:
-            text = _('Feel free to choose.')
-            update.message.reply_text(text, reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                             resize_keyboard=True))
-            return self.CHOOSE_OPTION
-
-    def pos_tag(self, bot, update, user_data):
-        """
-        Saves pos-tag of the current term to DB
-        """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-        pos_tag = update.message.text
-        original_pos_tag = user_data['pos_tags'][pos_tag]
-
-        logger.info('User %s chose pos-tag "%s"', user.first_name, original_pos_tag)
-
-        self.term_collection.update(user_data['cur_term'].id, {'pos_tag': original_pos_tag})
-
-        update.message.reply_text(_('I see!'), reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                                resize_keyboard=True))
-        return self.CHOOSE_OPTION
-
-    def description(self, bot, update, user_data):
-        """
-        Saves description of the current term to DB
-        """
-        _ = user_data['lang'].gettext
+            self.updater = Updater(token=settings.bot.token, workers=workers)
+        self.dispatcher = self.updater.dispatcher
+        self.term_collection = TermCollection()
+        self.graph = TermGraph(in_memory=settings.graph.in_memory, refresh_interval=settings.graph.refresh_interval)
+        self.terms = TermStore(self.term_collection, self.graph)
+        self.routes = {self.START_MENU: {}, self.CHOOSE_OPTION: {}, self.POS: {}}
+        self.locales = LocaleCatalog(on_load=self.update_state_handlers)
 
-        user = update.message.from_user
-        dscr = update.message.text
+        media = settings.media
+        self.media_store = MediaStore(media.directory)
+        self.media = MediaIngestor(self.updater.bot, self.term_collection, self.media_store,
+                                   on_done=self.media_saved,
+                                   workers=settings.workers.media,
+                                   queue_size=media.queue_size,
+                                   retries=media.retries,
+                                   retry_delay=media.retry_delay,
+                                   chunk_size=media.chunk_size,
+                                   timeout=media.timeout)
+        self.media_sender = MediaSender(self.term_collection, self.media_store, timeout=media.timeout)
 
-        logger.info('User %s gave a description to the term "%s"', user.first_name, user_data['cur_term'].name)
+        outbox = settings.outbox
+        self.outbox = Outbox(self.updater.bot,
+                             rate=outbox.rate,
+                             burst=outbox.burst,
+                             chat_rate=outbox.chat_rate,
+                             chat_burst=outbox.chat_burst,
+                             queue_size=outbox.queue_size,
+                             workers=settings.workers.outbox,
+                             retries=outbox.retries)
 
-        self.term_collection.update(user_data['cur_term'].id, {'description': dscr})
+        # conversation states and user_data live in the state store, so any process can continue a conversation
+        self.state_store = create_state_store(settings.state.backend, sqlite_path=settings.state.sqlite_path,
+                                              max_sessions=settings.sessions.max_sessions)
+        self.dispatcher.user_data = PersistentUserData(self.state_store, max_sessions=settings.sessions.max_sessions)
 
-        update.message.reply_text(_('Good work!'), reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                                    resize_keyboard=True))
-        return self.CHOOSE_OPTION
+        self.profiler = metrics.SamplingProfiler(interval=settings.metrics.profiler_interval)
+        self.metrics_server = None
+        self.metrics_logger = None
 
-    def image(self, bot, update, user_data):
+    def update_state_handlers(self, locale):
         """
-        Saves image of the current term to DB
+        Adds the button labels of the user's language to the routing tables of the states.
+        Called once per language by the locale catalog. The tables are replaced as a whole,
+        so the dispatcher threads never see a half-updated table.
         """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-        photo_file = bot.get_file(update.message.photo[-1].file_id)
-
-        filename_sha1 = hashlib.sha1(bytes(f"image_{user_data['cur_term'].id}", encoding='utf8')).hexdigest()
-
-        directory = f"{params['multimedia_dir']}/images"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        photo_file.download(f"{directory}/{filename_sha1}.jpg")
-
-        logger.info('User %s uploaded the image for the term "%s"', user.first_name, user_data['cur_term'].name)
-
-        self.term_collection.update(user_data['cur_term'].id, {'image': f"image_{user_data['cur_term'].id}"})
+        options = locale.options
+        labels = {
+            self.START_MENU: {options['new_term']: self.new_term_option,
+                              options['list_term']: self.list_of_terms_option},
+            self.CHOOSE_OPTION: {options[key]: self.choose_menu_option
+                                 for key in ('pos_tag', 'description', 'synonyms', 'similars',
+                                             'image', 'audio', 'video')},
+            self.POS: {tag: self.pos_tag for tag in locale.pos_tags},
+        }
+        for state, table in labels.items():
+            self.routes[state] = {**self.routes[state], **table}
 
-        update.message.reply_text(_('Awesome!'), reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                                  resize_keyboard=True))
-        return self.CHOOSE_OPTION
-
-    def audio(self, bot, update, user_data):
+    def label_handler(self, state):
         """
-        Saves audiofile of the current term to DB
+        Creates the single handler of the state, which routes the button labels of all languages
+        through the lookup table of the state
         """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-        if update.message.audio:
-            audio_file = bot.get_file(update.message.audio)
-        elif update.message.voice:
-            audio_file = bot.get_file(update.message.voice)
-            print(audio_file)
-
-        filename_sha1 = hashlib.sha1(bytes(f"audio_{user_data['cur_term'].id}", encoding='utf8')).hexdigest()
-
-        directory = f"{params['multimedia_dir']}/audio"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        audio_file.download(f"{directory}/{filename_sha1}")
-
-        logger.info('User %s uploaded the audiofile for the term "%s"', user.first_name, user_data['cur_term'].name)
-
-        self.term_collection.update(user_data['cur_term'].id, {'audiofile': f"audio_{user_data['cur_term'].id}"})
+        async def route(bot, update, user_data):
+            return await self.routes[state][update.message.text](bot, update, user_data)
 
-        update.message.reply_text(_('Awesome!'), reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                                  resize_keyboard=True))
-        return self.CHOOSE_OPTION
+        return MessageHandler(Filters.text & LabelFilter(self.routes, state), self.callback(route),
+                              pass_user_data=True)
 
-    def video(self, bot, update, user_data):
+    def callback(self, handler):
         """
-        Saves videofile of the current term to DB
+        :param handler: coroutine function of the conversation, see Conversation
+        :return: the callback of the handler for the dispatcher threads
         """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-
-        video_file = bot.get_file(update.message.video)
-
-        filename_sha1 = hashlib.sha1(bytes(f"video_{user_data['cur_term'].id}", encoding='utf8')).hexdigest()
-
-        directory = f"{params['multimedia_dir']}/video"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        video_file.download(f"{directory}/{filename_sha1}")
-
-        logger.info('User %s uploaded the videofile for the term "%s"', user.first_name, user_data['cur_term'].name)
-
-        self.term_collection.update(user_data['cur_term'].id, {'videofile': f"video_{user_data['cur_term'].id}"})
+        @functools.wraps(handler)
+        def callback(bot, update, **kwargs):
+            return run_sync(handler(bot, update, **kwargs))
 
-        update.message.reply_text(_('Awesome!'), reply_markup=ReplyKeyboardMarkup(keyboard=user_data['term_btn'],
-                                                                                  resize_keyboard=True))
-        return self.CHOOSE_OPTION
+        return callback
 
-    def synonyms(self, bot, update, user_data):
+    def send_media(self, update, kind, key, file_id=None):
         """
-        Saves synonyms of the current term to DB
+        Queues the media file of the term to the chat of the update, see Conversation.send_media
         """
-        _ = user_data['lang'].gettext
+        send = functools.partial(self.media_sender.send, kind=kind, key=key, file_id=file_id)
+        self.outbox.send_media(update.effective_chat.id, send)
 
-        user = update.message.from_user
-        text = update.message.text
-
-        synonyms = [syn.strip(' ') for syn in text.split(',')]
-
-        logger.info('User %s listed synonyms for the term "%s"', user.first_name, user_data['cur_term'].name)
-
-        self.term_collection.add_synonyms_similars(user_data['cur_term'].id, words=synonyms, table='syn')
-
-        update.message.reply_text(_('I\'ll remember this!'), reply_markup=ReplyKeyboardMarkup(
-            keyboard=user_data['term_btn'], resize_keyboard=True))
-        return self.CHOOSE_OPTION
-
-    def similars(self, bot, update, user_data):
+    def submit_media(self, job):
         """
-        Saves similar words of the current term to DB
+        Queues the file for the media worker threads, see MediaIngestor
         """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-        text = update.message.text
-
-        similars = [sim.strip(' ') for sim in text.split(',')]
-
-        logger.info('User %s listed similar words for the term "%s"', user.first_name, user_data['cur_term'].name)
-
-        self.term_collection.add_synonyms_similars(user_data['cur_term'].id, words=similars, table='sim')
-
-        update.message.reply_text(_('I\'ll remember this!'), reply_markup=ReplyKeyboardMarkup(
-            keyboard=user_data['term_btn'], resize_keyboard=True))
-        return self.CHOOSE_OPTION
+        return self.media.submit(job)
 
     def error(self, bot, update, error):
         """
         Log Errors caused by Updates.
         """
+        metrics.UPDATE_ERRORS.inc()
         logger.warning('Update "%s" caused error "%s"', update, error)
 
-    def cancel(self, bot, update, user_data):
+    def end_session(self, key):
         """
-        Finishes the conversation after the user entered /cancel command
+        Forgets the user's session when the conversation ends, by /cancel or after conversation_timeout seconds
+        without updates; the next conversation starts with a new session. Sessions are per user, so the session
+        is kept while the user has a conversation in another chat.
+        :param key: (chat id, user id) of the conversation
         """
-        _ = user_data['lang'].gettext
-
-        user = update.message.from_user
-
-        logger.info('User %s canceled the conversation.', user.first_name)
+        if not self.conversations.user_active(key[1]):
+            self.dispatcher.user_data.expire(key[1])
 
-        update.message.reply_text(_('Bye! I hope we can talk again some day.'),
-                                  reply_markup=ReplyKeyboardRemove())
-
-        return ConversationHandler.END
+    def save_session(self, bot, update):
+        """
+        Writes the user's data to the state store after the conversation handler has handled the update
+        """
+        if update.effective_user:
+            self.dispatcher.user_data.flush(update.effective_user.id)
 
-    def run(self):
+    def conversation_handler(self):
         """
-        Registers the handlers of user actions and starts the bot
+        Declares the conversation: the handlers of user actions in every state.
+        The asyncio mode (async_bot.py) runs the same declaration and awaits the handlers instead of running them
+        with callback().
         """
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('start', self.start, pass_user_data=True)],
+        return ConversationHandler(
+            entry_points=[CommandHandler('start', self.callback(self.start), pass_user_data=True),
+                          CommandHandler('search', self.callback(self.search), pass_args=True, pass_user_data=True)],
 
             states={
-                self.START_MENU: [],
+                self.START_MENU: [self.label_handler(self.START_MENU)],
 
                 self.CHOOSE_TERM: [
-                    RegexHandler('^[0-9]+$', self.choose_term, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    RegexHandler('^[0-9]+$', self.callback(self.choose_term), pass_user_data=True),
+                    CommandHandler('next', self.callback(self.next_terms_page), pass_user_data=True),
+                    CommandHandler('prev', self.callback(self.prev_terms_page), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.NEW_TERM: [
-                    MessageHandler(Filters.text, self.add_new_term, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.text, self.callback(self.add_new_term), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.CHOOSE_OPTION: [
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    self.label_handler(self.CHOOSE_OPTION),
+                    CommandHandler('related', self.callback(self.related_terms), pass_user_data=True),
+                    CommandHandler('show', self.callback(self.show_term), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.POS: [
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    self.label_handler(self.POS),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.DESCRIPTION: [
-                    MessageHandler(Filters.text, self.description, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.text, self.callback(self.description), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.SYNONYMS: [
-                    MessageHandler(Filters.text, self.synonyms, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.text, self.callback(self.synonyms), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.SIMILARS: [
-                    MessageHandler(Filters.text, self.similars, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.text, self.callback(self.similars), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.IMAGE: [
-                    MessageHandler(Filters.photo, self.image, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.photo, self.callback(self.image), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.AUDIO: [
-                    MessageHandler(Filters.audio | Filters.voice, self.audio, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.audio | Filters.voice, self.callback(self.audio), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ],
 
                 self.VIDEO: [
-                    MessageHandler(Filters.video, self.video, pass_user_data=True),
-                    CommandHandler('menu', self.choose_menu_option, pass_user_data=True),
-                    CommandHandler('terms', self.list_of_terms_option, pass_user_data=True),
-                    CommandHandler('start', self.start, pass_user_data=True)
+                    MessageHandler(Filters.video, self.callback(self.video), pass_user_data=True),
+                    CommandHandler('menu', self.callback(self.choose_menu_option), pass_user_data=True),
+                    CommandHandler('terms', self.callback(self.list_of_terms_option), pass_user_data=True),
+                    CommandHandler('start', self.callback(self.start), pass_user_data=True)
                 ]
             },
 
-            fallbacks=[CommandHandler('cancel', self.cancel, pass_user_data=True)]
+            fallbacks=[CommandHandler('cancel', self.callback(self.cancel), pass_user_data=True),
+                       CommandHandler('search', self.callback(self.search), pass_args=True, pass_user_data=True)],
+
+            # idle conversations end, the timeout jobs run on the job queue of the updater
+            conversation_timeout=settings.sessions.timeout
         )
 
+    def setup(self):
+        """
+        Registers the handlers of user actions and starts the background workers
+        """
+        conv_handler = self.conversation_handler()
+        self.conversations = PersistentConversations(self.state_store, on_end=self.end_session,
+                                                     max_sessions=settings.sessions.max_sessions)
+        conv_handler.conversations = self.conversations
+        if settings.metrics.enabled:
+            self.instrument(conv_handler)
         self.dispatcher.add_handler(conv_handler)
+        self.dispatcher.add_handler(TypeHandler(Update, self.save_session), group=1)
 
         self.dispatcher.add_error_handler(self.error)
+        self.dispatcher.process_update = self.in_conversation(self.dispatcher.process_update)
+
+        self.term_collection.listen_for_invalidations()
+        self.media.start()
+        self.outbox.start()
+        self.start_metrics()
+
+    def warmup(self, timer=None):
+        """
+        Prepares what the first updates need before the bot accepts them: loads the locales, checks that
+        the schema is up to date, opens the pooled connections of the database and loads the term graph
+        :param timer: metrics.StartupTimer measuring the phases
+        :raise RuntimeError: the database has no tables or there are migrations to apply
+        """
+        timer = timer or metrics.StartupTimer()
+        if settings.bot.preload_locales:
+            with timer.phase('locales'):
+                self.locales.warmup()
+        with timer.phase('schema'):
+            migrations.check(get_engine())
+        with timer.phase('pool'):
+            for connection_string in (database_url(),) + settings.replicas.urls:
+                database.prime_pool(connection_string)
+        if self.graph.in_memory:
+            with timer.phase('graph'):
+                self.graph.load()
+
+    @staticmethod
+    def in_conversation(process_update):
+        """
+        Wraps Dispatcher.process_update to handle every update in the conversation of its chat,
+        so the reads after the chat's own writes go to the primary database, see database.ReplicaRouter
+        """
+        @functools.wraps(process_update)
+        def wrapper(update):
+            chat = update.effective_chat if isinstance(update, Update) else None
+            with database.conversation(chat.id if chat is not None else None):
+                return process_update(update)
+
+        return wrapper
+
+    def instrument(self, conv_handler):
+        """
+        Times the handlers by conversation state, the methods of the term collection and of the graph,
+        and counts the SQL statements of every update, see metrics.py
+        """
+        metrics.instrument_conversation(conv_handler, self.STATE_NAMES)
+        metrics.instrument_methods(self.term_collection, 'term_collection')
+        metrics.instrument_methods(self.graph, 'term_graph')
+        for connection_string in (database_url(),) + settings.replicas.urls:
+            metrics.count_statements(get_engine(connection_string))
+        self.dispatcher.process_update = metrics.track_updates(self.dispatcher.process_update)
+        metrics.SESSIONS.set_function(lambda: len(self.dispatcher.user_data))
+        metrics.SESSION_BYTES.set_function(lambda: self.dispatcher.user_data.memory_report()['bytes_per_session'])
+
+    def start_metrics(self):
+        """
+        Starts the /metrics endpoint, the periodic metrics log and the sampling profiler, as set in the
+        [metrics] section of config.ini. SIGUSR2 switches the profiler on and off in a running bot.
+        """
+        options = settings.metrics
+        port = options.port
+        if port:
+            try:
+                self.metrics_server = metrics.MetricsServer(listen=options.listen, port=port, profiler=self.profiler)
+                threading.Thread(target=self.metrics_server.serve_forever, name='metrics', daemon=True).start()
+            except OSError as e:
+                # e.g. the port is taken by another worker of the shard router
+                logger.warning('Metrics endpoint on port %s not started: %s', port, e)
+
+        if options.log_interval:
+            self.metrics_logger = metrics.SnapshotLogger(options.log_interval)
+            self.metrics_logger.start()
+
+        if options.profiler:
+            self.profiler.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_profiler())
+
+    def toggle_profiler(self):
+        """
+        Starts the sampling profiler, or stops it and saves the profile to profiler_output
+        """
+        if self.profiler.running:
+            self.profiler.stop()
+            self.profiler.dump(settings.metrics.profiler_output)
+        else:
+            self.profiler.start()
+
+    def stop_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        if self.metrics_logger:
+            self.metrics_logger.stop()
+        if self.profiler.running:
+            self.toggle_profiler()
+
+    def run(self, timer=None):
+        """
+        Starts the bot receiving updates by polling or by the webhook after the warm-up
+        :param timer: metrics.StartupTimer measuring the phases of the startup, see cli.py
+        """
+        timer = timer or metrics.StartupTimer()
+        with timer.phase('setup'):
+            self.setup()
+        self.warmup(timer)
 
-        self.updater.start_polling()
+        with timer.phase('receive'):
+            if settings.bot.mode == 'webhook':
+                self.start_webhook()
+            else:
+                self.updater.start_polling()
+        timer.report()
 
         self.updater.idle()
 
+        self.media.stop()
+        self.outbox.stop()
+        self.stop_metrics()
+
+    def serve_shard(self, updates):
+        """
+        Runs the bot as a worker process of the shard router, see router.py.
+        The updates are taken from the queue until the None sentinel is received.
+        :param updates: multiprocessing queue of update dictionaries
+        """
+        # the router stops the workers, Ctrl+C in the terminal must not interrupt them in the middle of an update
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.setup()
+        self.warmup()
+
+        self.updater.running = True
+        self.updater.job_queue.start()
+        threading.Thread(target=self.dispatcher.start, name='dispatcher').start()
+
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            self.dispatcher.update_queue.put(Update.de_json(data, self.updater.bot))
+
+        # the dispatcher drops the queued updates when it is stopped
+        while not self.dispatcher.update_queue.empty():
+            time.sleep(0.1)
+        self.updater.stop()
+        self.media.stop()
+        self.outbox.stop()
+        self.stop_metrics()
+
+    def start_webhook(self):
+        """
+        Starts the dispatcher and the embedded webhook server instead of polling,
+        and registers the webhook with Telegram if webhook_url is set
+        """
+        webhook = settings.webhook
+        sink = DispatcherSink(self.updater.bot, self.dispatcher.update_queue,
+                              max_queue=webhook.queue_size)
+        server = WebhookServer(sink, listen=webhook.listen, port=webhook.port, path=webhook.path, secret=webhook.secret)
+
+        # the updater stops the server, the dispatcher and the job queue on SIGINT/SIGTERM in idle()
+        self.updater.running = True
+        self.updater.httpd = server
+        self.updater.job_queue.start()
+        threading.Thread(target=self.dispatcher.start, name='dispatcher').start()
+        threading.Thread(target=server.serve_forever, name='webhook').start()
+
+        if webhook.url:
+            self.updater.bot.set_webhook(url=webhook.url, max_connections=webhook.max_connections,
+                                         secret_token=webhook.secret)
+
+        logger.info('Listening to webhook updates on port %s.', server.server_address[1])
+
 
 if __name__ == '__main__':
     bot = Bot()
@@ -0,0 +1,153 @@
+import json
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time-to-live of the entries.
+    Counts hits, misses and evictions. The generation counts the invalidations (pop and clear): a value read
+    before an invalidation and stored after it may be stale, so set() drops it when given the earlier generation.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        :param maxsize: maximum number of entries, the least recently used ones are evicted first
+        :param ttl: seconds after which an entry expires, None to keep entries until eviction
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        """
+        :param generation: the generation of the cache before the value was read, None to store the value anyway
+        """
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value or calls loader() and caches its result. None is returned but not cached,
+        so a missing row is read again next time. The loader is called without holding the lock, so concurrent
+        misses may load the value twice; a value loaded while the cache was invalidated isn't cached.
+        """
+        generation = self.generation
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            if value is not None:
+                self.set(key, value, generation)
+        return value
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        :return: dictionary with the size and hit/miss/eviction counters of the cache
+        """
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Listens to a PostgreSQL NOTIFY channel and passes the decoded JSON payloads to the callback.
+    Lets several bot processes invalidate each other's caches after writes.
+    """
+
+    def __init__(self, engine, channel, callback, on_connect=None, poll_timeout=5, reconnect_delay=5):
+        """
+        :param on_connect: called without arguments every time the listener (re)connects; the notifications sent
+                           while it was disconnected are lost, so it must drop everything the caches hold
+        """
+        super().__init__(name=f'cache-listener-{channel}', daemon=True)
+        self.engine = engine
+        self.channel = channel
+        self.callback = callback
+        self.on_connect = on_connect
+        self.poll_timeout = poll_timeout
+        self.reconnect_delay = reconnect_delay
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.warning('Cache invalidation listener of "%s" failed: %s', self.channel, e)
+                self._stopped.wait(self.reconnect_delay)
+
+    def _listen(self):
+        # the connection is detached from the pool, it is used only by this thread
+        connection = self.engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'LISTEN "{self.channel}"')
+            logger.info('Listening to cache invalidations on "%s".', self.channel)
+            if self.on_connect is not None:
+                self.on_connect()
+
+            while not self._stopped.is_set():
+                if select.select([dbapi_connection], [], [], self.poll_timeout) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    try:
+                        self.callback(json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning('Malformed cache invalidation "%s".', notify.payload)
+        finally:
+            dbapi_connection.close()
@@ -0,0 +1,68 @@
+import time
+
+# taken before the other imports, so the startup time includes importing the bot
+STARTED = time.perf_counter()
+
+import argparse
+import logging
+
+
+def serve(args):
+    """
+    Runs the bot: imports it, warms it up and starts receiving updates, timing every phase
+    """
+    import metrics
+
+    timer = metrics.StartupTimer(STARTED)
+    with timer.phase('imports'):
+        # python-telegram-bot and the handlers are imported only to serve
+        from bot import Bot
+    with timer.phase('init'):
+        bot = Bot()
+    bot.run(timer)
+
+
+def init_db(args):
+    """
+    Creates the tables of a new database or applies the pending migrations to an existing one
+    """
+    import database
+    import migrations
+
+    engine = database.get_engine()
+    database.create_tables()
+    if engine.dialect.name == 'postgresql':
+        applied = migrations.upgrade(engine)
+        if applied:
+            print(f'Applied {len(applied)} migrations.')
+    print(f'Schema version {migrations.current_version(engine)}, the latest is {migrations.LATEST_VERSION}.')
+
+
+def seed(args):
+    """
+    Inserts the sample terms, a glossary is imported with glossary_io.py
+    """
+    import database
+
+    print(f'Inserted {database.seed_tables()} sample terms.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Terminology bot')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='run the bot with the settings of config.ini')
+    subparsers.add_parser('init-db', help='create the tables or upgrade the schema of the database')
+    subparsers.add_parser('seed', help='insert the sample terms')
+    args = parser.parse_args()
+
+    commands = {'serve': serve, 'init-db': init_db, 'seed': seed}
+    if args.command not in commands:
+        parser.print_help()
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    commands[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
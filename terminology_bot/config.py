@@ -1,26 +1,271 @@
+from collections import namedtuple
 from configparser import ConfigParser
 import os.path
+import threading
+
+
+# directory of config.ini, the relative paths of the options are relative to it
+CONFIG_DIR = os.path.dirname(os.path.realpath(__file__))
+ENV_PREFIX = 'TERMINOLOGY_'
+
+# pool settings of the PostgreSQL engine, see database.engine_options
+PoolSettings = namedtuple('PoolSettings', ['size', 'max_overflow', 'timeout', 'recycle', 'pre_ping'])
+# read replicas of the database, see database.ReplicaRouter; max_lag is None to skip the replication lag check
+ReplicaSettings = namedtuple('ReplicaSettings', ['urls', 'check_interval', 'max_lag', 'pin_seconds'])
+# sizes of the LRU caches of the term collections, ttl is None for entries that never expire
+CacheSettings = namedtuple('CacheSettings', ['term_cache_size', 'page_cache_size', 'neighbour_cache_size', 'ttl',
+                                             'notify_channel'])
+# media ingestion: absolute path of the media store, bounds and timeouts of the downloads
+MediaSettings = namedtuple('MediaSettings', ['directory', 'queue_size', 'retries', 'retry_delay', 'chunk_size',
+                                             'timeout'])
+# numbers of the worker threads, processes and concurrent coroutines
+WorkerSettings = namedtuple('WorkerSettings', ['dispatcher', 'media', 'outbox', 'shards', 'concurrency'])
+# sessions of the users: seconds of inactivity after which a conversation ends (None to keep it),
+# and the number of sessions kept in memory, the least recently used ones are written to the state store
+SessionSettings = namedtuple('SessionSettings', ['timeout', 'max_sessions'])
+# where the conversation states and sessions are stored, see state_store.create_state_store;
+# sqlite_path is absolute
+StateSettings = namedtuple('StateSettings', ['backend', 'sqlite_path'])
+# options of [bot]: mode is polling or webhook, terms_order is name or id; base_url and base_file_url point
+# to another Bot API server, None for the one of Telegram
+BotSettings = namedtuple('BotSettings', ['token', 'mode', 'preload_locales', 'terms_page_size', 'terms_order',
+                                         'search_limit', 'base_url', 'base_file_url'])
+# embedded webhook server of [bot], also used by the front of the shard router; url and secret are None if not set
+WebhookSettings = namedtuple('WebhookSettings', ['listen', 'port', 'path', 'url', 'secret', 'queue_size',
+                                                 'max_connections'])
+# limits of the outgoing messages, see outbox.Outbox
+OutboxSettings = namedtuple('OutboxSettings', ['rate', 'burst', 'chat_rate', 'chat_burst', 'queue_size', 'retries'])
+# term graph, see term_graph.TermGraph; hops is the depth of the neighbourhood in the term profile
+GraphSettings = namedtuple('GraphSettings', ['in_memory', 'refresh_interval', 'hops'])
+# handler metrics, the /metrics endpoint (port 0 to disable it), the metrics log (interval 0 to disable it)
+# and the sampling profiler
+MetricsSettings = namedtuple('MetricsSettings', ['enabled', 'listen', 'port', 'log_interval', 'profiler',
+                                                 'profiler_interval', 'profiler_output'])
+# shard router: front is polling or webhook, queue_size bounds the updates waiting for a worker
+RouterSettings = namedtuple('RouterSettings', ['front', 'queue_size'])
+# asyncio mode: bounds of the update queue, of the HTTP connections to Telegram and of the asyncpg pool
+AsyncSettings = namedtuple('AsyncSettings', ['queue_size', 'connections', 'db_pool_min', 'db_pool_max'])
+Settings = namedtuple('Settings', ['database_url', 'pool', 'replicas', 'cache', 'media', 'workers', 'sessions',
+                                   'state', 'bot', 'webhook', 'outbox', 'graph', 'metrics', 'router', 'async_mode'])
+
+_sections = {}
+_settings = None
+_lock = threading.Lock()
+
+
+def resolve_path(path):
+    """
+    :return: absolute path, a relative path is taken relative to the directory of config.ini
+    """
+    return os.path.join(CONFIG_DIR, os.path.expanduser(path))
+
+
+def load_sections(filename='config.ini'):
+    """
+    Parses config.mine.ini, if it exists, or the config file once per process.
+    Environment variables TERMINOLOGY_<SECTION>_<OPTION> override the options of the file.
+    :return: dictionary {section: {option: value}}
+    """
+    sections = _sections.get(filename)
+    if sections is not None:
+        return sections
+
+    with _lock:
+        if filename not in _sections:
+            path = os.path.join(CONFIG_DIR, 'config.mine.ini')
+            if not os.path.exists(path):
+                path = os.path.join(CONFIG_DIR, filename)
+            parser = ConfigParser()
+            parser.read(path)
+
+            sections = {}
+            for section in parser.sections():
+                options = dict(parser.items(section))
+                prefix = f'{ENV_PREFIX}{section.upper()}_'
+                for name, value in os.environ.items():
+                    if name.startswith(prefix):
+                        options[name[len(prefix):].lower()] = value
+                sections[section] = options
+            _sections[filename] = sections
+    return _sections[filename]
 
 
 def get_config(section='postgresql', filename='config.ini'):
     """
-    Parses config.ini file
+    Reads config.ini file
     :return: parameters from the required section of config.ini file
     """
-    config_path = os.path.dirname(os.path.realpath(__file__))
-    os.chdir(config_path)
+    sections = load_sections(filename)
+    if section not in sections:
+        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+    return dict(sections[section])
 
-    if os.path.exists('config.mine.ini'):
-        filename = 'config.mine.ini'
-    parser = ConfigParser()
-    parser.read(filename)
 
-    config = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            config[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+def as_bool(value):
+    """
+    :return: True or False for the usual spellings of yes and no in config.ini
+    :raise ValueError: the value is neither
+    """
+    value = str(value).strip().lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError(f'"{value}" is not yes or no')
+
+
+def choice(*values):
+    """
+    :return: converter accepting only the given values
+    """
+    def convert(value):
+        if value not in values:
+            raise ValueError(f'must be one of {", ".join(values)}')
+        return value
+    return convert
+
+
+class _OptionReader:
+    """
+    Converts the options of the sections and collects the errors, so all invalid options are reported at once
+    """
 
-    return config
+    def __init__(self, sections):
+        self.sections = sections
+        self.errors = []
+
+    def __call__(self, section, option, convert, default, minimum=None):
+        raw = self.sections.get(section, {}).get(option, '').strip()
+        if not raw:
+            return default
+        try:
+            value = convert(raw)
+        except ValueError as e:
+            self.errors.append(f'[{section}] {option} = {raw}: {e}')
+            return default
+        if minimum is not None and value < minimum:
+            self.errors.append(f'[{section}] {option} = {raw}: must be at least {minimum}')
+        return value
+
+
+def load_settings(sections):
+    """
+    :param sections: dictionary {section: {option: value}}, see load_sections
+    :return: Settings
+    :raise ValueError: the message lists all invalid options
+    """
+    option = _OptionReader(sections)
+    postgresql = sections.get('postgresql', {})
+
+    database_url = option('postgresql', 'url', str, None)
+    if database_url is None:
+        missing = [name for name in ('user', 'password', 'host', 'database') if name not in postgresql]
+        if missing:
+            option.errors.append(f'[postgresql] {", ".join(missing)}: required unless url is set')
+        else:
+            database_url = (f"postgresql://{postgresql['user']}:{postgresql['password']}@{postgresql['host']}/"
+                            f"{postgresql['database']}")
+
+    pool = PoolSettings(size=option('postgresql', 'pool_size', int, 5, minimum=1),
+                        max_overflow=option('postgresql', 'max_overflow', int, 10, minimum=0),
+                        timeout=option('postgresql', 'pool_timeout', float, 30.0, minimum=0),
+                        recycle=option('postgresql', 'pool_recycle', int, 1800, minimum=-1),
+                        pre_ping=option('postgresql', 'pool_pre_ping', as_bool, True))
+
+    replicas = ReplicaSettings(urls=tuple(url.strip() for url in option('postgresql', 'replicas', str, '').split(',')
+                                          if url.strip()),
+                               check_interval=option('postgresql', 'replica_check_interval', float, 5.0, minimum=0.1),
+                               max_lag=option('postgresql', 'replica_max_lag', float, 0.0, minimum=0) or None,
+                               pin_seconds=option('postgresql', 'read_your_writes', float, 30.0, minimum=0))
+
+    cache = CacheSettings(term_cache_size=option('cache', 'term_cache_size', int, 4096, minimum=1),
+                          page_cache_size=option('cache', 'page_cache_size', int, 256, minimum=1),
+                          neighbour_cache_size=option('cache', 'neighbour_cache_size', int, 4096, minimum=1),
+                          ttl=option('cache', 'ttl', float, 0.0, minimum=0) or None,
+                          notify_channel=option('cache', 'notify_channel', str, None))
+
+    media = MediaSettings(directory=resolve_path(option('bot', 'multimedia_dir', str, 'data/media')),
+                          queue_size=option('media', 'queue_size', int, 100, minimum=1),
+                          retries=option('media', 'retries', int, 3, minimum=0),
+                          retry_delay=option('media', 'retry_delay', float, 2.0, minimum=0),
+                          chunk_size=option('media', 'chunk_size', int, 64 * 1024, minimum=1024),
+                          timeout=option('media', 'timeout', float, 60.0, minimum=1))
+
+    workers = WorkerSettings(dispatcher=option('bot', 'workers', int, 4, minimum=1),
+                             media=option('media', 'workers', int, 2, minimum=1),
+                             outbox=option('outbox', 'workers', int, 4, minimum=1),
+                             shards=option('router', 'shards', int, 2, minimum=1),
+                             concurrency=option('async', 'concurrency', int, 1000, minimum=1))
+
+    sessions = SessionSettings(timeout=option('state', 'conversation_timeout', float, 3600.0, minimum=0) or None,
+                               max_sessions=option('state', 'max_sessions', int, 10000, minimum=1))
+
+    state = StateSettings(backend=option('state', 'backend', choice('memory', 'sqlite', 'postgresql'), 'memory'),
+                          sqlite_path=resolve_path(option('state', 'sqlite_path', str, 'data/state.db')))
+
+    # the token is checked by Telegram, the tools working with the database don't need it
+    bot = BotSettings(token=option('bot', 'token', str, None),
+                      mode=option('bot', 'mode', choice('polling', 'webhook'), 'polling'),
+                      preload_locales=option('bot', 'preload_locales', as_bool, True),
+                      terms_page_size=option('bot', 'terms_page_size', int, 20, minimum=1),
+                      terms_order=option('bot', 'terms_order', choice('name', 'id'), 'name'),
+                      search_limit=option('bot', 'search_limit', int, 10, minimum=1),
+                      base_url=option('bot', 'base_url', str, None),
+                      base_file_url=option('bot', 'base_file_url', str, None))
+
+    webhook = WebhookSettings(listen=option('bot', 'webhook_listen', str, '0.0.0.0'),
+                              port=option('bot', 'webhook_port', int, 8443, minimum=0),
+                              path=option('bot', 'webhook_path', str, '/'),
+                              url=option('bot', 'webhook_url', str, None),
+                              secret=option('bot', 'webhook_secret', str, None),
+                              queue_size=option('bot', 'webhook_queue_size', int, 1000, minimum=1),
+                              max_connections=option('bot', 'webhook_max_connections', int, 40, minimum=1))
+
+    outbox = OutboxSettings(rate=option('outbox', 'rate', float, 30.0, minimum=0.001),
+                            burst=option('outbox', 'burst', int, 30, minimum=1),
+                            chat_rate=option('outbox', 'chat_rate', float, 1.0, minimum=0.001),
+                            chat_burst=option('outbox', 'chat_burst', int, 3, minimum=1),
+                            queue_size=option('outbox', 'queue_size', int, 10000, minimum=1),
+                            retries=option('outbox', 'retries', int, 3, minimum=0))
+
+    graph = GraphSettings(in_memory=option('graph', 'in_memory', as_bool, True),
+                          refresh_interval=option('graph', 'refresh_interval', float, 300.0, minimum=0),
+                          hops=option('graph', 'hops', int, 2, minimum=1))
+
+    metrics = MetricsSettings(enabled=option('metrics', 'enabled', as_bool, True),
+                              listen=option('metrics', 'listen', str, '127.0.0.1'),
+                              port=option('metrics', 'port', int, 0, minimum=0),
+                              log_interval=option('metrics', 'log_interval', float, 0.0, minimum=0),
+                              profiler=option('metrics', 'profiler', as_bool, False),
+                              profiler_interval=option('metrics', 'profiler_interval', float, 0.01, minimum=0.001),
+                              profiler_output=resolve_path(option('metrics', 'profiler_output', str,
+                                                                  'data/profile.txt')))
+
+    router = RouterSettings(front=option('router', 'front', choice('polling', 'webhook'), 'polling'),
+                            queue_size=option('router', 'queue_size', int, 1000, minimum=1))
+
+    async_mode = AsyncSettings(queue_size=option('async', 'queue_size', int, 10000, minimum=1),
+                               connections=option('async', 'connections', int, 100, minimum=1),
+                               db_pool_min=option('async', 'db_pool_min', int, 2, minimum=0),
+                               db_pool_max=option('async', 'db_pool_max', int, 20, minimum=1))
+    if async_mode.db_pool_min > async_mode.db_pool_max:
+        option.errors.append(f'[async] db_pool_min = {async_mode.db_pool_min}: must not exceed db_pool_max')
+
+    if option.errors:
+        raise ValueError('Invalid options in the config file:\n' + '\n'.join(option.errors))
+    return Settings(database_url=database_url, pool=pool, replicas=replicas, cache=cache, media=media,
+                    workers=workers, sessions=sessions, state=state, bot=bot, webhook=webhook, outbox=outbox,
+                    graph=graph, metrics=metrics, router=router, async_mode=async_mode)
+
+
+def get_settings():
+    """
+    :return: Settings of the process, loaded and validated on the first call
+    """
+    global _settings
+    if _settings is None:
+        settings = load_settings(load_sections())
+        with _lock:
+            if _settings is None:
+                _settings = settings
+    return _settings
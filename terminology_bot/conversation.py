@@ -0,0 +1,614 @@
+import functools
+import logging
+
+from config import get_settings
+from media_store import MediaJob
+from state_store import TermList
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_sync(coroutine):
+    """
+    Runs the coroutine of a handler to the end in the calling thread. The threaded mode stores the terms with
+    blocking calls, see TermStore, so its handlers finish without ever suspending.
+    :return: the result of the coroutine
+    :raise RuntimeError: the coroutine awaited something which isn't done yet
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coroutine.close()
+    raise RuntimeError(f'{coroutine.__qualname__} was suspended, it can run only on an event loop')
+
+
+def with_current_term(handler):
+    """
+    Passes the current term to the handler as `term`. If the term was deleted while the user was working with it,
+    the handler isn't called: the user gets the list of terms instead, see Conversation.term_gone.
+    """
+    @functools.wraps(handler)
+    async def wrapper(self, bot, update, user_data):
+        term = await self.current_term(user_data)
+        if term is None:
+            return await self.term_gone(update, user_data)
+        return await handler(self, bot, update, user_data, term)
+
+    return wrapper
+
+
+class TermStore:
+    """
+    The terms and the term graph as the handlers of the conversation use them. The methods are coroutines,
+    the threaded mode implements them with the blocking calls of TermCollection and TermGraph;
+    the asyncio mode overrides them, see async_bot.AsyncTermStore.
+    """
+
+    def __init__(self, term_collection, graph):
+        self.term_collection = term_collection
+        self.graph = graph
+
+    async def get(self, term_id):
+        return self.term_collection.get(term_id)
+
+    async def get_page(self, after=None, before=None, limit=20, order_by='name'):
+        return self.term_collection.get_page(after=after, before=before, limit=limit, order_by=order_by)
+
+    async def search(self, query, limit=10):
+        return self.term_collection.search(query, limit=limit)
+
+    async def profile(self, term_id):
+        return self.term_collection.profile(term_id)
+
+    async def create(self, term_name):
+        return self.term_collection.create(term_name)
+
+    async def update(self, term_id, dictionary):
+        return self.term_collection.update(term_id, dictionary)
+
+    async def link(self, term_id, words, kind):
+        """
+        Links the words to the term in the database and in the graph
+        :param kind: 'syn' or 'sim'
+        :return: ids of the linked terms
+        """
+        linked = self.term_collection.add_synonyms_similars(term_id, words=words, table=kind)
+        self.graph.add_links(term_id, linked, kind)
+        return linked
+
+    async def related(self, term_id, hops):
+        """
+        :return: neighbourhood of the term, see TermGraph.profile
+        """
+        return self.graph.profile(term_id, hops=hops)
+
+
+class Conversation:
+    """
+    The conversation of the bot with a user: the handlers of user actions in every state, shared by
+    the threaded mode (bot.py) and the asyncio mode (async_bot.py). The handlers are coroutines; they read and
+    write the terms through self.terms, a TermStore, and queue the replies in self.outbox, an Outbox.
+    The front ends set these attributes, implement send_media and submit_media and run the handlers.
+    """
+
+    START_MENU, CHOOSE_TERM, NEW_TERM, CHOOSE_OPTION, \
+    POS, DESCRIPTION, SYNONYMS, SIMILARS, IMAGE, AUDIO, VIDEO = range(11)
+    STATE_NAMES = ('START_MENU', 'CHOOSE_TERM', 'NEW_TERM', 'CHOOSE_OPTION',
+                   'POS', 'DESCRIPTION', 'SYNONYMS', 'SIMILARS', 'IMAGE', 'AUDIO', 'VIDEO')
+    # ConversationHandler.END of python-telegram-bot
+    END = -1
+
+    # reply markup hiding the keyboard, the front ends set a telegram.ReplyKeyboardRemove
+    REMOVE_KEYBOARD = None
+
+    terms = None
+    outbox = None
+    locales = None
+
+    def locale(self, user_data):
+        """
+        :param user_data: Session of the user, see state_store.py
+        :return: the shared Locale of the user, the default one if the user hasn't sent /start yet
+        """
+        return self.locales.get(user_data.locale)
+
+    async def current_term(self, user_data):
+        """
+        :return: the term the user works with. Only its id is kept in user_data, the term is read through the cache
+        """
+        return await self.terms.get(user_data.term_id)
+
+    async def term_gone(self, update, user_data):
+        """
+        Tells the user that the current term was deleted and sends the list of terms again
+        :return: the state CHOOSE_TERM
+        """
+        user_data.term_id = None
+        self.reply(update, self.locale(user_data).gettext('This term no longer exists.'))
+        await self.send_terms_page(update, user_data)
+        return self.CHOOSE_TERM
+
+    def reply(self, update, text, reply_markup=None):
+        """
+        Queues the reply to the chat of the update, see Outbox
+        """
+        self.outbox.send(update.effective_chat.id, text, reply_markup=reply_markup)
+
+    def send_media(self, update, kind, key, file_id=None):
+        """
+        Queues the media file of the term to the chat of the update, by its Telegram file id if it is known
+        :param kind: 'image', 'audio' or 'video'
+        :param key: key of the blob in the media store
+        :param file_id: file id of the blob if it has been read already, otherwise the sender looks it up
+        """
+        raise NotImplementedError
+
+    def submit_media(self, job):
+        """
+        Queues the download of the file sent by the user, see MediaJob
+        :return: False if the file can't be queued because too many files are being downloaded
+        """
+        raise NotImplementedError
+
+    async def start(self, bot, update, user_data):
+        """
+        Sends the greeting message with the start menu: 'Add new term' and 'Get list of terms' options
+        :return: the state START_MENU
+        """
+        locale = self.locales.get(update.message.from_user.language_code)
+        user_data.locale = locale.key
+
+        _ = locale.gettext
+        self.reply(update, _('Hello! I am Terminology Bot. Send /cancel to stop talking to me.'),
+                   reply_markup=locale.start_markup)
+        return self.START_MENU
+
+    async def new_term_option(self, bot, update, user_data):
+        """
+        Callback function for the user choosing 'Add new term' option
+        :return: the state NEW_TERM
+        """
+        _ = self.locale(user_data).gettext
+        self.reply(update, _('Type in the term.'))
+        return self.NEW_TERM
+
+    async def add_new_term(self, bot, update, user_data):
+        """
+        Adds new term to DB from the user input
+        :return: the state START_MENU
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        user = update.message.from_user
+        term_name = update.message.text
+
+        logger.info('User %s added the term "%s"', user.first_name, term_name)
+
+        await self.terms.create(term_name)
+
+        self.reply(update, _('I\'ll remember this term.'), reply_markup=locale.start_markup)
+
+        return self.START_MENU
+
+    async def list_of_terms_option(self, bot, update, user_data):
+        """
+        Callback function for the user choosing 'Get list of terms' option.
+        Sends the message with the first page of terms from DB.
+        :return: the state CHOOSE_TERM
+        """
+        await self.send_terms_page(update, user_data)
+        return self.CHOOSE_TERM
+
+    async def next_terms_page(self, bot, update, user_data):
+        """
+        Sends the next page of the list of terms
+        :return: the state CHOOSE_TERM
+        """
+        page = user_data.term_list
+        if page and page.has_next:
+            await self.send_terms_page(update, user_data, after=page.last, offset=page.offset + len(page.ids))
+        else:
+            await self.send_terms_page(update, user_data)
+        return self.CHOOSE_TERM
+
+    async def prev_terms_page(self, bot, update, user_data):
+        """
+        Sends the previous page of the list of terms
+        :return: the state CHOOSE_TERM
+        """
+        page = user_data.term_list
+        if page and page.has_prev:
+            await self.send_terms_page(update, user_data, before=page.first, offset=page.offset)
+        else:
+            await self.send_terms_page(update, user_data)
+        return self.CHOOSE_TERM
+
+    async def send_terms_page(self, update, user_data, after=None, before=None, offset=0):
+        """
+        Sends one page of the list of terms and keeps only the ids of this page in user_data:
+        the term with index i is term_list.ids[i - offset - 1].
+        :param offset: number of terms on the pages before this one, for continuous numbering
+        """
+        _ = self.locale(user_data).gettext
+
+        order_by = get_settings().bot.terms_order
+        page_size = get_settings().bot.terms_page_size
+        page = await self.terms.get_page(after=after, before=before, limit=page_size, order_by=order_by)
+
+        if before is not None:
+            offset = max(offset - len(page.terms), 0)
+        # the sort key of a (id, name) row
+        key = 0 if order_by == 'id' else 1
+        user_data.term_list = TermList(ids=tuple(term[0] for term in page.terms),
+                                        first=page.terms[0][key] if page.terms else None,
+                                        last=page.terms[-1][key] if page.terms else None,
+                                        offset=offset, has_prev=page.has_prev, has_next=page.has_next)
+
+        text_list = [_('These are the terms I know:')]
+        text_list.extend(f'{offset + i + 1}. {name}' for i, (id, name) in enumerate(page.terms))
+        if page.has_prev:
+            text_list.append(_('Send /prev to see the previous terms.'))
+        if page.has_next:
+            text_list.append(_('Send /next to see more terms.'))
+        text_list.append(_('\nPlease, choose one of them.'))
+
+        text = '\n'.join(text_list)
+
+        self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+
+    async def search(self, bot, update, user_data, args):
+        """
+        Finds terms by the words after the /search command and sends them as a numbered list
+        :return: the state CHOOSE_TERM if something was found
+        """
+        if user_data.locale is None:
+            # /search starts a conversation without /start
+            user_data.locale = self.locales.get(update.message.from_user.language_code).key
+        _ = self.locale(user_data).gettext
+
+        query = ' '.join(args)
+        if not query:
+            self.reply(update, _('Send /search and a part of the term, e.g. /search hydro'))
+            return None
+
+        terms = await self.terms.search(query, limit=get_settings().bot.search_limit)
+
+        logger.info('User %s searched for "%s"', update.message.from_user.first_name, query)
+
+        if not terms:
+            self.reply(update, _('Nothing was found for "%s".') % query)
+            return None
+
+        user_data.term_list = TermList(ids=tuple(term[0] for term in terms), first=None, last=None, offset=0,
+                                        has_prev=False, has_next=False)
+
+        text_list = [_('These are the terms I found:')]
+        text_list.extend(f'{i + 1}. {name}' for i, (id, name) in enumerate(terms))
+        text_list.append(_('\nPlease, choose one of them.'))
+
+        self.reply(update, '\n'.join(text_list), reply_markup=self.REMOVE_KEYBOARD)
+
+        return self.CHOOSE_TERM
+
+    async def choose_term(self, bot, update, user_data):
+        """
+        Sets the current term for future editing based on the user input
+        :return: the state CHOOSE_OPTION
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+        user = update.message.from_user
+        try:
+            page = user_data.term_list
+            if page is None:
+                raise IndexError('no list of terms')
+            position = int(update.message.text) - page.offset - 1
+            if not 0 <= position < len(page.ids):
+                raise IndexError(position)
+
+            user_data.term_id = page.ids[position]
+            term = await self.current_term(user_data)
+            if term is None:
+                # the term was deleted after the list was sent
+                return await self.term_gone(update, user_data)
+
+            user_data.term_list = None
+
+            logger.info('User %s chose the term "%s"', user.first_name, term.name)
+
+            text = _('Let\'s make the profile of the term "%s".\n'
+                     'Feel free to go back to the /menu and to the list of /terms.') % term.name
+            self.reply(update, text, reply_markup=locale.term_markup)
+
+            return self.CHOOSE_OPTION
+
+        except (KeyError, IndexError, ValueError):
+            text = _('Please choose an index number of a term from the list above.')
+            self.reply(update, text)
+            return self.CHOOSE_TERM
+
+    @with_current_term
+    async def choose_menu_option(self, bot, update, user_data, term):
+        """
+        Directs the user for futher actions based on the option he chose from the menu
+        :return: the state depending on the user input
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        option = update.message.text
+        if option == _('POS-tag'):
+            text = _('Choose the part-of-speech tag for the term "%s".') % term.name
+            self.reply(update, text, reply_markup=locale.pos_markup)
+            return self.POS
+
+        elif option == _('Description'):
+            text = _('Give a description to the term "%s".') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.DESCRIPTION
+
+        elif option == _('Synonyms'):
+            text = _('List synonyms of the term "%s" separating them with comma.') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.SYNONYMS
+
+        elif option == _('Similar words'):
+            text = _('List words similar with the term "%s" separating them with comma.') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.SIMILARS
+
+        elif option == _('Image'):
+            if term.image:
+                self.send_media(update, 'image', term.image)
+            text = _('Let\'s upload an image for the term "%s".') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.IMAGE
+
+        elif option == _('Audio'):
+            if term.audiofile:
+                self.send_media(update, 'audio', term.audiofile)
+            text = _('Let\'s upload an audiofile for the term "%s".') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.AUDIO
+
+        elif option == _('Video'):
+            if term.videofile:
+                self.send_media(update, 'video', term.videofile)
+            text = _('Let\'s upload a video for the term "%s".') % term.name
+            self.reply(update, text, reply_markup=self.REMOVE_KEYBOARD)
+            return self.VIDEO
+
+        else:
+            text = _('Feel free to choose.')
+            self.reply(update, text, reply_markup=locale.term_markup)
+            return self.CHOOSE_OPTION
+
+    @with_current_term
+    async def pos_tag(self, bot, update, user_data, term):
+        """
+        Saves pos-tag of the current term to DB
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        user = update.message.from_user
+        pos_tag = update.message.text
+        original_pos_tag = locale.pos_tags[pos_tag]
+
+        logger.info('User %s chose pos-tag "%s"', user.first_name, original_pos_tag)
+
+        await self.terms.update(term.id, {'pos_tag': original_pos_tag})
+
+        self.reply(update, _('I see!'), reply_markup=locale.term_markup)
+        return self.CHOOSE_OPTION
+
+    @with_current_term
+    async def description(self, bot, update, user_data, term):
+        """
+        Saves description of the current term to DB
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        user = update.message.from_user
+        dscr = update.message.text
+
+        logger.info('User %s gave a description to the term "%s"', user.first_name, term.name)
+
+        await self.terms.update(term.id, {'description': dscr})
+
+        self.reply(update, _('Good work!'), reply_markup=locale.term_markup)
+        return self.CHOOSE_OPTION
+
+    @with_current_term
+    async def image(self, bot, update, user_data, term):
+        """
+        Saves image of the current term
+        """
+        return self.upload_media(update, user_data, term, 'image', update.message.photo[-1])
+
+    @with_current_term
+    async def audio(self, bot, update, user_data, term):
+        """
+        Saves audiofile of the current term
+        """
+        audio = update.message.audio or update.message.voice
+        return self.upload_media(update, user_data, term, 'audio', audio)
+
+    @with_current_term
+    async def video(self, bot, update, user_data, term):
+        """
+        Saves videofile of the current term
+        """
+        return self.upload_media(update, user_data, term, 'video', update.message.video)
+
+    def upload_media(self, update, user_data, term, kind, media):
+        """
+        Queues the file for downloading by the media workers. The user gets a reply when the file is saved.
+        :param media: PhotoSize, Audio, Voice or Video of the message
+        :return: the state CHOOSE_OPTION, or None to stay in the state if the queue is full
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        user = update.message.from_user
+
+        job = MediaJob(kind=kind, file_id=media.file_id, file_unique_id=getattr(media, 'file_unique_id', None),
+                       term_id=term.id, chat_id=update.message.chat_id, locale=locale.key)
+        if not self.submit_media(job):
+            self.reply(update, _('I\'m busy right now, please try again later.'))
+            return None
+
+        logger.info('User %s uploaded the %s for the term "%s"', user.first_name, kind, term.name)
+
+        self.reply(update, _('Got it! I\'ll let you know when the file is saved.'),
+                   reply_markup=locale.term_markup)
+        return self.CHOOSE_OPTION
+
+    def media_saved(self, job, error):
+        """
+        Tells the user that the media worker has saved the file or failed to
+        """
+        locale = self.locales.get(job.locale)
+        _ = locale.gettext
+
+        if error is None:
+            text = _('Awesome!')
+        else:
+            text = _('Sorry, I couldn\'t save the file. Please try again.')
+        self.outbox.send(job.chat_id, text, reply_markup=locale.term_markup)
+
+    @with_current_term
+    async def synonyms(self, bot, update, user_data, term):
+        """
+        Saves synonyms of the current term to DB
+        """
+        return await self.link_words(update, user_data, term, 'syn')
+
+    @with_current_term
+    async def similars(self, bot, update, user_data, term):
+        """
+        Saves similar words of the current term to DB
+        """
+        return await self.link_words(update, user_data, term, 'sim')
+
+    async def link_words(self, update, user_data, term, kind):
+        """
+        Links the comma-separated words of the message to the current term
+        :param kind: 'syn' or 'sim'
+        :return: the state CHOOSE_OPTION
+        """
+        locale = self.locale(user_data)
+        _ = locale.gettext
+
+        user = update.message.from_user
+        words = [word.strip(' ') for word in update.message.text.split(',')]
+
+        logger.info('User %s listed %s for the term "%s"', user.first_name,
+                    'synonyms' if kind == 'syn' else 'similar words', term.name)
+
+        await self.terms.link(term.id, words, kind)
+
+        self.reply(update, _('I\'ll remember this!'), reply_markup=locale.term_markup)
+        return self.CHOOSE_OPTION
+
+    @with_current_term
+    async def related_terms(self, bot, update, user_data, term):
+        """
+        Sends the neighbourhood of the current term: synonyms, similar words and terms linked through them
+        :return: the state CHOOSE_OPTION
+        """
+        locale = self.locale(user_data)
+
+        profile = await self.terms.related(term.id, hops=get_settings().graph.hops)
+
+        self.reply(update, self.related_text(locale, term, profile), reply_markup=locale.term_markup)
+        return self.CHOOSE_OPTION
+
+    async def show_term(self, bot, update, user_data):
+        """
+        Sends the profile card of the current term: its part of speech, description, synonyms and similar words,
+        followed by its media files. The card is read in one query, the media are sent by their file ids.
+        :return: the state CHOOSE_OPTION
+        """
+        locale = self.locale(user_data)
+        profile = await self.terms.profile(user_data.term_id)
+        if profile is None:
+            # the term was deleted while the user was working with it
+            return await self.term_gone(update, user_data)
+
+        self.reply(update, self.profile_text(locale, profile), reply_markup=locale.term_markup)
+        for kind, media in profile.media.items():
+            self.send_media(update, kind, media.key, file_id=media.file_id)
+        return self.CHOOSE_OPTION
+
+    @staticmethod
+    def profile_text(locale, profile):
+        """
+        :param profile: TermProfile of the term
+        """
+        _ = locale.gettext
+
+        def names(terms):
+            return ', '.join(found[1] for found in terms)
+
+        text_list = [_('Profile of the term "%s":') % profile.name]
+        if profile.pos_tag:
+            text_list.append(_('Part of speech: %s') % _(profile.pos_tag.value))
+        if profile.description:
+            text_list.append(_('Description: %s') % profile.description)
+        if profile.synonyms:
+            text_list.append(_('Synonyms: %s') % names(profile.synonyms))
+        if profile.similars:
+            text_list.append(_('Similar words: %s') % names(profile.similars))
+        if profile.media:
+            text_list.append(_('Media: %s') % ', '.join(locale.options[kind] for kind in profile.media))
+        if len(text_list) == 1:
+            text_list.append(_('Nothing is known about it yet.'))
+
+        return '\n'.join(text_list)
+
+    @staticmethod
+    def related_text(locale, term, profile):
+        """
+        :param profile: neighbourhood of the term, see TermGraph.profile
+        """
+        _ = locale.gettext
+
+        if profile['cluster_size'] <= 1:
+            return _('The term "%s" isn\'t linked with other terms yet.') % term.name
+
+        def names(terms):
+            return ', '.join(found[1] for found in terms)
+
+        text_list = [_('Neighbourhood of the term "%s":') % term.name]
+        if profile['syn']:
+            text_list.append(_('Synonyms: %s') % names(profile['syn']))
+        if profile['synonym_closure']:
+            text_list.append(_('Synonyms of synonyms: %s') % names(profile['synonym_closure']))
+        if profile['sim']:
+            text_list.append(_('Similar words: %s') % names(profile['sim']))
+        indirect = [found for found in profile['related'] if found[2] > 1]
+        if indirect:
+            text_list.append(_('Related terms: %s') % names(indirect))
+        text_list.append(_('Terms connected with it: %d') % (profile['cluster_size'] - 1))
+
+        return '\n'.join(text_list)
+
+    async def cancel(self, bot, update, user_data):
+        """
+        Finishes the conversation after the user entered /cancel command
+        """
+        _ = self.locale(user_data).gettext
+
+        user = update.message.from_user
+
+        logger.info('User %s canceled the conversation.', user.first_name)
+
+        self.reply(update, _('Bye! I hope we can talk again some day.'),
+                   reply_markup=self.REMOVE_KEYBOARD)
+
+        return self.END
@@ -1,14 +1,35 @@
-from sqlalchemy import (create_engine, Column, String, Integer, Text, Enum, ForeignKey, Sequence)
+from sqlalchemy import (create_engine, event, func, DDL, Column, String, Integer, SmallInteger, BigInteger, Text,
+                        DateTime, ForeignKey, Index, Sequence, TypeDecorator)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from config import get_config
+from sqlalchemy.orm import sessionmaker, relationship, foreign
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects import postgresql
+from cache import LRUCache
+from config import get_settings
 import enum
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
 
 
 Base = declarative_base()
 
-params = get_config(section='postgresql')
-db_string = f"postgresql://{params['user']}:{params['password']}@{params['host']}/{params['database']}"
+
+def database_url():
+    """
+    The config is read on the first call, not on import, so the tools importing the models don't need a complete
+    config file. url of the [postgresql] section, if set, is used instead of the other options, e.g. to run the bot
+    on SQLite.
+    :return: connection string of the primary database
+    """
+    return get_settings().database_url
 
 
 # dummy function for gettext to recognize POSenum values
@@ -22,16 +43,45 @@ class POSEnum(enum.Enum):
     adjective = _('adjective')
 
 
+# codes of the parts of speech stored in terms.pos_tag, they must never change
+POS_CODES = {POSEnum.noun: 1, POSEnum.verb: 2, POSEnum.adjective: 3}
+POS_BY_CODE = {code: member for member, code in POS_CODES.items()}
+
+
+def pos_code(value):
+    """
+    :param value: POSEnum member or its name
+    :return: code of the part of speech, None for None
+    """
+    if value is None:
+        return None
+    return POS_CODES[value if isinstance(value, POSEnum) else POSEnum[value]]
+
+
+class POSTag(TypeDecorator):
+    """POSEnum stored as a smallint code of POS_CODES"""
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        return pos_code(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else POS_BY_CODE[value]
+
+
 class Term(Base):
     __tablename__ = 'terms'
 
     id = Column(Integer, Sequence('terms_id_seq'), primary_key=True)
     name = Column(String(256), nullable=False, unique=True)
-    pos_tag = Column(Enum(POSEnum))
+    pos_tag = Column(POSTag)
     description = Column(Text)
     image = Column(String(256))
     audiofile = Column(String(256))
     videofile = Column(String(256))
+    created_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    # on PostgreSQL the trigger terms_updated_at also sets it for the updates written in plain SQL
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
 
     def __getitem__(self, key):
         return getattr(self, key)
@@ -44,58 +94,480 @@ class Synonyms(Base):
     __tablename__ = 'synonyms'
 
     term_id = Column(Integer, ForeignKey(Term.id), primary_key=True)
-    synonym_id = Column(Integer, ForeignKey(Term.id), primary_key=True)
+    synonym_id = Column(Integer, ForeignKey(Term.id), primary_key=True, index=True)
 
 
 class Similars(Base):
     __tablename__ = 'similar_words'
 
     term_id = Column(Integer, ForeignKey(Term.id), primary_key=True)
-    similar_word_id = Column(Integer, ForeignKey(Term.id), primary_key=True)
+    similar_word_id = Column(Integer, ForeignKey(Term.id), primary_key=True, index=True)
+
+
+class MediaBlob(Base):
+    """
+    Media file stored once by the hash of its content, with the number of terms referring to it.
+    file_id is the last known Telegram id of the file, so it can be sent again without uploading it.
+    extension is the one of the first upload of the content, e.g. '.jpg', used to name the file when it is sent.
+    """
+    __tablename__ = 'media_blobs'
+
+    key = Column(String(80), primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+    file_id = Column(String(256))
+    file_unique_id = Column(String(64))
+    extension = Column(String(16))
+
+
+# the linked terms and the media blobs of a term are read only with the eager loading options of
+# TermCollection.profile; lazy loading raises, so a view can't fall back to a query per attribute unnoticed
+Term.synonyms = relationship(Term, secondary=Synonyms.__table__, primaryjoin=Term.id == Synonyms.term_id,
+                             secondaryjoin=Term.id == Synonyms.synonym_id, order_by=Term.name,
+                             viewonly=True, lazy='raise')
+Term.similars = relationship(Term, secondary=Similars.__table__, primaryjoin=Term.id == Similars.term_id,
+                             secondaryjoin=Term.id == Similars.similar_word_id, order_by=Term.name,
+                             viewonly=True, lazy='raise')
+Term.image_blob = relationship(MediaBlob, primaryjoin=foreign(Term.image) == MediaBlob.key,
+                               viewonly=True, lazy='raise')
+Term.audiofile_blob = relationship(MediaBlob, primaryjoin=foreign(Term.audiofile) == MediaBlob.key,
+                                   viewonly=True, lazy='raise')
+Term.videofile_blob = relationship(MediaBlob, primaryjoin=foreign(Term.videofile) == MediaBlob.key,
+                                   viewonly=True, lazy='raise')
+
+
+# the primary keys of the link tables start with term_id, the indexes of the other column serve the reverse lookups;
+# the schema changes of existing databases, indexes included, are made by migrations.py
+Index('ix_terms_name_lower', func.lower(Term.name))
+
+# the document searched by the full-text search, the expression must be the same in the index and in the queries
+TERM_DOCUMENT = "to_tsvector('simple', name || ' ' || coalesce(description, ''))"
+
+# search indexes use PostgreSQL extensions, so they are created only there
+event.listen(Term.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+event.listen(Term.__table__, 'after_create',
+             DDL('CREATE INDEX ix_terms_name_trgm ON terms USING gin (name gin_trgm_ops)')
+             .execute_if(dialect='postgresql'))
+event.listen(Term.__table__, 'after_create',
+             DDL(f'CREATE INDEX ix_terms_document ON terms USING gin ({TERM_DOCUMENT})')
+             .execute_if(dialect='postgresql'))
+
+# updated_at of the rows updated in plain SQL, e.g. by the asyncio mode and the glossary import
+TOUCH_FUNCTION = """
+    CREATE OR REPLACE FUNCTION terms_touch_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at = now();
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+TOUCH_TRIGGER = """
+    CREATE TRIGGER terms_updated_at BEFORE UPDATE ON terms
+    FOR EACH ROW EXECUTE PROCEDURE terms_touch_updated_at()
+"""
+event.listen(Term.__table__, 'after_create', DDL(TOUCH_FUNCTION).execute_if(dialect='postgresql'))
+event.listen(Term.__table__, 'after_create', DDL(TOUCH_TRIGGER).execute_if(dialect='postgresql'))
+
+
+class PoolStats:
+    """Thread-safe counters of the connection pool activity of one engine"""
+
+    def __init__(self, limit=None):
+        """
+        :param limit: maximum number of connections of the pool, None if a checkout never waits
+        """
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def exhausted(self, pool):
+        """
+        :return: True if all connections the pool may open are checked out, so the next checkout waits
+        """
+        return self.limit is not None and pool.checkedout() >= self.limit
+
+    def add_wait(self, seconds):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {'connects': self.connects, 'checkouts': self.checkouts, 'checkins': self.checkins,
+                    'waits': self.waits, 'wait_time': self.wait_time, 'max_wait': self.max_wait,
+                    'avg_wait': self.wait_time / self.waits if self.waits else 0.0}
+
+
+def engine_options(pool):
+    """
+    :param pool: PoolSettings, the pool options of the [postgresql] section of config.ini
+    :return: keyword arguments for create_engine
+    """
+    return {
+        'pool_size': pool.size,
+        'max_overflow': pool.max_overflow,
+        'pool_timeout': pool.timeout,
+        'pool_recycle': pool.recycle,
+        'pool_pre_ping': pool.pre_ping,
+    }
+
+
+_engines = {}
+_sessions = {}
+_pool_stats = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(connection_string=None):
+    """
+    Returns the process-wide engine for the connection string, creating it on the first call.
+    The engine owns the connection pool shared by all threads of the process.
+    """
+    connection_string = connection_string or database_url()
+    engine = _engines.get(connection_string)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(connection_string)
+            if engine is None:
+                options = engine_options(get_settings().pool) if connection_string.startswith('postgresql') else {}
+                engine = create_engine(connection_string, **options)
+
+                # max_overflow -1 lets the pool open connections without limit
+                limited = options and options['max_overflow'] >= 0
+                stats = PoolStats(options['pool_size'] + options['max_overflow'] if limited else None)
+                event.listen(engine, 'connect', stats.on_connect)
+                event.listen(engine, 'checkout', stats.on_checkout)
+                event.listen(engine, 'checkin', stats.on_checkin)
+
+                _pool_stats[connection_string] = stats
+                _sessions[connection_string] = sessionmaker(bind=engine)
+                _engines[connection_string] = engine
+    return engine
+
+
+def get_session_factory(connection_string=None):
+    """
+    :return: the session factory bound to the process-wide engine
+    """
+    connection_string = connection_string or database_url()
+    get_engine(connection_string)
+    return _sessions[connection_string]
+
+
+def pool_stats(connection_string=None):
+    """
+    Reports pool counters to help sizing pool_size and max_overflow
+    :return: dictionary with checkout/checkin/wait counters and the current pool occupancy
+    """
+    connection_string = connection_string or database_url()
+    pool = get_engine(connection_string).pool
+    stats = _pool_stats[connection_string].as_dict()
+    stats['status'] = pool.status()
+    if isinstance(pool, QueuePool):
+        stats.update({'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow()})
+    return stats
+
+
+def prime_pool(connection_string=None):
+    """
+    Opens the connections of the pool in advance, so the first updates don't wait for connecting
+    :return: number of the opened connections
+    """
+    engine = get_engine(connection_string)
+    size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def dispose_engines():
+    """
+    Closes all pooled connections, e.g. after fork in a child process
+    """
+    with _engines_lock:
+        for connection_string, engine in _engines.items():
+            engine.dispose()
+
+
+# conversation of the update handled by the current thread, see conversation()
+_local = threading.local()
+
+
+@contextmanager
+def conversation(key):
+    """
+    Marks the reads and writes of the current thread as made for the conversation, e.g. for the chat of an update,
+    so the reads after its own writes go to the primary database, see ReplicaRouter
+    """
+    previous = getattr(_local, 'conversation', None)
+    _local.conversation = key
+    try:
+        yield
+    finally:
+        _local.conversation = previous
+
+
+def current_conversation():
+    return getattr(_local, 'conversation', None)
+
+
+class ReplicaRouter:
+    """
+    Chooses the database of a read: the healthy replicas in turn, the primary if there are none.
+    A replica is unhealthy while it doesn't answer the health check or lags behind by more than max_lag seconds,
+    or after a read on it failed, until the next successful check. The writes go to the primary, and for
+    pin_seconds after a write so do all reads of the same conversation: the user sees their own changes
+    even if the replicas haven't replayed them yet.
+    """
+
+    # replication lag of a PostgreSQL standby in seconds, NULL on a primary
+    LAG_SQL = 'SELECT extract(epoch FROM now() - pg_last_xact_replay_timestamp())'
+
+    def __init__(self, primary, replicas=(), check_interval=5, max_lag=None, pin_seconds=30):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.pin_seconds = pin_seconds
+        self.healthy = list(self.replicas)
+        self.turn = itertools.count()
+        # conversations which wrote in the last pin_seconds
+        self.pinned = LRUCache(maxsize=100000, ttl=pin_seconds or None)
+        self.reads = {'replica': 0, 'primary': 0, 'pinned': 0, 'failed_over': 0}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the health checks of the replicas in a background thread
+        """
+        if self.replicas and self._thread is None:
+            self._thread = threading.Thread(target=self._check_periodically, name='replica-checks', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _check_periodically(self):
+        while not self._stopped.wait(self.check_interval):
+            self.check()
+
+    def check(self):
+        """
+        Runs the health check of every replica and updates the list of the healthy ones
+        """
+        healthy = []
+        for url in self.replicas:
+            try:
+                with get_engine(url).connect() as connection:
+                    # reading a row finds out a replica without the schema, which a bare SELECT 1 doesn't
+                    connection.execute(Term.__table__.select().with_only_columns([Term.id]).limit(1)).fetchall()
+                    if connection.dialect.name == 'postgresql' and self.max_lag is not None:
+                        lag = connection.execute(self.LAG_SQL).scalar()
+                        if lag is not None and lag > self.max_lag:
+                            raise RuntimeError(f'replication lag of {lag:.1f} s')
+                healthy.append(url)
+            except Exception as e:
+                e = getattr(e, 'orig', e)
+                if url in self.healthy:
+                    logger.warning('Replica %s is unhealthy: %s', _safe_url(url), e)
+        with self._lock:
+            for url in set(healthy) - set(self.healthy):
+                logger.info('Replica %s is healthy again.', _safe_url(url))
+            self.healthy = healthy
+
+    def mark_unhealthy(self, url, error):
+        with self._lock:
+            if url in self.healthy:
+                logger.warning('Read on the replica %s failed, it is skipped until the next check: %s',
+                               _safe_url(url), error)
+                self.healthy = [healthy for healthy in self.healthy if healthy != url]
+
+    def written(self):
+        """
+        Pins the conversation of the current thread to the primary after its write
+        """
+        key = current_conversation()
+        if key is not None and self.replicas and self.pin_seconds:
+            self.pinned.set(key, True)
+
+    def read_url(self, primary=False):
+        """
+        :param primary: True to read from the primary, e.g. a row changed less than pin_seconds ago
+        :return: connection string of the database for the next read
+        """
+        key = current_conversation()
+        with self._lock:
+            if not self.healthy:
+                self.reads['primary'] += 1
+                return self.primary
+            if primary or (key is not None and self.pinned.get(key, False)):
+                self.reads['pinned'] += 1
+                return self.primary
+            self.reads['replica'] += 1
+            return self.healthy[next(self.turn) % len(self.healthy)]
+
+    def read(self, load, primary=False):
+        """
+        Runs load(session) on the database chosen by read_url. If the replica fails, it is marked unhealthy
+        and the read runs again on the primary.
+        :return: the result of load
+        """
+        url = self.read_url(primary)
+        try:
+            with SQLAlchemyDBConnection(url) as db:
+                return load(db.session)
+        except DBAPIError as e:
+            if url == self.primary:
+                raise
+            self.mark_unhealthy(url, e.orig)
+            with self._lock:
+                self.reads['failed_over'] += 1
+        with SQLAlchemyDBConnection(self.primary) as db:
+            return load(db.session)
+
+    def stats(self):
+        """
+        :return: dictionary with the numbers of reads by database, the healthy replicas and the pinned conversations
+        """
+        with self._lock:
+            return {**self.reads, 'replicas': len(self.replicas), 'healthy': len(self.healthy),
+                    'pinned_conversations': len(self.pinned)}
+
+
+def _safe_url(url):
+    """
+    :return: the connection string without the password, for the log
+    """
+    return repr(make_url(url))
+
+
+_router = None
+
+
+def get_router():
+    """
+    :return: the process-wide ReplicaRouter of the replicas in the [postgresql] section of config.ini
+    """
+    global _router
+    if _router is None:
+        with _engines_lock:
+            if _router is None:
+                replicas = get_settings().replicas
+                router = ReplicaRouter(database_url(), replicas.urls, check_interval=replicas.check_interval,
+                                       max_lag=replicas.max_lag, pin_seconds=replicas.pin_seconds)
+                router.start()
+                _router = router
+    return _router
+
+
+def read(load, primary=False):
+    """
+    Runs the read load(session) on a replica or on the primary, see ReplicaRouter.read
+    """
+    return get_router().read(load, primary)
 
 
 class SQLAlchemyDBConnection(object):
-    def __init__(self, connection_string):
-        self.connection_string = connection_string
+    """
+    Context manager giving a new session of the process-wide pooled engine, so nested contexts don't share
+    a session. The session is closed on exit and its connection goes back to the pool.
+    """
+
+    def __init__(self, connection_string=None):
+        """
+        :param connection_string: None for the database of config.ini
+        """
+        self.connection_string = connection_string or database_url()
         self.session = None
 
     def __enter__(self):
-        engine = create_engine(self.connection_string)
-        Session = sessionmaker()
-        self.session = Session(bind=engine)
+        self.session = get_session_factory(self.connection_string)()
+
+        # checking out the connection eagerly lets us measure the time spent waiting for the pool,
+        # only the checkouts from an exhausted pool are counted as waits
+        stats = _pool_stats[self.connection_string]
+        blocked = stats.exhausted(self.session.bind.pool)
+        started = time.perf_counter()
+        self.session.connection()
+        if blocked:
+            stats.add_wait(time.perf_counter() - started)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.session.close()
 
 
+def insert_ignore(session, table):
+    """
+    :return: INSERT statement of the table that skips the rows violating unique or primary key constraints
+    """
+    dialect = session.bind.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert().prefix_with('IGNORE')
+
+
 def create_tables():
     """
-    Creates the DB schema based on the classes Term, Synonyms, Similars
+    Creates the DB schema based on the classes Term, Synonyms, Similars, MediaBlob.
+    A new schema is marked with the latest migration, the existing tables are upgraded by migrations.py
     """
-    engine = create_engine(db_string)
+    import migrations
+
+    engine = get_engine()
+    is_new = not engine.has_table(Term.__tablename__)
     Base.metadata.create_all(engine)
+    if is_new:
+        migrations.stamp(engine)
 
 
 def seed_tables():
     """
-    Inserts Term instances into DB
+    Inserts the sample terms into DB, skipping the ones which already exist, so it can be run again
+    :return: number of the inserted terms
     """
-    terms = [
-        Term(name='juba'),
-        Term(name='fixation'),
-        Term(name='valet'),
-        Term(name='wallet'),
-        Term(name='hydrocolloid'),
-    ]
+    names = ['juba', 'fixation', 'valet', 'wallet', 'hydrocolloid']
 
-    with SQLAlchemyDBConnection(db_string) as db:
-        db.session.add_all(terms)
+    with SQLAlchemyDBConnection() as db:
+        inserted = 0
+        for name in names:
+            inserted += db.session.execute(insert_ignore(db.session, Term.__table__).values(name=name)).rowcount
         db.session.commit()
-
-    print('Terminology database is ready.')
+    return inserted
 
 
 if __name__ == '__main__':
     create_tables()
     seed_tables()
+    print('Terminology database is ready.')
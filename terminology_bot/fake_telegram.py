@@ -0,0 +1,223 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeTelegram'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            data = json.loads(body.decode('utf-8') or '{}')
+        elif content_type.startswith('multipart/form-data'):
+            data = self._multipart(content_type, body)
+        else:
+            data = dict(parse_qsl(body.decode('utf-8')))
+        self._call(data)
+
+    @staticmethod
+    def _multipart(content_type, body):
+        """
+        :return: dictionary of the form fields, the uploaded files are bytes
+        """
+        message = BytesParser(policy=policy.HTTP).parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        data = {}
+        for part in message.iter_parts():
+            payload = part.get_payload(decode=True)
+            name = part.get_param('name', header='content-disposition')
+            data[name] = payload if part.get_filename() else payload.decode('utf-8')
+        return data
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path.startswith(self.server.file_prefix):
+            return self._send_file()
+        self.path = path
+        self._call(dict(parse_qsl(query)))
+
+    def _call(self, data):
+        server = self.server
+        if not self.path.startswith(server.api_prefix):
+            return self._respond(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+        method = self.path[len(server.api_prefix):]
+        if server.latency:
+            time.sleep(server.latency)
+        answer = server.call(method, data)
+        self._respond(200 if answer['ok'] else answer['error_code'], answer)
+
+    def _send_file(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        server.count('download')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(server.file_size))
+        self.end_headers()
+        # the content differs between the files, so the media store keeps every downloaded file
+        self.wfile.write(self.path.encode('utf-8').ljust(server.file_size, b'\0')[:server.file_size])
+
+    def _respond(self, code, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.client_address[0], format % args)
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Local stand-in of the Telegram Bot API for benchmarks: answers the methods the bot calls, keeps the sent
+    messages and serves generated files for the media downloads. Point the bot to it with the base_url and
+    base_file_url options of the [bot] section.
+    """
+    daemon_threads = True
+
+    def __init__(self, token, listen='127.0.0.1', port=0, file_size=64 * 1024, latency=0, keep_messages=10000):
+        """
+        :param port: 0 to take a free port
+        :param file_size: size of the downloaded files in bytes
+        :param latency: seconds every request waits, to imitate the network
+        :param keep_messages: number of the last sent messages kept in `messages`
+        """
+        super().__init__((listen, port), FakeTelegramHandler)
+        self.token = token
+        self.file_size = file_size
+        self.latency = latency
+        self.api_prefix = f'/bot{token}/'
+        self.file_prefix = f'/file/bot{token}/'
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.messages = deque(maxlen=keep_messages)
+        self.updates = deque()
+        self.message_id = 0
+        self.uploaded_bytes = 0
+        # file ids the send methods answer with 'wrong file identifier', to imitate expired ids
+        self.stale_file_ids = set()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/bot'
+
+    @property
+    def base_file_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/file/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def count(self, method):
+        with self.lock:
+            self.calls[method] += 1
+
+    def push_updates(self, updates):
+        """
+        Queues update dictionaries for getUpdates
+        """
+        with self.lock:
+            self.updates.extend(updates)
+
+    def call(self, method, data):
+        """
+        :return: the answer of the Bot API method
+        """
+        self.count(method)
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            return {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'}
+        try:
+            return {'ok': True, 'result': handler(data)}
+        except ValueError as e:
+            return {'ok': False, 'error_code': 400, 'description': f'Bad Request: {e}'}
+
+    def api_getMe(self, data):
+        return {'id': 1, 'is_bot': True, 'first_name': 'Terminology Bot', 'username': 'terminology_bot'}
+
+    def api_sendMessage(self, data):
+        with self.lock:
+            self.message_id += 1
+            message = {'message_id': self.message_id, 'date': int(time.time()), 'text': data.get('text', ''),
+                       'chat': {'id': int(data['chat_id']), 'type': 'private'}}
+            self.messages.append(message)
+        return message
+
+    def _send_media(self, data, field, attributes):
+        """
+        Answers a send method of a media file, sent by its file id or uploaded
+        :param attributes: the attributes of the file besides its id and size
+        """
+        file = data[field]
+        with self.lock:
+            self.message_id += 1
+            if isinstance(file, bytes):
+                self.uploaded_bytes += len(file)
+                file_id = f'{field}-{self.message_id}'
+                size = len(file)
+            elif file in self.stale_file_ids:
+                raise ValueError('wrong file identifier/HTTP URL specified')
+            else:
+                file_id = file
+                size = self.file_size
+            media = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': size, **attributes}
+            message = {'message_id': self.message_id, 'date': int(time.time()),
+                       'chat': {'id': int(data['chat_id']), 'type': 'private'},
+                       field: [media] if field == 'photo' else media}
+            self.messages.append(message)
+        return message
+
+    def api_sendPhoto(self, data):
+        return self._send_media(data, 'photo', {'width': 640, 'height': 480})
+
+    def api_sendAudio(self, data):
+        return self._send_media(data, 'audio', {'duration': 1})
+
+    def api_sendVideo(self, data):
+        return self._send_media(data, 'video', {'width': 640, 'height': 480, 'duration': 1})
+
+    def api_sendChatAction(self, data):
+        return True
+
+    def api_getFile(self, data):
+        return {'file_id': data['file_id'], 'file_size': self.file_size, 'file_path': f'files/{data["file_id"]}.jpg'}
+
+    def api_getUpdates(self, data):
+        offset = int(data.get('offset') or 0)
+        deadline = time.monotonic() + min(float(data.get('timeout') or 0), 1)
+        while True:
+            with self.lock:
+                while self.updates and self.updates[0]['update_id'] < offset:
+                    self.updates.popleft()
+                if self.updates or time.monotonic() >= deadline:
+                    return list(self.updates)[:int(data.get('limit') or 100)]
+            time.sleep(0.01)
+
+    def api_deleteWebhook(self, data):
+        return True
+
+    def api_setWebhook(self, data):
+        return True
@@ -0,0 +1,377 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+import time
+
+from sqlalchemy import bindparam, func, text
+
+from config import get_settings
+from database import SQLAlchemyDBConnection, Term, MediaBlob, POSEnum, insert_ignore, pos_code
+from term_collection import TermCollection, NOTIFY_CHUNK
+
+
+logger = logging.getLogger(__name__)
+
+
+FIELDS = ['name', 'pos_tag', 'description', 'image', 'audiofile', 'videofile', 'synonyms', 'similars']
+ATTRIBUTES = ['pos_tag', 'description', 'image', 'audiofile', 'videofile']
+MEDIA_COLUMNS = sorted(TermCollection.MEDIA_COLUMNS)
+# link fields of a record and the kinds of TermCollection.LINK_TABLES
+LINK_FIELDS = {'synonyms': 'syn', 'similars': 'sim'}
+# separator of the words in the synonyms and similars columns of a CSV file
+LIST_SEPARATOR = ';'
+
+
+def detect_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+
+
+def read_records(file, file_format='csv'):
+    """
+    Yields the raw records of a CSV file with the header FIELDS (any subset, name is required)
+    or of a JSON Lines file with one object per line
+    """
+    if file_format == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        for row in csv.DictReader(file):
+            for field in LINK_FIELDS:
+                if row.get(field) is not None:
+                    row[field] = row[field].split(LIST_SEPARATOR)
+            yield row
+
+
+def normalize_record(record):
+    """
+    :return: record with the normalized name and link words, empty values as None and pos_tag as POSEnum
+    :raise ValueError: the record has no name, a field of a wrong type or an unknown part of speech
+    """
+    if not isinstance(record, dict):
+        raise ValueError('the record is not an object')
+    name = record.get('name') or ''
+    if not isinstance(name, str):
+        raise ValueError('name is not a string')
+    names = TermCollection.normalize_words([name])
+    if not names:
+        raise ValueError('the record has no name')
+
+    normalized = {'name': names[0]}
+    for field in ATTRIBUTES:
+        value = record.get(field)
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f'{field} is not a string')
+        normalized[field] = value and value.strip() or None
+    if normalized['pos_tag'] is not None:
+        pos_tag = normalized['pos_tag'].lower()
+        if pos_tag not in POSEnum.__members__:
+            raise ValueError(f'unknown part of speech "{normalized["pos_tag"]}"')
+        normalized['pos_tag'] = POSEnum[pos_tag]
+
+    for field in LINK_FIELDS:
+        words = record.get(field) or []
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            raise ValueError(f'{field} is not a list of strings')
+        words = TermCollection.normalize_words(words)
+        normalized[field] = [word for word in words if word != names[0]]
+    return normalized
+
+
+def write_records(file, records, file_format='csv'):
+    """
+    Writes the records as CSV with the header FIELDS or as JSON Lines
+    :return: number of written records
+    """
+    count = 0
+    if file_format == 'jsonl':
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+    else:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for record in records:
+            row = dict(record)
+            for field in LINK_FIELDS:
+                row[field] = LIST_SEPARATOR.join(row[field])
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def export_terms(connection_string=None, batch_size=5000):
+    """
+    Yields the terms as records with the fields FIELDS, in the order of ids.
+    The terms are read in batches of keyset pagination, so the memory doesn't grow with the glossary.
+    """
+    last_id = 0
+    with SQLAlchemyDBConnection(connection_string) as db:
+        while True:
+            terms = db.session.query(Term.id, Term.name, Term.pos_tag, Term.description, Term.image,
+                                     Term.audiofile, Term.videofile)\
+                .filter(Term.id > last_id).order_by(Term.id).limit(batch_size).all()
+            if not terms:
+                return
+
+            links = {}
+            for field, kind in LINK_FIELDS.items():
+                link_table, link_column = TermCollection.LINK_TABLES[kind]
+                rows = db.session.query(link_table.term_id, Term.name)\
+                    .join(Term, Term.id == getattr(link_table, link_column))\
+                    .filter(link_table.term_id.between(terms[0].id, terms[-1].id))\
+                    .order_by(Term.name)
+                for term_id, name in rows:
+                    links.setdefault((field, term_id), []).append(name)
+
+            for term in terms:
+                record = {'name': term.name, 'pos_tag': term.pos_tag.name if term.pos_tag else None}
+                record.update((column, getattr(term, column)) for column in ATTRIBUTES[1:])
+                record.update((field, links.get((field, term.id), [])) for field in LINK_FIELDS)
+                yield record
+            last_id = terms[-1].id
+
+
+class GlossaryImporter:
+    """
+    Loads records of read_records into the terms and link tables in batches, one transaction per batch.
+    Missing terms are created, the non-empty attributes of the record overwrite those of the term,
+    the synonyms and similars are added to the existing links; the words missing in the glossary become terms.
+    On PostgreSQL a batch is copied with COPY into a temporary staging table and merged with a few set-based
+    statements. Other databases get the batch with executemany.
+    """
+
+    STAGING_TABLE = """
+        CREATE TEMP TABLE IF NOT EXISTS glossary_staging (
+            name text NOT NULL, pos_tag smallint, description text, image text, audiofile text, videofile text,
+            synonyms text[] NOT NULL, similars text[] NOT NULL
+        ) ON COMMIT DELETE ROWS
+    """
+
+    # names of the staged terms and of their link words
+    STAGED_NAMES = """
+        SELECT name FROM glossary_staging
+        UNION SELECT unnest(synonyms) FROM glossary_staging
+        UNION SELECT unnest(similars) FROM glossary_staging
+    """
+
+    def __init__(self, connection_string=None, batch_size=5000):
+        self.connection_string = connection_string
+        self.batch_size = batch_size
+        # imports notify the running bots like their own writes
+        self.notify_channel = get_settings().cache.notify_channel
+
+    def run(self, records):
+        """
+        :param records: iterable of raw records
+        :return: dictionary with the numbers of imported and skipped records and the seconds spent
+        """
+        started = time.perf_counter()
+        imported, skipped = 0, 0
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            merge = self._merge_copy if db.session.bind.dialect.name == 'postgresql' else self._merge_executemany
+
+            batch = {}
+            for number, record in enumerate(records, 1):
+                try:
+                    record = normalize_record(record)
+                except ValueError as e:
+                    logger.warning('Record %s skipped: %s', number, e)
+                    skipped += 1
+                    continue
+
+                self._add_to_batch(batch, record)
+                if len(batch) >= self.batch_size:
+                    imported += self._flush(db.session, merge, batch)
+                    logger.info('Imported %s terms, %.0f terms/s.',
+                                imported, imported / (time.perf_counter() - started))
+                    batch = {}
+            if batch:
+                imported += self._flush(db.session, merge, batch)
+
+        return {'imported': imported, 'skipped': skipped, 'seconds': time.perf_counter() - started}
+
+    @staticmethod
+    def _add_to_batch(batch, record):
+        """
+        Merges the records of the same term, as a term can be written only once by a set-based statement
+        """
+        previous = batch.get(record['name'])
+        if previous is None:
+            batch[record['name']] = record
+            return
+        for field in ATTRIBUTES:
+            if record[field] is not None:
+                previous[field] = record[field]
+        for field in LINK_FIELDS:
+            previous[field] = TermCollection.normalize_words(previous[field] + record[field])
+
+    @staticmethod
+    def _flush(session, merge, batch):
+        """
+        Writes the batch in one transaction
+        :return: number of written terms
+        """
+        merge(session, list(batch.values()))
+        session.commit()
+        return len(batch)
+
+    def _merge_copy(self, session, records):
+        session.execute(text(self.STAGING_TABLE))
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for record in records:
+            writer.writerow([record['name'], pos_code(record['pos_tag'])] +
+                            [record[field] for field in ATTRIBUTES[1:]] +
+                            [self._array_literal(record[field]) for field in LINK_FIELDS])
+        buffer.seek(0)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(f'COPY glossary_staging ({", ".join(FIELDS)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+        # the terms and the link words missing in the glossary
+        session.execute(text(f"""
+            INSERT INTO terms (id, name)
+            SELECT nextval('terms_id_seq'), names.name FROM ({self.STAGED_NAMES}) names
+            WHERE NOT EXISTS (SELECT 1 FROM terms WHERE terms.name = names.name)
+            ON CONFLICT (name) DO NOTHING
+        """))
+
+        # references to the media blobs move from the current keys of the terms to the imported keys;
+        # the size of a blob unknown to media_blobs is 0 until the file is put into the store
+        changed = ' UNION ALL '.join(
+            f'SELECT s.{column} AS key, 1 AS delta FROM glossary_staging s JOIN terms t ON t.name = s.name '
+            f'WHERE s.{column} IS NOT NULL AND t.{column} IS DISTINCT FROM s.{column} '
+            f'UNION ALL SELECT t.{column}, -1 FROM glossary_staging s JOIN terms t ON t.name = s.name '
+            f'WHERE s.{column} IS NOT NULL AND t.{column} IS NOT NULL AND t.{column} != s.{column}'
+            for column in MEDIA_COLUMNS)
+        session.execute(text(f"""
+            INSERT INTO media_blobs (key, size, refcount)
+            SELECT DISTINCT key, 0, 0 FROM ({changed}) changed WHERE delta > 0
+            ON CONFLICT (key) DO NOTHING
+        """))
+        session.execute(text(f"""
+            UPDATE media_blobs SET refcount = media_blobs.refcount + changed.delta
+            FROM (SELECT key, sum(delta) AS delta FROM ({changed}) changed GROUP BY key) changed
+            WHERE media_blobs.key = changed.key AND changed.delta != 0
+        """))
+
+        assignments = ', '.join(f'{column} = coalesce(s.{column}, terms.{column})' for column in ATTRIBUTES)
+        session.execute(text(f"""
+            UPDATE terms SET {assignments}
+            FROM glossary_staging s WHERE terms.name = s.name
+        """))
+
+        for field, kind in LINK_FIELDS.items():
+            link_table, link_column = TermCollection.LINK_TABLES[kind]
+            session.execute(text(f"""
+                INSERT INTO {link_table.__tablename__} (term_id, {link_column})
+                SELECT t.id, l.id FROM glossary_staging s
+                JOIN terms t ON t.name = s.name
+                CROSS JOIN LATERAL unnest(s.{field}) AS word(name)
+                JOIN terms l ON l.name = word.name
+                WHERE l.id != t.id
+                ON CONFLICT DO NOTHING
+            """))
+
+        if self.notify_channel:
+            term_ids = [row.id for row in session.execute(text(
+                f'SELECT terms.id FROM terms JOIN ({self.STAGED_NAMES}) names ON names.name = terms.name'))]
+            self._notify(session, term_ids)
+
+    def _merge_executemany(self, session, records):
+        names = TermCollection.normalize_words(
+            [record['name'] for record in records] +
+            [word for record in records for field in LINK_FIELDS for word in record[field]])
+        session.execute(insert_ignore(session, Term.__table__), [{'name': name} for name in names])
+
+        terms = {}
+        for i in range(0, len(names), 500):
+            terms.update((row.name, row) for row in session.query(
+                Term.id, Term.name, Term.image, Term.audiofile, Term.videofile).filter(Term.name.in_(names[i:i + 500])))
+
+        deltas = {}
+        for record in records:
+            term = terms[record['name']]
+            for column in MEDIA_COLUMNS:
+                if record[column] is not None and record[column] != getattr(term, column):
+                    deltas[record[column]] = deltas.get(record[column], 0) + 1
+                    if getattr(term, column) is not None:
+                        deltas[getattr(term, column)] = deltas.get(getattr(term, column), 0) - 1
+        added = [{'key': key, 'size': 0, 'refcount': 0} for key, delta in deltas.items() if delta > 0]
+        if added:
+            session.execute(insert_ignore(session, MediaBlob.__table__), added)
+        moved = [{'_key': key, '_delta': delta} for key, delta in deltas.items() if delta]
+        if moved:
+            session.execute(MediaBlob.__table__.update().where(MediaBlob.key == bindparam('_key'))
+                            .values(refcount=MediaBlob.refcount + bindparam('_delta')), moved)
+
+        values = {column: func.coalesce(bindparam(f'_{column}', type_=getattr(Term, column).type),
+                                        getattr(Term, column))
+                  for column in ATTRIBUTES}
+        session.execute(Term.__table__.update().where(Term.id == bindparam('_id')).values(values),
+                        [dict({f'_{column}': record[column] for column in ATTRIBUTES},
+                              _id=terms[record['name']].id) for record in records])
+
+        for field, kind in LINK_FIELDS.items():
+            link_table, link_column = TermCollection.LINK_TABLES[kind]
+            links = [{'term_id': terms[record['name']].id, link_column: terms[word].id}
+                     for record in records for word in record[field]]
+            if links:
+                session.execute(insert_ignore(session, link_table.__table__), links)
+
+    def _notify(self, session, term_ids):
+        """
+        Notifies the running bots about the written terms, see TermCollection._write_done.
+        The ids are sent in chunks, as the payload of a notification is limited to 8000 bytes.
+        """
+        for i in range(0, len(term_ids), NOTIFY_CHUNK):
+            payload = json.dumps({'origin': 'glossary_io', 'terms': term_ids[i:i + NOTIFY_CHUNK], 'pages': i == 0})
+            session.execute(text('SELECT pg_notify(:channel, :payload)'),
+                            {'channel': self.notify_channel, 'payload': payload})
+
+    @staticmethod
+    def _array_literal(words):
+        """
+        :return: PostgreSQL array literal of the words for COPY
+        """
+        return '{' + ','.join('"' + word.replace('\\', '\\\\').replace('"', '\\"') + '"' for word in words) + '}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import and export of the glossary as CSV or JSON Lines')
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import', help='add the terms of the file to the glossary')
+    export_parser = subparsers.add_parser('export', help='write all terms of the glossary to the file')
+    for subparser in (import_parser, export_parser):
+        subparser.add_argument('file', help='path of the file, - for the standard input or output')
+        subparser.add_argument('--format', choices=['csv', 'jsonl'],
+                               help='format of the file, by default .jsonl and .json files are JSON Lines')
+        subparser.add_argument('--batch-size', type=int, default=5000, help='number of terms per transaction')
+    args = parser.parse_args()
+
+    if args.command not in ('import', 'export'):
+        parser.print_help()
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    file_format = args.format or detect_format(args.file)
+
+    if args.command == 'import':
+        file = sys.stdin if args.file == '-' else open(args.file, newline='', encoding='utf-8')
+        with file:
+            stats = GlossaryImporter(batch_size=args.batch_size).run(read_records(file, file_format))
+        print(f'Imported {stats["imported"]} terms, skipped {stats["skipped"]} records in {stats["seconds"]:.1f} s.')
+    else:
+        started = time.perf_counter()
+        file = sys.stdout if args.file == '-' else open(args.file, 'w', newline='', encoding='utf-8')
+        with file:
+            count = write_records(file, export_terms(batch_size=args.batch_size), file_format)
+        print(f'Exported {count} terms in {time.perf_counter() - started:.1f} s.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,4 +2,5 @@ docker run --rm -p 5555:5432 --name pg_terminology -e POSTGRES_USER=admin -e POS
 sleep 10
 pip3 install -r requirements.txt
 export PYTHONPATH=`pwd`
-python3 database.py
\ No newline at end of file
+python3 cli.py init-db
+python3 cli.py seed
\ No newline at end of file
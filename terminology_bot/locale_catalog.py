@@ -0,0 +1,146 @@
+import gettext
+import logging
+import os
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from telegram import ReplyKeyboardMarkup
+
+from config import resolve_path
+from database import POSEnum
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCALE = 'en'
+
+
+class Locale(namedtuple('Locale', ['key', 'translation', 'options', 'pos_tags',
+                                   'start_markup', 'term_markup', 'pos_markup'])):
+    """
+    Immutable UI-elements of one language. The instances are shared between all users of the language.
+    """
+    __slots__ = ()
+
+    @property
+    def gettext(self):
+        return self.translation.gettext
+
+
+class LocaleCatalog:
+    """
+    Loads the gettext translations from the locale directory once per process
+    and builds the button labels and keyboards of every language.
+    """
+
+    def __init__(self, locale_dir='data/locale', domain='bot', default=DEFAULT_LOCALE, on_load=None):
+        """
+        :param on_load: callback called once with every Locale the first time it is loaded
+        """
+        self.locale_dir = resolve_path(locale_dir)
+        self.domain = domain
+        self.default = default
+        self.on_load = on_load
+
+        self._locales = {}
+        self._aliases = {}
+        self._lock = threading.Lock()
+        self.available = self.find_locales()
+
+    def find_locales(self):
+        """
+        :return: the names of the locales which have compiled .mo files of the domain
+        """
+        if not os.path.isdir(self.locale_dir):
+            return []
+        return sorted(name for name in os.listdir(self.locale_dir)
+                      if os.path.exists(os.path.join(self.locale_dir, name, 'LC_MESSAGES', f'{self.domain}.mo')))
+
+    def resolve(self, lang_code):
+        """
+        Finds the best available locale for the language code of a Telegram user,
+        falling back through the language prefix: 'ru' -> 'ru_RU', 'en-US' -> 'en'.
+        :return: locale key, the default locale if nothing suits
+        """
+        key = self._aliases.get(lang_code)
+        if key is not None:
+            return key
+
+        key = self.default
+        if lang_code:
+            code = lang_code.replace('-', '_').lower()
+            prefix = code.split('_')[0]
+            by_name = {name.lower(): name for name in self.available}
+
+            if code in by_name:
+                key = by_name[code]
+            elif prefix in by_name:
+                key = by_name[prefix]
+            else:
+                key = next((name for name in self.available if name.lower().startswith(prefix + '_')), key)
+
+        self._aliases[lang_code] = key
+        return key
+
+    def get(self, lang_code):
+        """
+        :return: the shared Locale for the language code, loaded on the first request
+        """
+        key = self.resolve(lang_code)
+        locale = self._locales.get(key)
+        if locale is None:
+            with self._lock:
+                locale = self._locales.get(key)
+                if locale is None:
+                    locale = self._load(key)
+                    self._locales[key] = locale
+                    if self.on_load:
+                        self.on_load(locale)
+        return locale
+
+    def warmup(self):
+        """
+        Eagerly loads all available locales, e.g. at boot
+        :return: list of the loaded Locales
+        """
+        return [self.get(name) for name in self.available]
+
+    def _load(self, key):
+        try:
+            translation = gettext.translation(self.domain, self.locale_dir, [key])
+            if key != self.default:
+                translation.add_fallback(gettext.translation(self.domain, self.locale_dir, [self.default]))
+        except IOError:
+            logger.info('No translation files for "%s" were found. Messages will not be translated.', key)
+            translation = gettext.NullTranslations()
+
+        _ = translation.gettext
+        options = {
+            'new_term': _('Add new term'),
+            'list_term': _('Get list of terms'),
+            'pos_tag': _('POS-tag'),
+            'description': _('Description'),
+            'synonyms': _('Synonyms'),
+            'similars': _('Similar words'),
+            'image': _('Image'),
+            'audio': _('Audio'),
+            'video': _('Video'),
+        }
+        pos_tags = {_(member.value): member.value for name, member in POSEnum.__members__.items()}
+
+        start_btn = ((options['new_term'],), (options['list_term'],))
+        term_btn = ((options['pos_tag'], options['description']),
+                    (options['synonyms'], options['similars']),
+                    (options['image'], options['audio'], options['video']))
+        pos_btn = (tuple(pos_tags),)
+
+        return Locale(key=key,
+                      translation=translation,
+                      options=MappingProxyType(options),
+                      pos_tags=MappingProxyType(pos_tags),
+                      start_markup=ReplyKeyboardMarkup(keyboard=start_btn, resize_keyboard=True,
+                                                       one_time_keyboard=True),
+                      term_markup=ReplyKeyboardMarkup(keyboard=term_btn, resize_keyboard=True),
+                      pos_markup=ReplyKeyboardMarkup(keyboard=pos_btn, resize_keyboard=True,
+                                                     one_time_keyboard=True))
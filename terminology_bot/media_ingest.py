@@ -0,0 +1,150 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+
+from telegram.error import NetworkError
+
+import metrics
+from database import conversation
+
+
+logger = logging.getLogger(__name__)
+
+class MediaIngestor:
+    """
+    Downloads media files of the terms on a bounded pool of worker threads, off the dispatcher threads.
+    A file is streamed in chunks to a temporary file while its content hash is computed,
+    and then atomically moved into the content-addressed media store.
+    """
+
+    # kind of media: (default file extension, column of the Term)
+    KINDS = {
+        'image': ('.jpg', 'image'),
+        'audio': ('.ogg', 'audiofile'),
+        'video': ('.mp4', 'videofile'),
+    }
+
+    def __init__(self, bot, term_collection, store, on_done, workers=2, queue_size=100, retries=3,
+                 retry_delay=2, chunk_size=64 * 1024, timeout=60):
+        """
+        :param on_done: callback on_done(job, error) called from a worker thread when a job is finished,
+                        error is None if the file was saved
+        :param queue_size: maximum number of jobs waiting for a worker
+        :param retries: number of extra download attempts after network errors
+        """
+        self.bot = bot
+        self.term_collection = term_collection
+        self.store = store
+        self.on_done = on_done
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'media-ingest-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Lets the workers finish the queued jobs and stops them
+        """
+        for _ in self._threads:
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, job):
+        """
+        Queues the job without blocking
+        :return: False if the queue is full
+        """
+        try:
+            self.jobs.put_nowait(job)
+            return True
+        except queue.Full:
+            logger.warning('Media queue is full, the %s for the term %s was rejected.', job.kind, job.term_id)
+            return False
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self._ingest(job)
+            finally:
+                self.jobs.task_done()
+
+    def _ingest(self, job):
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                key, size, extension = self.save(job)
+                # the user's next reads of the term go to the primary, see database.ReplicaRouter
+                with conversation(job.chat_id):
+                    self.term_collection.set_media(job.term_id, self.KINDS[job.kind][1], key, size, extension,
+                                                   file_id=job.file_id, file_unique_id=job.file_unique_id)
+                error = None
+                break
+            except (NetworkError, OSError) as e:
+                error = e
+                logger.warning('Attempt %s to save the %s for the term %s failed: %s',
+                               attempt + 1, job.kind, job.term_id, e)
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+            except Exception as e:
+                error = e
+                logger.exception('Saving the %s for the term %s failed.', job.kind, job.term_id)
+                break
+
+        try:
+            self.on_done(job, error)
+        except Exception:
+            logger.exception('Reply about the %s for the term %s failed.', job.kind, job.term_id)
+
+    def save(self, job):
+        """
+        Streams the file into the media store
+        :return: key of the blob, its size in bytes and the extension of the file
+        """
+        started = time.perf_counter()
+        telegram_file = self.bot.get_file(job.file_id, timeout=self.timeout)
+        extension = os.path.splitext(telegram_file.file_path or '')[1].lower() or self.KINDS[job.kind][0]
+
+        digest = hashlib.sha256()
+        size = 0
+        with self.store.temporary_file() as tmp:
+            try:
+                with urllib.request.urlopen(telegram_file.file_path, timeout=self.timeout) as response:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        digest.update(chunk)
+                        tmp.write(chunk)
+                        size += len(chunk)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+
+        metrics.MEDIA_SECONDS.observe(time.perf_counter() - started, job.kind)
+        metrics.MEDIA_BYTES.inc(size, job.kind)
+        return self.store.put(tmp.name, digest.hexdigest()), size, extension
+
+    def stats(self):
+        """
+        :return: dictionary with the queue depth and the number of workers
+        """
+        return {'queued': self.jobs.qsize(), 'queue_size': self.jobs.maxsize, 'workers': len(self._threads)}
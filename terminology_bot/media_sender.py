@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+from collections import Counter
+
+from telegram import InputFile
+from telegram.error import BadRequest
+
+import metrics
+from cache import LRUCache
+from media_store import MediaStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaSender:
+    """
+    Sends the media files of the terms by their Telegram file ids, so the same bytes are not uploaded again.
+    A file without a known id, or with an id Telegram doesn't accept anymore, is uploaded from the media store
+    and the id of the uploaded file is kept with the blob for the next time.
+    """
+
+    # kind of media: (method of telegram.Bot, attribute of the sent message with the file)
+    METHODS = {
+        'image': ('send_photo', 'photo'),
+        'audio': ('send_audio', 'audio'),
+        'video': ('send_video', 'video'),
+    }
+
+    def __init__(self, term_collection, store, timeout=60, cache_size=4096):
+        """
+        :param timeout: seconds to wait for an upload
+        :param cache_size: number of the blobs whose file ids are cached
+        """
+        self.term_collection = term_collection
+        self.store = store
+        self.timeout = timeout
+        # file ids of the blobs, '' if the blob has none
+        self.file_ids = LRUCache(maxsize=cache_size)
+        # sends by the source of the file: file_id, upload (no id known), stale (id not accepted), missing
+        self.sends = Counter()
+        self._lock = threading.Lock()
+
+    def file_id(self, key):
+        """
+        :return: the Telegram file id of the blob, None if there is none
+        """
+        return self.file_ids.get_or_load(key, lambda: self.term_collection.media_file_id(key) or '') or None
+
+    def send(self, bot, chat_id, reply_markup=None, kind='image', key=None, file_id=None):
+        """
+        Sends the blob to the chat; the signature fits Outbox.send_media.
+        Flood waits and network errors of the upload are raised for the outbox to retry.
+        :param file_id: file id of the blob if the caller has already read it, e.g. from TermProfile
+        """
+        method, attribute = self.METHODS[kind]
+        send = getattr(bot, method)
+
+        source = 'upload'
+        file_id = file_id or self.file_id(key)
+        if file_id:
+            try:
+                send(chat_id, file_id, reply_markup=reply_markup)
+                self._count(kind, 'file_id')
+                return
+            except BadRequest as e:
+                # the ids of the files are kept by Telegram, but they may expire or belong to another bot
+                logger.info('File id of the blob %s was not accepted, uploading the file: %s', key, e)
+                self.file_ids.pop(key)
+                source = 'stale'
+
+        try:
+            file = open(self.store.path(key), 'rb')
+        except OSError as e:
+            logger.warning('The %s %s can\'t be sent: %s', kind, key, e)
+            self._count(kind, 'missing')
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            # the blob file has no extension, Telegram gets the type of the file from the name of the upload
+            upload = InputFile(file, filename=MediaStore.file_name(key, self.term_collection.media_extension(key)))
+            message = send(chat_id, upload, reply_markup=reply_markup, timeout=self.timeout)
+        self._count(kind, source)
+        metrics.MEDIA_UPLOAD_BYTES.inc(size, kind)
+
+        sent = getattr(message, attribute, None)
+        if isinstance(sent, list):
+            # the sizes of the photo, the largest one is the uploaded file
+            sent = sent[-1] if sent else None
+        if sent is not None:
+            self.term_collection.set_media_file_id(key, sent.file_id, getattr(sent, 'file_unique_id', None))
+            self.file_ids.set(key, sent.file_id)
+
+    def _count(self, kind, source):
+        metrics.MEDIA_SENDS.inc(1, kind, source)
+        with self._lock:
+            self.sends[source] += 1
+
+    def stats(self):
+        """
+        :return: dictionary with the numbers of sends by the source of the file and the hit rate of the file ids,
+                 the share of the sends without an upload
+        """
+        with self._lock:
+            stats = dict(self.sends)
+        total = sum(stats.values())
+        stats['hit_rate'] = stats.get('file_id', 0) / total if total else None
+        return stats
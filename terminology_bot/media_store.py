@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import namedtuple
+
+from config import get_settings
+from database import SQLAlchemyDBConnection, MediaBlob
+
+
+logger = logging.getLogger(__name__)
+
+# a media file sent by the user for the term; locale is the key of the user's language for the replies,
+# file_unique_id is None with the Bot API clients which don't know it
+MediaJob = namedtuple('MediaJob', ['kind', 'file_id', 'file_unique_id', 'term_id', 'chat_id', 'locale'])
+
+
+class MediaStore:
+    """
+    Content-addressed storage of the media files. A file is stored once under the SHA-256 of its content
+    in sharded subdirectories: <root>/ab/cd/abcd..., so the same bytes uploaded with another extension are
+    the same blob. The number of terms referring to a file and its extension are kept in the media_blobs table,
+    see TermCollection.set_media.
+    """
+
+    TMP_DIR = '.tmp'
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        """
+        :return: path of the blob file
+        """
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def temporary_file(self):
+        """
+        :return: open temporary file on the same file system as the blobs, so it can be renamed atomically
+        """
+        directory = os.path.join(self.root, self.TMP_DIR)
+        os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, suffix='.part', delete=False)
+
+    def put(self, tmp_path, digest):
+        """
+        Moves the downloaded file into the store. If the blob already exists the file isn't written again.
+        :param digest: SHA-256 hex digest of the file content
+        :return: key of the blob
+        """
+        key = digest
+        path = self.path(key)
+
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # fresh modification time protects the blob from the garbage collector until it is referenced
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return key
+
+    def put_file(self, source_path):
+        """
+        Copies a local file into the store
+        :return: key of the blob
+        """
+        digest = hashlib.sha256()
+        with open(source_path, 'rb') as source, self.temporary_file() as tmp:
+            for chunk in iter(lambda: source.read(64 * 1024), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        return self.put(tmp.name, digest.hexdigest())
+
+    @staticmethod
+    def file_name(key, extension=None):
+        """
+        :return: name of the blob file for an upload, so Telegram gets the type of the file from its extension;
+                 keys of the blobs stored before the extension was kept apart already end with it
+        """
+        if os.path.splitext(key)[1]:
+            return key
+        return key + (extension or '')
+
+    def collect_garbage(self, grace_period=3600, dry_run=False):
+        """
+        Removes the blobs no term refers to, files unknown to the media_blobs table and stale temporary files.
+        Files modified during the grace period are kept, as they may belong to an upload in progress.
+        :return: number of removed files and freed bytes
+        """
+        deadline = time.time() - grace_period
+        removed, freed = 0, 0
+
+        with SQLAlchemyDBConnection() as db:
+            known = set()
+            for blob in db.session.query(MediaBlob.key, MediaBlob.refcount, MediaBlob.size):
+                path = self.path(blob.key)
+                if blob.refcount > 0 or (os.path.exists(path) and os.path.getmtime(path) > deadline):
+                    known.add(blob.key)
+                    continue
+
+                logger.info('Removing unreferenced blob %s.', blob.key)
+                if not dry_run:
+                    deleted = db.session.query(MediaBlob)\
+                        .filter(MediaBlob.key == blob.key, MediaBlob.refcount <= 0)\
+                        .delete(synchronize_session=False)
+                    if not deleted:
+                        known.add(blob.key)
+                        continue
+                    if os.path.exists(path):
+                        os.remove(path)
+                removed += 1
+                freed += blob.size
+            db.session.commit()
+
+        for path in self._stored_files():
+            if os.path.basename(path) in known or os.path.getmtime(path) > deadline:
+                continue
+
+            logger.info('Removing orphaned file %s.', path)
+            freed += os.path.getsize(path)
+            removed += 1
+            if not dry_run:
+                os.remove(path)
+
+        return removed, freed
+
+    def _stored_files(self):
+        """
+        Yields the files of the shard directories and the temporary directory.
+        Other files of the multimedia directory, e.g. saved before the store was introduced, are left alone.
+        """
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            is_shard = len(name) == 2 and all(char in '0123456789abcdef' for char in name)
+            if not (is_shard or name == self.TMP_DIR):
+                continue
+            for directory, subdirectories, files in os.walk(os.path.join(self.root, name)):
+                for file_name in files:
+                    yield os.path.join(directory, file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the content-addressed media store')
+    subparsers = parser.add_subparsers(dest='command')
+    gc_parser = subparsers.add_parser('gc', help='remove media files no term refers to')
+    gc_parser.add_argument('--grace-period', type=int, default=3600,
+                           help='keep files modified during this number of seconds')
+    gc_parser.add_argument('--dry-run', action='store_true', help='only report what would be removed')
+    args = parser.parse_args()
+
+    if args.command != 'gc':
+        parser.print_help()
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    store = MediaStore(get_settings().media.directory)
+    removed, freed = store.collect_garbage(grace_period=args.grace_period, dry_run=args.dry_run)
+    print(f'Removed {removed} files, {freed} bytes freed.')
+
+
+if __name__ == '__main__':
+    main()
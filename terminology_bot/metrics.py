@@ -0,0 +1,402 @@
+import bisect
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+
+class Metric:
+    """
+    Base of the metrics: values kept per combination of the label values, safe to update from any thread
+    """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{self._escape(value)}"' for name, value in pairs) + '}'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def exposition(self):
+        """
+        :return: lines of the metric in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = [(key, self._copy(value)) for key, value in sorted(self._values.items())]
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def snapshot(self):
+        """
+        :return: dictionary {label values joined by '/': summary of the values}
+        """
+        with self._lock:
+            return {'/'.join(map(str, key)) or 'all': self._summary(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self, key, value):
+        return [f'{self.name}{self._label_text(key)} {value}']
+
+    @staticmethod
+    def _summary(value):
+        return value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function, *label_values):
+        """
+        Reports the value returned by function() whenever the metric is read
+        """
+        self.set(function, *label_values)
+
+    @staticmethod
+    def _copy(value):
+        return value() if callable(value) else value
+
+    def _samples(self, key, value):
+        return [f'{self.name}{self._label_text(key)} {value}']
+
+    @staticmethod
+    def _summary(value):
+        return value() if callable(value) else value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    # upper bounds of the buckets in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # counts of the buckets, the last one for the values above all bounds, sum of the values
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1]]
+
+    def _samples(self, key, value):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append(f'{self.name}_bucket{self._label_text(key, [("le", bound)])} {cumulative}')
+        samples.append(f'{self.name}_sum{self._label_text(key)} {total}')
+        samples.append(f'{self.name}_count{self._label_text(key)} {cumulative}')
+        return samples
+
+    @staticmethod
+    def _summary(value):
+        count = sum(value[0])
+        return {'count': count, 'sum': value[1], 'mean': value[1] / count if count else 0}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        return '\n'.join(line for metric in self.metrics for line in metric.exposition()) + '\n'
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.add(Histogram('bot_handler_seconds', 'Time spent in the handlers of the conversation',
+                                         labels=('state', 'handler')))
+UPDATE_SECONDS = registry.add(Histogram('bot_update_seconds', 'Time spent on an update by all handlers'))
+UPDATE_ERRORS = registry.add(Counter('bot_update_errors_total', 'Updates whose handlers raised an exception'))
+METHOD_SECONDS = registry.add(Histogram('bot_method_seconds', 'Time spent in the methods of the bot components',
+                                        labels=('component', 'method')))
+SQL_STATEMENTS = registry.add(Counter('bot_sql_statements_total', 'SQL statements executed'))
+SQL_PER_UPDATE = registry.add(Histogram('bot_sql_statements_per_update', 'SQL statements executed for one update',
+                                        buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)))
+MEDIA_BYTES = registry.add(Counter('bot_media_download_bytes_total', 'Bytes of the downloaded media files',
+                                   labels=('kind',)))
+MEDIA_SECONDS = registry.add(Histogram('bot_media_download_seconds', 'Time spent downloading a media file',
+                                       labels=('kind',), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)))
+# source of a sent media file: file_id (no upload), upload (no id known), stale (id not accepted) or missing;
+# the hit rate of the file ids is the file_id sends divided by all sends
+MEDIA_SENDS = registry.add(Counter('bot_media_sends_total', 'Media files sent to the users by the source of the file',
+                                   labels=('kind', 'source')))
+MEDIA_UPLOAD_BYTES = registry.add(Counter('bot_media_upload_bytes_total',
+                                          'Bytes of the media files uploaded to Telegram', labels=('kind',)))
+SESSIONS = registry.add(Gauge('bot_sessions', 'Sessions of the users kept in memory'))
+SESSION_BYTES = registry.add(Gauge('bot_session_bytes', 'Bytes of memory per session of a user'))
+STARTUP_SECONDS = registry.add(Gauge('bot_startup_seconds', 'Seconds spent in the phases of the startup',
+                                     labels=('phase',)))
+
+# number of SQL statements of the update handled by the current thread
+_local = threading.local()
+
+
+class StartupTimer:
+    """
+    Measures the phases of the startup, e.g. the imports, the warm-up and connecting to Telegram.
+    Every phase is logged and kept in STARTUP_SECONDS.
+    """
+
+    def __init__(self, started=None):
+        """
+        :param started: time.perf_counter() of the start, e.g. taken before the imports
+        """
+        self.started = time.perf_counter() if started is None else started
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.phases.append((name, seconds))
+            STARTUP_SECONDS.set(seconds, name)
+            logger.info('Startup phase %s took %.3f s.', name, seconds)
+
+    def report(self):
+        """
+        Logs the time of every phase and the total time since the start
+        :return: dictionary {phase: seconds} with the total under 'total'
+        """
+        total = time.perf_counter() - self.started
+        STARTUP_SECONDS.set(total, 'total')
+        logger.info('Started in %.3f s: %s.', total,
+                    ', '.join(f'{name} {seconds:.3f} s' for name, seconds in self.phases))
+        return {**dict(self.phases), 'total': total}
+
+
+def count_statements(engine):
+    """
+    Counts the SQL statements executed by the engine, in total and per update
+    """
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        SQL_STATEMENTS.inc()
+        _local.statements = getattr(_local, 'statements', 0) + 1
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def track_updates(process_update):
+    """
+    Wraps Dispatcher.process_update to measure the time and the SQL statements of every update
+    """
+    @functools.wraps(process_update)
+    def wrapper(update):
+        _local.statements = 0
+        started = time.perf_counter()
+        try:
+            return process_update(update)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - started)
+            SQL_PER_UPDATE.observe(_local.statements)
+
+    return wrapper
+
+
+def timed(function, histogram, *label_values):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, *label_values)
+
+    return wrapper
+
+
+def instrument_conversation(conversation, state_names):
+    """
+    Times the callbacks of the ConversationHandler by the state they belong to
+    :param state_names: sequence of the state names indexed by the state
+    """
+    groups = [('entry', conversation.entry_points), ('fallback', conversation.fallbacks)]
+    groups.extend((state_names[state], handlers) for state, handlers in conversation.states.items())
+    for state_name, handlers in groups:
+        for handler in handlers:
+            handler.callback = timed(handler.callback, HANDLER_SECONDS, state_name, handler.callback.__name__)
+
+
+def instrument_methods(instance, component):
+    """
+    Times the public methods of the instance, e.g. of TermCollection
+    """
+    for name, method in inspect.getmembers(instance, inspect.ismethod):
+        if not name.startswith('_'):
+            setattr(instance, name, timed(method, METHOD_SECONDS, component, name))
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: takes the stacks of all threads every `interval` seconds and counts them.
+    The result is in the collapsed format of flame graph tools: 'frame;frame;frame count' per line.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+            self._thread.start()
+            logger.info('Sampling profiler started.')
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+            logger.info('Sampling profiler stopped after %s samples.', self.samples)
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                stacks.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def collapsed(self):
+        """
+        :return: the counted stacks in the collapsed format, the most frequent first
+        """
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def dump(self, filename):
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write(self.collapsed())
+        logger.info('Profile saved to %s.', filename)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server_version = 'TerminologyBot'
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/metrics':
+            return self._respond(200, registry.exposition(), 'text/plain; version=0.0.4')
+        if self.path == '/profile' and server.profiler is not None:
+            return self._respond(200, server.profiler.collapsed(), 'text/plain')
+        self._respond(404, '', 'text/plain')
+
+    def _respond(self, code, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.client_address[0], format % args)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Local HTTP server of the metrics for Prometheus (/metrics) and of the profiler samples (/profile)
+    """
+    daemon_threads = True
+
+    def __init__(self, listen='127.0.0.1', port=9100, profiler=None):
+        self.profiler = profiler
+        super().__init__((listen, port), MetricsHandler)
+
+
+class SnapshotLogger(threading.Thread):
+    """
+    Writes the snapshot of all metrics to the log as one JSON line every `interval` seconds
+    """
+
+    def __init__(self, interval=60):
+        super().__init__(name='metrics-log', daemon=True)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            logger.info('Metrics %s', json.dumps(registry.snapshot(), sort_keys=True))
@@ -0,0 +1,207 @@
+import argparse
+import logging
+import time
+from collections import namedtuple
+
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, func, select, text
+
+from database import get_engine, POS_CODES, TERM_DOCUMENT, TOUCH_FUNCTION, TOUCH_TRIGGER
+
+
+logger = logging.getLogger(__name__)
+
+# one schema change. The upgrade gets a connection; a transactional migration runs in one transaction,
+# the others in autocommit mode, e.g. to build indexes concurrently, and must be safe to run again after a failure
+Migration = namedtuple('Migration', ['version', 'name', 'upgrade', 'transactional'])
+
+# versions of the applied migrations, a database without the table has the schema of version 0
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(256), nullable=False),
+    Column('applied_at', DateTime(timezone=True), nullable=False, server_default=func.now()),
+)
+
+
+def create_index(connection, name, table, definition):
+    """
+    Builds the index without blocking the writes to the table. An interrupted concurrent build leaves
+    an invalid index behind, it is dropped and built again.
+    :param definition: the part of CREATE INDEX after the table name, e.g. '(name)' or 'USING gin (...)'
+    """
+    invalid = connection.execute(text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)'),
+                                 name=name).scalar()
+    if invalid:
+        logger.info('Dropping invalid index %s.', name)
+        connection.execute(f'DROP INDEX CONCURRENTLY {name}')
+    connection.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}')
+
+
+def link_indexes(connection):
+    create_index(connection, 'ix_synonyms_synonym_id', 'synonyms', '(synonym_id)')
+    create_index(connection, 'ix_similar_words_similar_word_id', 'similar_words', '(similar_word_id)')
+
+
+def name_indexes(connection):
+    connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    create_index(connection, 'ix_terms_name_lower', 'terms', '(lower(name))')
+    create_index(connection, 'ix_terms_name_trgm', 'terms', 'USING gin (name gin_trgm_ops)')
+    create_index(connection, 'ix_terms_document', 'terms', f'USING gin ({TERM_DOCUMENT})')
+
+
+def pos_tag_codes(connection, batch_size=10000):
+    """
+    Replaces the posenum column with a smallint column of POS_CODES. The codes are written to a new column
+    in batches of ids, each in its own transaction, while the bot keeps working. The rows changed meanwhile
+    are copied again under a short exclusive lock, then the columns are swapped.
+    """
+    column_type = connection.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = 'terms' AND column_name = 'pos_tag'"
+    )).scalar()
+    if column_type == 'smallint':
+        return
+
+    code = 'CASE pos_tag::text ' + ' '.join(f"WHEN '{member.name}' THEN {code}"
+                                            for member, code in POS_CODES.items()) + ' END'
+    connection.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS pos_tag_code smallint')
+
+    last_id = connection.execute('SELECT coalesce(max(id), 0) FROM terms').scalar()
+    for after in range(0, last_id, batch_size):
+        connection.execute(text(f'UPDATE terms SET pos_tag_code = {code} '
+                                f'WHERE id > :after AND id <= :until AND pos_tag IS NOT NULL'),
+                           after=after, until=after + batch_size)
+        logger.info('Converted the parts of speech of %s of %s terms.', min(after + batch_size, last_id), last_id)
+
+    with connection.engine.begin() as transaction:
+        transaction.execute('LOCK TABLE terms IN ACCESS EXCLUSIVE MODE')
+        transaction.execute(f'UPDATE terms SET pos_tag_code = {code} WHERE pos_tag_code IS DISTINCT FROM {code}')
+        transaction.execute('ALTER TABLE terms DROP COLUMN pos_tag')
+        transaction.execute('ALTER TABLE terms RENAME COLUMN pos_tag_code TO pos_tag')
+        transaction.execute('DROP TYPE IF EXISTS posenum')
+
+
+def timestamps(connection):
+    # now() is stable, so since PostgreSQL 11 the default of the existing rows is stored once, not written to them
+    connection.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now()')
+    connection.execute('ALTER TABLE terms ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()')
+    connection.execute(TOUCH_FUNCTION)
+    connection.execute('DROP TRIGGER IF EXISTS terms_updated_at ON terms')
+    connection.execute(TOUCH_TRIGGER)
+
+
+def media_file_ids(connection):
+    connection.execute('ALTER TABLE media_blobs ADD COLUMN IF NOT EXISTS file_id varchar(256)')
+    connection.execute('ALTER TABLE media_blobs ADD COLUMN IF NOT EXISTS file_unique_id varchar(64)')
+
+
+def media_extensions(connection):
+    connection.execute('ALTER TABLE media_blobs ADD COLUMN IF NOT EXISTS extension varchar(16)')
+
+
+MIGRATIONS = [
+    Migration(1, 'indexes of the linked terms', link_indexes, False),
+    Migration(2, 'case-insensitive, trigram and full-text indexes of the terms', name_indexes, False),
+    Migration(3, 'parts of speech as smallint codes', pos_tag_codes, False),
+    Migration(4, 'created_at and updated_at of the terms', timestamps, True),
+    Migration(5, 'Telegram file ids of the media blobs', media_file_ids, True),
+    Migration(6, 'file extensions of the media blobs', media_extensions, True),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(engine):
+    """
+    :return: version of the schema, None if the database has no tables yet
+    """
+    if engine.has_table(schema_migrations.name):
+        with engine.connect() as connection:
+            return connection.execute(select([func.max(schema_migrations.c.version)])).scalar() or 0
+    return 0 if engine.has_table('terms') else None
+
+
+def stamp(engine, version=LATEST_VERSION):
+    """
+    Marks the migrations up to the version as applied without running them, e.g. after database.create_tables
+    """
+    schema_migrations.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(schema_migrations.delete())
+        connection.execute(schema_migrations.insert(), [{'version': migration.version, 'name': migration.name}
+                                                        for migration in MIGRATIONS if migration.version <= version])
+
+
+def pending_migrations(engine, target=LATEST_VERSION):
+    version = current_version(engine)
+    if version is None:
+        raise RuntimeError('The database has no tables, create them with python cli.py init-db')
+    return [migration for migration in MIGRATIONS if version < migration.version <= target]
+
+
+def check(engine):
+    """
+    Makes sure the schema is up to date before the bot starts
+    :raise RuntimeError: the database has no tables or there are migrations to apply
+    """
+    pending = pending_migrations(engine)
+    if pending:
+        raise RuntimeError(f'The schema is at version {current_version(engine)}, apply the migrations '
+                           f'{", ".join(str(migration.version) for migration in pending)} '
+                           f'with python migrations.py upgrade')
+
+
+def upgrade(engine, target=LATEST_VERSION):
+    """
+    Applies the pending migrations up to the target version in order
+    :return: list of the applied migrations
+    """
+    pending = pending_migrations(engine, target)
+    if pending and engine.dialect.name != 'postgresql':
+        raise RuntimeError('Migrations upgrade only PostgreSQL databases, create the tables of this database again')
+
+    schema_migrations.create(engine, checkfirst=True)
+    for migration in pending:
+        logger.info('Applying migration %s: %s.', migration.version, migration.name)
+        started = time.perf_counter()
+        if migration.transactional:
+            with engine.begin() as connection:
+                migration.upgrade(connection)
+                connection.execute(schema_migrations.insert(), version=migration.version, name=migration.name)
+        else:
+            with engine.connect() as connection:
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                migration.upgrade(connection)
+                connection.execute(schema_migrations.insert(), version=migration.version, name=migration.name)
+        logger.info('Migration %s applied in %.1f s.', migration.version, time.perf_counter() - started)
+    return pending
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Versioned migrations of the database schema')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('status', help='show the version of the schema and the pending migrations')
+    upgrade_parser = subparsers.add_parser('upgrade', help='apply the pending migrations')
+    upgrade_parser.add_argument('--to', type=int, default=LATEST_VERSION, help='version to upgrade to')
+    stamp_parser = subparsers.add_parser('stamp', help='mark the migrations as applied without running them')
+    stamp_parser.add_argument('version', type=int, nargs='?', default=LATEST_VERSION)
+    args = parser.parse_args()
+
+    if args.command not in ('status', 'upgrade', 'stamp'):
+        parser.print_help()
+        return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    engine = get_engine()
+    if args.command == 'status':
+        print(f'Schema version {current_version(engine)}, the latest is {LATEST_VERSION}.')
+        for migration in pending_migrations(engine):
+            print(f'Pending {migration.version}: {migration.name}')
+    elif args.command == 'upgrade':
+        applied = upgrade(engine, args.to)
+        print(f'Applied {len(applied)} migrations, schema version {current_version(engine)}.')
+    else:
+        stamp(engine, args.version)
+        print(f'Schema marked as version {args.version}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from telegram.error import RetryAfter, BadRequest, TimedOut, NetworkError, TelegramError
+
+from cache import LRUCache
+from rate_limit import TokenBucket, split_text
+
+
+logger = logging.getLogger(__name__)
+
+# a message waiting to be sent; queued_at is the time.monotonic() of the send() call,
+# send is None for a text message, otherwise the callable send(bot, chat_id, reply_markup) which sends the message
+OutgoingMessage = namedtuple('OutgoingMessage', ['chat_id', 'text', 'reply_markup', 'queued_at', 'attempt', 'send'])
+
+
+class Outbox:
+    """
+    Queue of the outgoing messages, sent by worker threads within the limits of Telegram:
+    `rate` messages per second in total and `chat_rate` messages per second to one chat.
+    The messages of a chat are sent in order, one at a time. On a flood-wait error (RetryAfter)
+    sending is paused for the requested time and the message is sent again.
+    """
+
+    # maximum length of a message text in Telegram
+    MAX_LENGTH = 4096
+
+    def __init__(self, bot, rate=30, burst=30, chat_rate=1, chat_burst=3, queue_size=10000, workers=4, retries=3):
+        """
+        :param burst: number of messages which can be sent at once before the rate limit applies
+        :param queue_size: maximum number of waiting messages, new messages are dropped when it is reached
+        :param retries: number of extra attempts after network errors and flood waits
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.queue_size = queue_size
+        self.workers = workers
+        self.retries = retries
+
+        self.bucket = TokenBucket(rate, burst)
+        # buckets of the chats which got messages recently
+        self.chat_buckets = LRUCache(maxsize=100000, ttl=max(60, chat_burst / chat_rate))
+        # waiting messages of every chat, and the heap of (time, sequence number, chat id) of the chats
+        # whose first message can be sent at the time; a chat is in the heap or being sent to, never both
+        self.chats = {}
+        self.ready = []
+        self.sequence = itertools.count()
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self._threads = []
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=1000)
+
+    def start(self):
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'outbox-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Sends the queued messages and stops the workers
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def send(self, chat_id, text, reply_markup=None):
+        """
+        Queues the message without blocking. Long texts are split into several messages,
+        the reply markup is attached to the last one.
+        :return: False if the message was dropped because the queue is full
+        """
+        chunks = split_text(text, self.MAX_LENGTH)
+        now = time.monotonic()
+        messages = [OutgoingMessage(chat_id, chunk, None, now, 0, None) for chunk in chunks]
+        messages[-1] = messages[-1]._replace(reply_markup=reply_markup)
+        return self._queue(chat_id, messages)
+
+    def send_media(self, chat_id, send, reply_markup=None):
+        """
+        Queues a message sent by the callable send(bot, chat_id, reply_markup), e.g. a media file of MediaSender,
+        in order with the other messages of the chat and within the same limits
+        :return: False if the message was dropped because the queue is full
+        """
+        return self._queue(chat_id, [OutgoingMessage(chat_id, None, reply_markup, time.monotonic(), 0, send)])
+
+    def _queue(self, chat_id, outgoing):
+        with self.condition:
+            if self.queued + len(outgoing) > self.queue_size:
+                self.dropped += len(outgoing)
+                logger.warning('Outgoing queue is full, a message to the chat %s was dropped.', chat_id)
+                return False
+
+            messages = self.chats.get(chat_id)
+            if messages is None:
+                messages = self.chats[chat_id] = deque()
+                self._schedule(chat_id, outgoing[0].queued_at)
+            messages.extend(outgoing)
+            self.queued += len(outgoing)
+            self._wake()
+        return True
+
+    def _wake(self):
+        self.condition.notify()
+
+    def _schedule(self, chat_id, now):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets.set(chat_id, bucket)
+        heapq.heappush(self.ready, (now + bucket.reserve(now), next(self.sequence), chat_id))
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while True:
+                    taken = self._take()
+                    if taken is not None:
+                        break
+                    if not self.running and not self.queued:
+                        return
+                    self.condition.wait(self._wait())
+
+            chat_id, message, delay = taken
+            if delay:
+                time.sleep(delay)
+            try:
+                if message.send is None:
+                    self.bot.send_message(message.chat_id, message.text, reply_markup=message.reply_markup)
+                else:
+                    message.send(self.bot, message.chat_id, message.reply_markup)
+                error = None
+            except Exception as e:
+                error = e
+            self._done(chat_id, message, error)
+
+    def _take(self):
+        """
+        Takes the first message of the chat which is due, must be called holding the condition
+        :return: (chat id, message, seconds to wait for the global rate limit), None if no message is due
+        """
+        now = time.monotonic()
+        if not self.ready or self.ready[0][0] > now or self.paused_until > now:
+            return None
+        chat_id = heapq.heappop(self.ready)[2]
+        return chat_id, self.chats[chat_id].popleft(), self.bucket.reserve(now)
+
+    def _wait(self):
+        """
+        :return: seconds until a message may be due, must be called holding the condition
+        """
+        now = time.monotonic()
+        wake = min(self.ready[0][0], now + 1) if self.ready else now + 1
+        return max(wake, self.paused_until) - now
+
+    def _done(self, chat_id, message, error):
+        """
+        Puts the message back to the queue of the chat if it has to be sent again and schedules the next one
+        :param error: the exception raised by the sending, None if the message was sent
+        """
+        retry, backoff = self._outcome(message, error)
+        with self.condition:
+            messages = self.chats[chat_id]
+            if retry is not None:
+                messages.appendleft(retry)
+            else:
+                self.queued -= 1
+            if messages:
+                self._schedule(chat_id, max(time.monotonic() + backoff, self.paused_until))
+            else:
+                del self.chats[chat_id]
+            self._wake()
+
+    def _outcome(self, message, error):
+        """
+        Counts the sent message or decides what to do after the error
+        :return: the message to send again, None if it was sent or given up, and the seconds to wait before
+                 the next message to the chat
+        """
+        if error is None:
+            with self.condition:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - message.queued_at)
+            return None, 0
+
+        if isinstance(error, RetryAfter):
+            logger.warning('Flood wait of %s s while sending to the chat %s.', error.retry_after, message.chat_id)
+            with self.condition:
+                self.paused_until = max(self.paused_until, time.monotonic() + error.retry_after)
+            return self._retry(message, error), 0
+        if isinstance(error, (TimedOut, NetworkError)) and not isinstance(error, BadRequest):
+            # BadRequest is a NetworkError in python-telegram-bot, but sending it again won't help
+            return self._retry(message, error), 2 ** message.attempt
+
+        if isinstance(error, TelegramError):
+            logger.warning('Message to the chat %s was not sent: %s', message.chat_id, error)
+        else:
+            # e.g. an error of the database in the callable of a media message, the worker keeps going
+            logger.error('Message to the chat %s was not sent.', message.chat_id, exc_info=error)
+        with self.condition:
+            self.failed += 1
+        return None, 0
+
+    def _retry(self, message, error):
+        with self.condition:
+            if message.attempt >= self.retries:
+                logger.warning('Message to the chat %s was not sent after %s attempts: %s',
+                               message.chat_id, message.attempt + 1, error)
+                self.failed += 1
+                return None
+            self.retried += 1
+        return message._replace(attempt=message.attempt + 1)
+
+    def stats(self):
+        """
+        :return: dictionary with the queue depth, the counters of sent, dropped, failed and retried messages
+                 and the delivery latency in seconds (median, 95th percentile, maximum) of the last 1000 messages
+        """
+        with self.condition:
+            latencies = sorted(self.latencies)
+            stats = {'queued': self.queued, 'chats': len(self.chats), 'sent': self.sent, 'dropped': self.dropped,
+                     'failed': self.failed, 'retried': self.retried}
+        if latencies:
+            stats.update(latency_median=latencies[len(latencies) // 2],
+                         latency_p95=latencies[int(len(latencies) * 0.95)],
+                         latency_max=latencies[-1])
+        return stats
+
+
+class AsyncOutbox(Outbox):
+    """
+    Outbox of the asyncio mode: the same queue and limits, the messages are sent by tasks on the event loop.
+    The client sends with coroutines, e.g. async_bot.TelegramClient, and the callables of the media messages
+    are coroutine functions. The queue is used only from the thread of the event loop.
+    """
+
+    def start(self):
+        self.running = True
+        self.wakeup = asyncio.Event()
+        self._threads = [asyncio.ensure_future(self._work()) for i in range(self.workers)]
+
+    async def stop(self):
+        """
+        Sends the queued messages and stops the workers
+        """
+        with self.condition:
+            self.running = False
+        self.wakeup.set()
+        await asyncio.gather(*self._threads)
+        self._threads = []
+
+    def _wake(self):
+        self.wakeup.set()
+
+    async def _work(self):
+        while True:
+            with self.condition:
+                taken = self._take()
+                if taken is None:
+                    if not self.running and not self.queued:
+                        return
+                    wait = self._wait()
+                    self.wakeup.clear()
+
+            if taken is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            chat_id, message, delay = taken
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                if message.send is None:
+                    await self.bot.send_message(message.chat_id, message.text, reply_markup=message.reply_markup)
+                else:
+                    await message.send(self.bot, message.chat_id, message.reply_markup)
+                error = None
+            except Exception as e:
+                error = e
+            self._done(chat_id, message, error)
@@ -0,0 +1,54 @@
+import time
+
+
+class TokenBucket:
+    """
+    Rate limit of `rate` messages per second with bursts of up to `capacity` messages.
+    Tokens are reserved in advance: the caller waits the returned delay and sends.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """
+        Takes a token
+        :return: seconds until the token is available
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+def split_text(text, limit=4096):
+    """
+    Splits a long text into chunks of at most `limit` characters at line breaks.
+    Lines longer than the limit are cut.
+    :return: list of chunks
+    """
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += '\n' + line
+        else:
+            chunks.append(current)
+            current = line
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,133 @@
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from webhook import SECRET_HEADER
+
+
+def read_updates(filename):
+    """
+    Reads recorded updates from a JSON array or a JSON Lines file
+    :return: generator of update dictionaries
+    """
+    with open(filename, encoding='utf-8') as file:
+        first = file.read(1)
+        file.seek(0)
+        if first == '[':
+            yield from json.load(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def batches(updates, size, repeat=1, renumber=False):
+    """
+    Splits the updates into batches. With renumber every update gets a new update_id,
+    so the repeated updates are not taken for duplicates.
+    """
+    batch = []
+    update_id = 1
+    for _ in range(repeat):
+        for update in updates:
+            if renumber:
+                update = dict(update, update_id=update_id)
+                update_id += 1
+            batch.append(update)
+            if len(batch) == size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class Replayer:
+    """
+    Posts recorded updates to the webhook of a locally running bot and measures the throughput
+    """
+
+    def __init__(self, url, secret=None, timeout=10):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.refused = 0
+        self.failed = 0
+
+    def post(self, batch):
+        data = json.dumps(batch if len(batch) > 1 else batch[0]).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.secret:
+            headers[SECRET_HEADER] = self.secret
+
+        while True:
+            request = urllib.request.Request(self.url, data=data, headers=headers, method='POST')
+            try:
+                urllib.request.urlopen(request, timeout=self.timeout).close()
+                with self.lock:
+                    self.sent += len(batch)
+                return
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    with self.lock:
+                        self.failed += len(batch)
+                    return
+                # the queue of the bot is full, retry like Telegram does
+                with self.lock:
+                    self.refused += 1
+                time.sleep(float(e.headers.get('Retry-After', 1)))
+            except OSError:
+                with self.lock:
+                    self.failed += len(batch)
+                return
+
+    def run(self, batch_iterator, concurrency=4):
+        """
+        Sends the batches from several threads
+        :return: elapsed seconds
+        """
+        lock = threading.Lock()
+
+        def work():
+            while True:
+                with lock:
+                    batch = next(batch_iterator, None)
+                if batch is None:
+                    return
+                self.post(batch)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=work) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded Telegram updates to the local webhook')
+    parser.add_argument('filename', help='JSON array or JSON Lines file with recorded updates')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram', help='webhook URL of the bot')
+    parser.add_argument('--secret', help='webhook secret token')
+    parser.add_argument('--batch', type=int, default=1, help='updates per request')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of parallel requests')
+    parser.add_argument('--repeat', type=int, default=1, help='how many times to send the recorded updates')
+    parser.add_argument('--renumber', action='store_true', help='give every sent update a new update_id')
+    args = parser.parse_args()
+
+    updates = list(read_updates(args.filename))
+    replayer = Replayer(args.url, secret=args.secret)
+    elapsed = replayer.run(batches(updates, args.batch, args.repeat, args.renumber), args.concurrency)
+
+    rate = replayer.sent / elapsed if elapsed else 0
+    print(f'Sent {replayer.sent} updates in {elapsed:.2f} s ({rate:.1f} updates/s), '
+          f'{replayer.refused} refusals (queue full), {replayer.failed} failed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from telegram import Bot as TelegramBot
+from telegram.error import TelegramError
+
+from config import get_settings
+from webhook import WebhookServer
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_shard(index, updates):
+    """
+    Entry point of a worker process. The bot is imported in the worker, so every shard has
+    its own updater, dispatcher threads, database engines and caches.
+    """
+    logging.basicConfig(format=f'%(asctime)s - shard {index} - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    from bot import Bot
+    Bot().serve_shard(updates)
+
+
+# fields of an update holding its content, one of them is set
+UPDATE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query',
+                 'inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query')
+
+
+def shard_key(update):
+    """
+    The sessions are stored per user, so all updates of a user go to the same worker, whatever the chat:
+    a user talking to the bot in a private chat and in a group doesn't have the session cached by two workers.
+    :param update: update dictionary as sent by Telegram
+    :return: id of the user who sent the update, or of the chat if there is no user, e.g. for channel posts
+    """
+    for field in UPDATE_FIELDS:
+        content = update.get(field)
+        if content:
+            if content.get('from'):
+                return content['from']['id']
+            if content.get('chat'):
+                return content['chat']['id']
+    return update.get('update_id', 0)
+
+
+class ShardRouter:
+    """
+    Distributes the updates between worker processes by user id, see shard_key. All updates of a user go to
+    the same worker, in order, so a conversation or a session is never handled by two processes at once.
+    Each worker has a bounded queue; the router refuses updates when the queue of their worker is full.
+    """
+
+    def __init__(self, shards=2, queue_size=1000, check_interval=1):
+        """
+        :param queue_size: maximum number of updates waiting for a worker
+        :param check_interval: seconds between the checks of the worker processes
+        """
+        # workers are started clean instead of forking the threads and database connections of the router
+        self.context = multiprocessing.get_context('spawn')
+        self.shards = shards
+        self.queue_size = queue_size
+        self.check_interval = check_interval
+        self.queues = [self.context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.workers = [None] * shards
+        self.restarting = set()
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.shards):
+            self._spawn(index)
+        threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True).start()
+
+    def stop(self):
+        """
+        Lets the workers handle the queued updates and stops them
+        """
+        self.running = False
+        with self.lock:
+            for updates in self.queues:
+                updates.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def route(self, updates, block=False):
+        """
+        Queues the updates to their workers. Can be used as the sink of WebhookServer.
+        :param updates: list of update dictionaries
+        :param block: wait for free space in the queues instead of refusing the updates
+        :return: False if the updates were refused
+        """
+        by_shard = {}
+        for update in updates:
+            by_shard.setdefault(shard_key(update) % self.shards, []).append(update)
+
+        with self.lock:
+            # the updates are accepted or refused as a whole, otherwise the retry of the sender would duplicate some
+            if not block and any(self.queues[index].qsize() + len(batch) > self.queue_size
+                                 for index, batch in by_shard.items()):
+                return False
+            for index, batch in by_shard.items():
+                for update in batch:
+                    self.queues[index].put(update)
+        return True
+
+    def restart_worker(self, index):
+        """
+        Restarts the worker after it has handled the updates queued before the restart.
+        The new updates of the shard wait in the queue meanwhile.
+        """
+        with self.lock:
+            self.restarting.add(index)
+            self.queues[index].put(None)
+        try:
+            self.workers[index].join()
+            self._spawn(index)
+        finally:
+            self.restarting.discard(index)
+
+    def rolling_restart(self):
+        """
+        Restarts the workers one by one, e.g. to deploy a new version of the bot without downtime
+        """
+        logger.info('Rolling restart of %s workers.', self.shards)
+        for index in range(self.shards):
+            if not self.running:
+                break
+            self.restart_worker(index)
+        logger.info('Rolling restart finished.')
+
+    def stats(self):
+        """
+        :return: list of dictionaries with the queue depth and the process id of each worker
+        """
+        return [{'shard': index, 'queued': self.queues[index].qsize(), 'pid': worker.pid, 'alive': worker.is_alive()}
+                for index, worker in enumerate(self.workers)]
+
+    def _spawn(self, index):
+        worker = self.context.Process(target=run_shard, args=(index, self.queues[index]), name=f'shard-{index}')
+        worker.start()
+        self.workers[index] = worker
+        logger.info('Started worker %s with pid %s.', index, worker.pid)
+
+    def _supervise(self):
+        while self.running:
+            time.sleep(self.check_interval)
+            for index, worker in enumerate(self.workers):
+                if self.running and index not in self.restarting and not worker.is_alive():
+                    logger.error('Worker %s exited with code %s, starting it again.', index, worker.exitcode)
+                    self._spawn(index)
+
+
+def poll(bot, router, stop, timeout=30):
+    """
+    Front end without the webhook: receives the updates by long polling and routes them to the workers.
+    Blocks while the queue of a worker is full, so Telegram keeps the updates until the workers catch up.
+    """
+    bot.delete_webhook()
+    offset = None
+    while not stop.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout)
+        except TelegramError as e:
+            logger.warning('Getting updates failed: %s', e)
+            time.sleep(1)
+            continue
+
+        if updates:
+            router.route([update.to_dict() for update in updates], block=True)
+            offset = updates[-1].update_id + 1
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    settings = get_settings()
+    if settings.state.backend == 'memory':
+        logger.warning('Conversation states are kept in memory, they are lost when a worker is restarted.')
+
+    router = ShardRouter(shards=settings.workers.shards, queue_size=settings.router.queue_size)
+    router.start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=router.rolling_restart,
+                                                                        name='rolling-restart').start())
+
+    bot = TelegramBot(settings.bot.token)
+    webhook = settings.webhook
+    if settings.router.front == 'webhook':
+        server = WebhookServer(router.route, listen=webhook.listen, port=webhook.port, path=webhook.path,
+                               secret=webhook.secret)
+        front = threading.Thread(target=server.serve_forever, name='webhook')
+        front.start()
+        if webhook.url:
+            bot.set_webhook(url=webhook.url, max_connections=webhook.max_connections, secret_token=webhook.secret)
+    else:
+        server = None
+        front = threading.Thread(target=poll, args=(bot, router, stop), name='polling')
+        front.start()
+
+    logger.info('Routing updates to %s workers.', router.shards)
+    while not stop.wait(1):
+        pass
+
+    if server:
+        server.shutdown()
+    front.join()
+    router.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+import json
+import logging
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import MutableMapping
+
+from sqlalchemy import Column, String, Integer, BigInteger, LargeBinary, MetaData, Table, select
+from sqlalchemy.dialects import postgresql
+
+from cache import LRUCache
+from database import SQLAlchemyDBConnection, get_engine
+
+
+logger = logging.getLogger(__name__)
+
+# marks a conversation whose state is not cached, the cached state None marks an ended one
+_MISSING = object()
+
+metadata = MetaData()
+
+conversations_table = Table(
+    'bot_conversations', metadata,
+    Column('name', String(64), primary_key=True),
+    Column('key', String(64), primary_key=True),
+    Column('state', Integer, nullable=False),
+)
+
+user_data_table = Table(
+    'bot_user_data', metadata,
+    Column('user_id', BigInteger, primary_key=True),
+    Column('data', LargeBinary, nullable=False),
+)
+
+
+# the list of terms shown to the user: ids of the terms in the order of their numbers, sort keys of the first
+# and the last term to turn the pages, and the number of the terms on the pages before this one
+TermList = namedtuple('TermList', ['ids', 'first', 'last', 'offset', 'has_prev', 'has_next'])
+
+
+class Session:
+    """
+    user_data of a user: only the key of the locale and the ids of the terms, never the terms or the keyboards,
+    so a session takes a few hundred bytes whatever the user does
+    """
+    __slots__ = ('locale', 'term_id', 'term_list')
+
+    def __init__(self, locale=None, term_id=None, term_list=None):
+        self.locale = locale
+        self.term_id = term_id
+        self.term_list = term_list
+
+    def as_dict(self):
+        """
+        :return: dictionary of the fields which are set, term_list as a dictionary too
+        """
+        data = {}
+        if self.locale is not None:
+            data['locale'] = self.locale
+        if self.term_id is not None:
+            data['term_id'] = self.term_id
+        if self.term_list is not None:
+            data['page'] = self.term_list._asdict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Reads the session from as_dict(), the unknown keys are dropped
+        """
+        page = data.get('page')
+        term_list = TermList(**dict(page, ids=tuple(page['ids']))) if page else None
+        return cls(data.get('locale'), data.get('term_id'), term_list)
+
+    def size(self):
+        """
+        :return: bytes taken by the session object and its values
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.locale) + sys.getsizeof(self.term_id)
+        if self.term_list is not None:
+            size += sys.getsizeof(self.term_list) + sum(sys.getsizeof(value) for value in self.term_list)
+            size += sum(sys.getsizeof(term_id) for term_id in self.term_list.ids)
+        return size
+
+
+def dumps(data):
+    """
+    Compact serialization of user_data: JSON without spaces, as bytes
+    """
+    if isinstance(data, Session):
+        data = data.as_dict()
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def loads(raw):
+    return json.loads(raw.decode('utf-8'))
+
+
+def conversation_key(key):
+    """
+    Converts a ConversationHandler key, a tuple of chat and user ids, to a string
+    """
+    return ':'.join(str(part) for part in key)
+
+
+class MemoryStateStore:
+    """
+    Keeps conversation states and user_data in process memory. Nothing survives a restart.
+    At most max_sessions of each are kept, the least recently used ones are forgotten.
+    """
+
+    def __init__(self, max_sessions=10000):
+        self.conversations = LRUCache(maxsize=max_sessions)
+        self.user_data = LRUCache(maxsize=max_sessions)
+
+    def load_conversation(self, name, key):
+        return self.conversations.get((name, key))
+
+    def save_conversation(self, name, key, state):
+        self.conversations.set((name, key), state)
+
+    def delete_conversation(self, name, key):
+        self.conversations.pop((name, key))
+
+    def load_user_data(self, user_id):
+        raw = self.user_data.get(user_id)
+        return loads(raw) if raw is not None else None
+
+    def save_user_data(self, user_id, raw):
+        self.user_data.set(user_id, raw)
+
+    def delete_user_data(self, user_id):
+        self.user_data.pop(user_id)
+
+
+class SQLStateStore:
+    """
+    Keeps conversation states and user_data in SQL tables, shared by all bot processes.
+    Works with PostgreSQL and SQLite.
+    """
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+        metadata.create_all(get_engine(connection_string))
+
+    def _upsert(self, session, table, values, keys):
+        if session.bind.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(values)
+            statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={column: statement.excluded[column] for column in values if column not in keys})
+        else:
+            statement = table.insert().prefix_with('OR REPLACE').values(values)
+        session.execute(statement)
+
+    def load_conversation(self, name, key):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            return db.session.execute(
+                select([conversations_table.c.state])
+                .where(conversations_table.c.name == name)
+                .where(conversations_table.c.key == key)).scalar()
+
+    def save_conversation(self, name, key, state):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            self._upsert(db.session, conversations_table, {'name': name, 'key': key, 'state': state}, ['name', 'key'])
+            db.session.commit()
+
+    def delete_conversation(self, name, key):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            db.session.execute(conversations_table.delete()
+                               .where(conversations_table.c.name == name)
+                               .where(conversations_table.c.key == key))
+            db.session.commit()
+
+    def load_user_data(self, user_id):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            raw = db.session.execute(
+                select([user_data_table.c.data]).where(user_data_table.c.user_id == user_id)).scalar()
+        return loads(raw) if raw is not None else None
+
+    def save_user_data(self, user_id, raw):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            self._upsert(db.session, user_data_table, {'user_id': user_id, 'data': raw}, ['user_id'])
+            db.session.commit()
+
+    def delete_user_data(self, user_id):
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            db.session.execute(user_data_table.delete().where(user_data_table.c.user_id == user_id))
+            db.session.commit()
+
+
+def create_state_store(backend, connection_string=None, sqlite_path='data/state.db', max_sessions=10000):
+    """
+    :param backend: 'memory', 'sqlite' or 'postgresql'
+    :param connection_string: database of the 'postgresql' backend, None for the database of config.ini
+    :param max_sessions: number of the sessions the 'memory' backend keeps
+    """
+    if backend == 'memory':
+        return MemoryStateStore(max_sessions)
+    if backend == 'sqlite':
+        return SQLStateStore(f'sqlite:///{sqlite_path}')
+    if backend == 'postgresql':
+        return SQLStateStore(connection_string)
+    raise ValueError(f'Unknown state backend "{backend}"')
+
+
+class PersistentConversations(MutableMapping):
+    """
+    Replacement of ConversationHandler.conversations that writes the states through to the store.
+    States are cached in the process: with sharded routing a conversation is handled by one process only,
+    and after a restart the states are read back from the store. At most max_sessions states are cached,
+    the least recently used ones are read from the store again when needed.
+    """
+
+    def __init__(self, store, name='terms', max_sessions=10000, on_end=None):
+        """
+        :param on_end: callback on_end(key) called when a conversation ends, by the user or by the timeout
+        """
+        self.store = store
+        self.name = name
+        self.max_sessions = max_sessions
+        self.on_end = on_end
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _keep(self, key, state):
+        self._cache[key] = state
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_sessions:
+            self._cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        with self._lock:
+            state = self._cache.get(key, _MISSING)
+            if state is not _MISSING:
+                self._cache.move_to_end(key)
+        if state is _MISSING:
+            # the store is read without holding the lock, so the lookups of other chats aren't blocked by it
+            loaded = self.store.load_conversation(self.name, conversation_key(key))
+            with self._lock:
+                # a state written or read by another thread meanwhile is newer than the loaded one
+                state = self._cache.setdefault(key, loaded)
+                self._keep(key, state)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        # promises of run_async handlers can't be stored, they are kept only in memory
+        if isinstance(state, int):
+            self.store.save_conversation(self.name, conversation_key(key), state)
+        with self._lock:
+            self._keep(key, state)
+
+    def __delitem__(self, key):
+        self.store.delete_conversation(self.name, conversation_key(key))
+        with self._lock:
+            self._keep(key, None)
+        if self.on_end is not None:
+            self.on_end(key)
+
+    def __iter__(self):
+        with self._lock:
+            return iter([key for key, state in self._cache.items() if state is not None])
+
+    def __len__(self):
+        with self._lock:
+            return sum(1 for state in self._cache.values() if state is not None)
+
+    def evict(self, key):
+        """
+        Forgets the cached state, it is read from the store on the next update
+        """
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def user_active(self, user_id):
+        """
+        :return: True if the user has another conversation in progress among the cached states
+        """
+        with self._lock:
+            return any(state is not None and key[1] == user_id for key, state in self._cache.items())
+
+
+class PersistentUserData(MutableMapping):
+    """
+    Replacement of Dispatcher.user_data holding a Session per user. A session is read from the store
+    on first access and written back by flush() after the update is handled, only if it has changed.
+    At most max_sessions sessions are kept in memory: the least recently used one is saved and forgotten
+    when another one is read, so the memory doesn't grow with the number of users.
+    """
+
+    def __init__(self, store, max_sessions=10000):
+        self.store = store
+        self.max_sessions = max_sessions
+        # sessions in the order of use, and their serialized form as it is in the store
+        self._data = OrderedDict()
+        self._saved = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, user_id):
+        with self._lock:
+            session = self._data.get(user_id)
+            if session is not None:
+                self._data.move_to_end(user_id)
+                return session
+
+        # the store is read without holding the lock, so other users' updates aren't blocked by it
+        loaded = Session.from_dict(self.store.load_user_data(user_id) or {})
+        evicted = []
+        with self._lock:
+            # another thread may have read the session meanwhile, its copy is kept
+            session = self._data.setdefault(user_id, loaded)
+            self._data.move_to_end(user_id)
+            if session is loaded:
+                self._saved[user_id] = dumps(session)
+            while len(self._data) > self.max_sessions:
+                evicted.append(self._data.popitem(last=False))
+        # the evicted sessions are written without holding the lock
+        for evicted_id, evicted_session in evicted:
+            self._save(evicted_id, evicted_session, self._saved.pop(evicted_id, None))
+        return session
+
+    def __setitem__(self, user_id, session):
+        with self._lock:
+            self._data[user_id] = session
+
+    def __delitem__(self, user_id):
+        self.store.delete_user_data(user_id)
+        with self._lock:
+            self._data.pop(user_id, None)
+            self._saved.pop(user_id, None)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def _save(self, user_id, session, saved):
+        raw = dumps(session)
+        if raw != saved:
+            self.store.save_user_data(user_id, raw)
+        return raw
+
+    def flush(self, user_id):
+        """
+        Saves the user's session if it has changed since it was loaded or saved
+        """
+        with self._lock:
+            session = self._data.get(user_id)
+            if session is None:
+                return
+            saved = self._saved.get(user_id)
+        raw = self._save(user_id, session, saved)
+        with self._lock:
+            if user_id in self._data:
+                self._saved[user_id] = raw
+
+    def evict(self, user_id):
+        """
+        Saves and forgets the user's session, it is read from the store on the next update
+        """
+        self.flush(user_id)
+        with self._lock:
+            self._data.pop(user_id, None)
+            self._saved.pop(user_id, None)
+
+    def expire(self, user_id):
+        """
+        Forgets the session of a finished conversation and deletes it from the store
+        """
+        del self[user_id]
+
+    def memory_report(self):
+        """
+        :return: dictionary with the number of sessions in memory, the bytes they take with their serialized copies
+                 and the bytes per session
+        """
+        with self._lock:
+            sessions = list(self._data.values())
+            saved = list(self._saved.values())
+        size = sum(session.size() for session in sessions) + sum(sys.getsizeof(raw) for raw in saved)
+        return {'sessions': len(sessions), 'max_sessions': self.max_sessions, 'bytes': size,
+                'bytes_per_session': size / len(sessions) if sessions else 0}
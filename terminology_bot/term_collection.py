@@ -1,56 +1,479 @@
-from database import (SQLAlchemyDBConnection, Term, Synonyms, Similars, db_string)
-from sqlalchemy import exists
+import bisect
+import json
+import threading
+import uuid
+from collections import namedtuple, OrderedDict
+
+from cache import LRUCache, InvalidationListener
+from config import get_settings
+from database import (SQLAlchemyDBConnection, Term, Synonyms, Similars, MediaBlob, get_engine, insert_ignore,
+                      TERM_DOCUMENT, get_router, read)
+from sqlalchemy import text, select, func, bindparam, String
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import joinedload, load_only
+
+
+# one page of the term list: (id, name) pairs and whether there are pages before and after it
+TermPage = namedtuple('TermPage', ['terms', 'has_prev', 'has_next'])
+# everything the /show view tells about a term; media is a dictionary {'image'/'audio'/'video': MediaRef},
+# synonyms and similars are lists of (id, name) pairs ordered by name
+TermProfile = namedtuple('TermProfile', ['id', 'name', 'pos_tag', 'description', 'media', 'synonyms', 'similars'])
+# media file of a term: key of the blob in the media store and its Telegram file id, None if it is unknown
+MediaRef = namedtuple('MediaRef', ['key', 'file_id'])
+
+# number of term ids in one cache invalidation, the payload of a NOTIFY is limited to 8000 bytes
+NOTIFY_CHUNK = 500
+
+# the hot lookups are baked: the queries are built and compiled to SQL once per process,
+# later calls only bind the parameters
+bakery = baked.bakery()
+
+TERM_QUERY = bakery(lambda session: session.query(Term))
+TERM_QUERY += lambda query: query.filter(Term.id == bindparam('term_id'))
+
+# the term, its media blobs and both lists of the linked terms as one statement with joins
+PROFILE_QUERY = bakery(lambda session: session.query(Term).options(
+    joinedload(Term.synonyms).load_only('id', 'name'),
+    joinedload(Term.similars).load_only('id', 'name'),
+    joinedload(Term.image_blob).load_only('key', 'file_id'),
+    joinedload(Term.audiofile_blob).load_only('key', 'file_id'),
+    joinedload(Term.videofile_blob).load_only('key', 'file_id')))
+PROFILE_QUERY += lambda query: query.filter(Term.id == bindparam('term_id'))
+
+NEIGHBOURS_QUERY = bakery(lambda session: session.query(Term).options(
+    load_only('id'),
+    joinedload(Term.synonyms).load_only('id', 'name'),
+    joinedload(Term.similars).load_only('id', 'name')))
+NEIGHBOURS_QUERY += lambda query: query.filter(Term.id == bindparam('term_id'))
+
+MEDIA_BLOB_QUERY = bakery(lambda session: session.query(MediaBlob.file_id, MediaBlob.extension))
+MEDIA_BLOB_QUERY += lambda query: query.filter(MediaBlob.key == bindparam('key'))
+
+
+class PrefixIndex:
+    """
+    Sorted in-process index of the term names for the prefix search on databases without trigram indexes.
+    It is built on the first search and rebuilt after new terms were added.
+    """
+
+    def __init__(self):
+        self._names = []
+        self._ids = []
+        self._lock = threading.Lock()
+        self.stale = True
+
+    def build(self, terms):
+        """
+        :param terms: iterable of (id, name) pairs
+        """
+        terms = sorted(terms, key=lambda term: term[1])
+        with self._lock:
+            self._ids = [term[0] for term in terms]
+            self._names = [term[1] for term in terms]
+            self.stale = False
+
+    def invalidate(self):
+        self.stale = True
+
+    def search(self, prefix, limit=10):
+        """
+        :return: list of (id, name) pairs of the terms starting with the prefix, in alphabetical order
+        """
+        with self._lock:
+            names, ids = self._names, self._ids
+        found = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and len(found) < limit and names[i].startswith(prefix):
+            found.append((ids[i], names[i]))
+            i += 1
+        return found
 
 
 class TermCollection:
+    ORDER_COLUMNS = {'name': Term.name, 'id': Term.id}
+    LINK_TABLES = {'syn': (Synonyms, 'synonym_id'), 'sim': (Similars, 'similar_word_id')}
+    UPDATABLE_COLUMNS = frozenset(['pos_tag', 'description', 'image', 'audiofile', 'videofile'])
+    MEDIA_COLUMNS = frozenset(['image', 'audiofile', 'videofile'])
+    # kind of media: column of the Term
+    MEDIA_KINDS = {'image': 'image', 'audio': 'audiofile', 'video': 'videofile'}
+
+    # trigram similarity and full-text rank of the terms, uses the indexes created in database.py
+    SEARCH_SQL = text(f"""
+        SELECT id, name,
+               greatest(similarity(name, :query),
+                        ts_rank({TERM_DOCUMENT}, plainto_tsquery('simple', :query))) AS rank
+        FROM terms
+        WHERE name % :query
+           OR name LIKE :prefix
+           OR {TERM_DOCUMENT} @@ plainto_tsquery('simple', :query)
+        ORDER BY name LIKE :prefix DESC, rank DESC, name
+        LIMIT :limit
+    """)
+
     def __init__(self):
-        self.terms = []
+        cache_settings = get_settings().cache
+        self.terms_cache = LRUCache(maxsize=cache_settings.term_cache_size, ttl=cache_settings.ttl)
+        self.pages_cache = LRUCache(maxsize=cache_settings.page_cache_size, ttl=cache_settings.ttl)
+        self.neighbours_cache = LRUCache(maxsize=cache_settings.neighbour_cache_size,
+                                         ttl=cache_settings.ttl)
+        self.prefix_index = PrefixIndex()
+        # terms (and 'pages' for the term list) changed less than read_your_writes seconds ago: the replicas may
+        # not have replayed the change yet, so they are read from the primary and no stale row gets cached
+        pin_seconds = get_settings().replicas.pin_seconds
+        self.changed = LRUCache(maxsize=100000, ttl=pin_seconds) if pin_seconds else None
+
+        # invalidations sent by this instance are already applied, the listener skips them
+        self.origin = uuid.uuid4().hex
+        self.notify_channel = cache_settings.notify_channel
+        self.listener = None
+
+    def cache_stats(self):
+        """
+        :return: dictionary with hit/miss/eviction counters of every cache
+        """
+        return {'terms': self.terms_cache.stats(),
+                'pages': self.pages_cache.stats(),
+                'neighbours': self.neighbours_cache.stats()}
+
+    def invalidate(self, term_ids=(), pages=False):
+        """
+        Drops the cached terms and their neighbourhoods, and optionally all cached pages of the term list
+        """
+        for term_id in term_ids:
+            self.terms_cache.pop(term_id)
+            self.neighbours_cache.pop(term_id)
+            if self.changed is not None:
+                self.changed.set(term_id, True)
+        if pages:
+            self.pages_cache.clear()
+            self.prefix_index.invalidate()
+            if self.changed is not None:
+                self.changed.set('pages', True)
+
+    def clear_caches(self):
+        """
+        Drops everything cached, e.g. when invalidations of other processes may have been missed
+        """
+        self.terms_cache.clear()
+        self.neighbours_cache.clear()
+        self.pages_cache.clear()
+        self.prefix_index.invalidate()
+
+    def _recently_changed(self, key):
+        """
+        :param key: id of a term or 'pages'
+        :return: True if the reads of the key must go to the primary database
+        """
+        return self.changed is not None and self.changed.get(key, False)
+
+    def listen_for_invalidations(self):
+        """
+        Starts applying the invalidations of other bot processes sent to the PostgreSQL NOTIFY channel
+        set by notify_channel in the [cache] section of config.ini
+        """
+        engine = get_engine()
+        if self.notify_channel and engine.dialect.name == 'postgresql' and self.listener is None:
+            self.listener = InvalidationListener(engine, self.notify_channel, self._on_invalidation,
+                                                 on_connect=self.clear_caches)
+            self.listener.start()
+
+    def _on_invalidation(self, payload):
+        if payload.get('origin') != self.origin:
+            self.invalidate(payload.get('terms', ()), payload.get('pages', False))
+
+    def _write_done(self, session, term_ids=(), pages=False):
+        """
+        Commits the write, invalidates the local caches and notifies the other bot processes.
+        The notification is sent in the same transaction, so it is delivered only if the write is committed.
+        The ids are sent in chunks, as the payload of a notification is limited to 8000 bytes.
+        """
+        term_ids = list(term_ids)
+        if self.notify_channel and session.bind.dialect.name == 'postgresql':
+            for i in range(0, max(len(term_ids), 1), NOTIFY_CHUNK):
+                payload = json.dumps({'origin': self.origin, 'terms': term_ids[i:i + NOTIFY_CHUNK],
+                                      'pages': pages and i == 0})
+                session.execute(text('SELECT pg_notify(:channel, :payload)'),
+                                {'channel': self.notify_channel, 'payload': payload})
+        session.commit()
+        get_router().written()
+        self.invalidate(term_ids, pages)
 
-    def get_terms(self):
-        with SQLAlchemyDBConnection(db_string) as db:
-            terms = db.session.query(Term).all()
-        return terms
+    def get_terms(self, after=None, before=None, limit=20, order_by='name'):
+        """
+        Fetches (id, name) pairs of the terms using keyset pagination.
+        :param after: the sort key of the last term of the current page, to get the next page
+        :param before: the sort key of the first term of the current page, to get the previous page
+        :param order_by: 'name' or 'id'
+        :return: list of (id, name) tuples in ascending order
+        """
+        column = self.ORDER_COLUMNS[order_by]
+
+        def load(session):
+            query = session.query(Term.id, Term.name)
+            if before is not None:
+                terms = query.filter(column < before).order_by(column.desc()).limit(limit).all()
+                terms.reverse()
+            else:
+                if after is not None:
+                    query = query.filter(column > after)
+                terms = query.order_by(column).limit(limit).all()
+            return [tuple(term) for term in terms]
+
+        return self.pages_cache.get_or_load((after, before, limit, order_by),
+                                            lambda: read(load, primary=self._recently_changed('pages')))
+
+    def get_page(self, after=None, before=None, limit=20, order_by='name'):
+        """
+        Fetches one page of the term list. One extra row is requested to find out whether the list goes on.
+        :return: TermPage
+        """
+        terms = self.get_terms(after=after, before=before, limit=limit + 1, order_by=order_by)
+        more = len(terms) > limit
+
+        if before is not None:
+            return TermPage(terms[-limit:] if more else terms, has_prev=more, has_next=True)
+        return TermPage(terms[:limit], has_prev=after is not None, has_next=more)
+
+    def search(self, query, limit=10):
+        """
+        Finds terms by a part of the name or the description.
+        PostgreSQL ranks the terms by trigram similarity and full-text rank,
+        other databases use the in-process prefix index and a substring match.
+        :return: list of (id, name) pairs, the best matches first
+        """
+        query = ' '.join(query.lower().split())
+        if not query:
+            return []
+
+        if get_engine().dialect.name == 'postgresql':
+            return self._search_postgresql(query, limit)
+        return self._search_prefix(query, limit)
+
+    def _search_postgresql(self, query, limit):
+        prefix = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        def load(session):
+            rows = session.execute(self.SEARCH_SQL, {'query': query, 'prefix': prefix, 'limit': limit})
+            return [(row.id, row.name) for row in rows]
+
+        return read(load, primary=self._recently_changed('pages'))
+
+    def _search_prefix(self, query, limit):
+        primary = self._recently_changed('pages')
+        if self.prefix_index.stale:
+            self.prefix_index.build(read(lambda session: session.query(Term.id, Term.name).all(), primary))
+
+        found = self.prefix_index.search(query, limit)
+        if len(found) < limit:
+            found_ids = {term[0] for term in found}
+            rows = read(lambda session: session.query(Term.id, Term.name).filter(Term.name.contains(query))
+                        .order_by(Term.name).limit(limit + len(found)).all(), primary)
+            found.extend((row.id, row.name) for row in rows if row.id not in found_ids)
+        return found[:limit]
 
     def get(self, term_id):
-        with SQLAlchemyDBConnection(db_string) as db:
-            term = db.session.query(Term).filter(Term.id == term_id).first()
-        return term
+        """
+        :return: the term, read through the cache. The instance is shared, it must not be modified
+        """
+        def load(session):
+            return TERM_QUERY(session).params(term_id=term_id).first()
+
+        return self.terms_cache.get_or_load(term_id,
+                                            lambda: read(load, primary=self._recently_changed(term_id)))
+
+    def profile(self, term_id):
+        """
+        Reads the term with its media and the terms linked with it in one query
+        :return: TermProfile, None if there is no such term
+        """
+        def load(session):
+            term = PROFILE_QUERY(session).params(term_id=term_id).one_or_none()
+            if term is None:
+                return None
+
+            media = {}
+            for kind, column in self.MEDIA_KINDS.items():
+                key = term[column]
+                if key:
+                    blob = term[f'{column}_blob']
+                    media[kind] = MediaRef(key, blob.file_id if blob is not None else None)
+
+            return TermProfile(id=term.id, name=term.name, pos_tag=term.pos_tag, description=term.description,
+                               media=media,
+                               synonyms=[(linked.id, linked.name) for linked in term.synonyms],
+                               similars=[(linked.id, linked.name) for linked in term.similars])
+
+        return read(load, primary=self._recently_changed(term_id))
+
+    def get_neighbours(self, term_id):
+        """
+        :return: dictionary {'syn': [(id, name), ...], 'sim': [(id, name), ...]} of the words linked to the term
+        """
+        def load(session):
+            term = NEIGHBOURS_QUERY(session).params(term_id=term_id).one_or_none()
+            if term is None:
+                return {'syn': [], 'sim': []}
+            return {'syn': [(linked.id, linked.name) for linked in term.synonyms],
+                    'sim': [(linked.id, linked.name) for linked in term.similars]}
+
+        return self.neighbours_cache.get_or_load(term_id,
+                                                 lambda: read(load, primary=self._recently_changed(term_id)))
 
     def create(self, term_name):
-        term_name = term_name.lower()
+        """
+        Adds the term unless a term with this name exists, in one statement without a race between workers
+        :return: id of the new term, None if the term already existed
+        """
+        names = self.normalize_words([term_name])
+        if not names:
+            return None
+
+        with SQLAlchemyDBConnection() as db:
+            if db.session.bind.dialect.name == 'postgresql':
+                statement = postgresql.insert(Term.__table__).values(name=names[0])\
+                    .on_conflict_do_nothing(index_elements=['name'])\
+                    .returning(Term.id)
+                term_id = db.session.execute(statement).scalar()
+            else:
+                result = db.session.execute(insert_ignore(db.session, Term.__table__).values(name=names[0]))
+                term_id = result.inserted_primary_key[0] if result.rowcount else None
 
-        with SQLAlchemyDBConnection(db_string) as db:
-            term_exists = db.session.query(exists().where(Term.name == term_name)).scalar()
-            if not term_exists:
-                db.session.add(Term(name=term_name))
-                db.session.commit()
+            if term_id is None:
+                db.session.rollback()
+            else:
+                self._write_done(db.session, pages=True)
+        return term_id
 
     def update(self, term_id, dictionary):
-        with SQLAlchemyDBConnection(db_string) as db:
-            term = db.session.query(Term).filter(Term.id == term_id).first()
+        """
+        Updates the columns of the term with one UPDATE statement
+        :param dictionary: {column: value}, only the columns from UPDATABLE_COLUMNS are allowed
+        :return: number of updated rows
+        """
+        unknown = set(dictionary) - self.UPDATABLE_COLUMNS
+        if unknown:
+            raise ValueError(f'Columns {", ".join(sorted(unknown))} of the term can\'t be updated')
+
+        with SQLAlchemyDBConnection() as db:
+            result = db.session.execute(Term.__table__.update().where(Term.id == term_id).values(**dictionary))
+            self._write_done(db.session, term_ids=[term_id])
+        return result.rowcount
 
-            for key, val in dictionary.items():
-                term[key] = val
+    def set_media(self, term_id, column, key, size, extension=None, file_id=None, file_unique_id=None):
+        """
+        Points the media column of the term to the blob of the media store and moves the reference
+        from the previous blob of the column to the new one in the same transaction
+        :param column: 'image', 'audiofile' or 'videofile'
+        :param extension: extension of the uploaded file, kept with a new blob
+        :param file_id: Telegram id of the file, kept with the blob to send the file again without uploading it
+        :return: key of the previous blob, None if there was none
+        :raise ValueError: the term doesn't exist, nothing is changed
+        """
+        if column not in self.MEDIA_COLUMNS:
+            raise ValueError(f'Column {column} of the term doesn\'t keep media')
+        media_column = getattr(Term, column)
+        file_ids = {'file_id': file_id, 'file_unique_id': file_unique_id} if file_id else {}
 
+        with SQLAlchemyDBConnection() as db:
+            previous = db.session.query(media_column).filter(Term.id == term_id).with_for_update().scalar()
+            if previous == key:
+                if file_ids:
+                    db.session.execute(MediaBlob.__table__.update().where(MediaBlob.key == key).values(file_ids))
+                    db.session.commit()
+                else:
+                    db.session.rollback()
+                return previous
+
+            # the term may have been deleted, then no blob gets a reference
+            updated = db.session.execute(Term.__table__.update().where(Term.id == term_id).values({column: key}))
+            if not updated.rowcount:
+                db.session.rollback()
+                raise ValueError(f'Term {term_id} doesn\'t exist')
+            db.session.execute(insert_ignore(db.session, MediaBlob.__table__)
+                               .values(key=key, size=size, refcount=0, extension=extension))
+            db.session.execute(MediaBlob.__table__.update().where(MediaBlob.key == key)
+                               .values(refcount=MediaBlob.refcount + 1, **file_ids))
+            if previous:
+                db.session.execute(MediaBlob.__table__.update().where(MediaBlob.key == previous)
+                                   .values(refcount=MediaBlob.refcount - 1))
+            self._write_done(db.session, term_ids=[term_id])
+        return previous
+
+    def media_file_id(self, key):
+        """
+        :return: the Telegram file id of the blob, None if the file has never been sent or received by the bot
+        """
+        row = read(lambda session: MEDIA_BLOB_QUERY(session).params(key=key).first())
+        return row.file_id if row is not None else None
+
+    def media_extension(self, key):
+        """
+        :return: extension of the blob file, e.g. '.jpg', None if it is unknown
+        """
+        row = read(lambda session: MEDIA_BLOB_QUERY(session).params(key=key).first())
+        return row.extension if row is not None else None
+
+    def set_media_file_id(self, key, file_id, file_unique_id=None):
+        """
+        Keeps the Telegram file id of the blob, e.g. after the file was uploaded again
+        """
+        with SQLAlchemyDBConnection() as db:
+            db.session.execute(MediaBlob.__table__.update().where(MediaBlob.key == key)
+                               .values(file_id=file_id, file_unique_id=file_unique_id))
             db.session.commit()
+        get_router().written()
 
     def add_synonyms_similars(self, term_id, words, table='syn'):
-        with SQLAlchemyDBConnection(db_string) as db:
-            term = db.session.query(Term).filter(Term.id == term_id).first()
-            words = [w.lower() for w in words]
+        """
+        Links the term with the words as synonyms ('syn') or similar words ('sim').
+        Missing words are added as new terms. The number of queries doesn't depend on the number of words:
+        one upsert of the terms, one query for ids of already existing terms and one insert of the links.
+        :return: ids of the linked terms
+        """
+        link_table, link_column = self.LINK_TABLES[table]
+        words = self.normalize_words(words)
+        if not words:
+            return []
 
-            for word in words:
-                word_exists = db.session.query(exists().where(Term.name == word)).scalar()
+        with SQLAlchemyDBConnection() as db:
+            ids = self._upsert_names(db.session, words)
 
-                if not word_exists:
-                    db.session.add(Term(name=word))
-                    db.session.flush()
+            links = [{'term_id': term_id, link_column: ids[word]} for word in words if ids[word] != term_id]
+            if links:
+                db.session.execute(insert_ignore(db.session, link_table.__table__).values(links))
 
-                s_word = db.session.query(Term).filter(Term.name == word).first()
+            linked = [link[link_column] for link in links]
+            self._write_done(db.session, term_ids=[term_id] + linked, pages=True)
+        return linked
 
-                if table == 'syn':
-                    db.session.add(Synonyms(term_id=term.id, synonym_id=s_word.id))
-                elif table == 'sim':
-                    db.session.add(Similars(term_id=term.id, similar_word_id=s_word.id))
+    @staticmethod
+    def normalize_words(words):
+        """
+        :return: lowercased words without extra spaces, empty strings and duplicates, in the original order
+        """
+        normalized = (' '.join(word.lower().split()) for word in words)
+        return list(OrderedDict.fromkeys(word for word in normalized if word))
 
-            db.session.commit()
+    @staticmethod
+    def _upsert_names(session, names):
+        """
+        Inserts the missing terms in one statement
+        :return: dictionary {name: id} for all the names
+        """
+        ids = {}
+        if session.bind.dialect.name == 'postgresql':
+            # nextval is evaluated for every unnested name, which a multi-row VALUES can't do for the sequence
+            statement = postgresql.insert(Term.__table__)\
+                .from_select(['name'], select([func.unnest(bindparam('names', type_=ARRAY(String)))]))\
+                .on_conflict_do_nothing(index_elements=['name'])\
+                .returning(Term.id, Term.name)
+            ids.update((row.name, row.id) for row in session.execute(statement, {'names': names}))
+        else:
+            session.execute(insert_ignore(session, Term.__table__).values([{'name': name} for name in names]))
+
+        missing = [name for name in names if name not in ids]
+        if missing:
+            ids.update((row.name, row.id) for row in
+                       session.query(Term.id, Term.name).filter(Term.name.in_(missing)))
+        return ids
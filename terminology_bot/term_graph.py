@@ -0,0 +1,298 @@
+import threading
+import time
+from array import array
+from collections import deque
+
+from sqlalchemy import text
+
+from database import SQLAlchemyDBConnection, Term
+from term_collection import TermCollection
+
+
+class AdjacencyIndex:
+    """
+    Symmetric adjacency lists of one relation: for every term a compact array of the ids of the linked terms
+    """
+
+    def __init__(self):
+        self._adjacency = {}
+        self._lock = threading.Lock()
+
+    def build(self, pairs):
+        """
+        :param pairs: iterable of (term_id, linked_id) rows of a link table
+        """
+        lists = {}
+        for a, b in pairs:
+            if a != b:
+                lists.setdefault(a, set()).add(b)
+                lists.setdefault(b, set()).add(a)
+        adjacency = {term_id: array('i', sorted(linked)) for term_id, linked in lists.items()}
+        with self._lock:
+            self._adjacency = adjacency
+
+    def add(self, term_id, linked_ids):
+        """
+        Adds the links of the term written after the index was built
+        """
+        with self._lock:
+            for linked_id in linked_ids:
+                if linked_id == term_id:
+                    continue
+                for a, b in ((term_id, linked_id), (linked_id, term_id)):
+                    neighbours = self._adjacency.get(a)
+                    if neighbours is None:
+                        self._adjacency[a] = array('i', [b])
+                    elif b not in neighbours:
+                        neighbours.append(b)
+
+    def neighbours(self, term_id):
+        return self._adjacency.get(term_id, ())
+
+    def term_ids(self):
+        """
+        :return: ids of the terms having links
+        """
+        return list(self._adjacency)
+
+    def __len__(self):
+        return len(self._adjacency)
+
+
+class TermGraph:
+    """
+    Graph of the terms linked as synonyms ('syn') or similar words ('sim'). The links are symmetric:
+    a link stored from A to B is also a link from B to A.
+    Queries run on the in-memory adjacency index, which is loaded on the first query, updated by add_links
+    after writes of this process and reloaded after refresh_interval seconds to see the writes of other processes.
+    Without the index the queries are recursive CTEs in the database.
+    """
+
+    KINDS = tuple(TermCollection.LINK_TABLES)
+
+    def __init__(self, connection_string=None, in_memory=True, refresh_interval=300):
+        """
+        :param in_memory: keep the adjacency index, otherwise every query goes to the database
+        :param refresh_interval: seconds after which the index is loaded again, 0 to never reload it
+        """
+        self.connection_string = connection_string
+        self.in_memory = in_memory
+        self.refresh_interval = refresh_interval
+        self.indexes = None
+        self.loaded_at = 0
+        self._lock = threading.Lock()
+        # links added while the index is being loaded, (term_id, linked_ids, kind); None when no load is running
+        self._pending = None
+        self._pending_lock = threading.Lock()
+
+    def load(self):
+        """
+        Builds the adjacency indexes from the link tables. The links added by add_links during the load may be
+        missing from the rows read, they are applied to the new indexes before they replace the old ones.
+        """
+        with self._pending_lock:
+            self._pending = []
+        indexes = {}
+        try:
+            with SQLAlchemyDBConnection(self.connection_string) as db:
+                for kind, (link_table, link_column) in TermCollection.LINK_TABLES.items():
+                    indexes[kind] = AdjacencyIndex()
+                    indexes[kind].build(db.session.query(link_table.term_id, getattr(link_table, link_column)))
+        except BaseException:
+            with self._pending_lock:
+                self._pending = None
+            raise
+
+        with self._pending_lock:
+            for term_id, linked_ids, kind in self._pending:
+                indexes[kind].add(term_id, linked_ids)
+            self._pending = None
+            self.indexes = indexes
+        self.loaded_at = time.monotonic()
+        return indexes
+
+    def invalidate(self):
+        """
+        Makes the next query load the index again
+        """
+        self.indexes = None
+
+    def _get_indexes(self):
+        indexes = self.indexes
+        if indexes is None or (self.refresh_interval and time.monotonic() - self.loaded_at > self.refresh_interval):
+            with self._lock:
+                if self.indexes is indexes:
+                    indexes = self.load()
+                else:
+                    indexes = self.indexes
+        return indexes
+
+    def add_links(self, term_id, linked_ids, kind='syn'):
+        """
+        Updates the loaded index after the term was linked with the words,
+        see TermCollection.add_synonyms_similars
+        """
+        with self._pending_lock:
+            if self._pending is not None:
+                self._pending.append((term_id, list(linked_ids), kind))
+            indexes = self.indexes
+            if indexes is not None:
+                indexes[kind].add(term_id, linked_ids)
+
+    def neighbours(self, term_id, kind='syn'):
+        """
+        :return: sorted ids of the terms directly linked with the term
+        """
+        if self.in_memory:
+            return sorted(self._get_indexes()[kind].neighbours(term_id))
+        return sorted(self._walk_sql(term_id, (kind,), hops=1))
+
+    def synonym_closure(self, term_id):
+        """
+        :return: ids of the terms which are synonyms of the term directly or through other synonyms
+        """
+        return self._reachable(term_id, kinds=('syn',))
+
+    def component(self, term_id):
+        """
+        :return: ids of all terms connected with the term by links of any kind, including the term
+        """
+        return self._reachable(term_id, kinds=self.KINDS) | {term_id}
+
+    def _reachable(self, term_id, kinds):
+        if self.in_memory:
+            return set(self.related(term_id, hops=None, kinds=kinds))
+        return self._closure_sql(term_id, kinds)
+
+    def related(self, term_id, hops=2, kinds=KINDS):
+        """
+        Finds the terms reachable from the term over at most `hops` links of the given kinds
+        :param hops: None to follow the links without limit, only with the in-memory index
+        :return: dictionary {term id: number of links from the term}, without the term itself
+        """
+        if not self.in_memory:
+            return self._walk_sql(term_id, kinds, hops)
+
+        indexes = self._get_indexes()
+        distances = {term_id: 0}
+        frontier = deque([term_id])
+        while frontier:
+            current = frontier.popleft()
+            distance = distances[current]
+            if hops is not None and distance >= hops:
+                continue
+            for kind in kinds:
+                for linked_id in indexes[kind].neighbours(current):
+                    if linked_id not in distances:
+                        distances[linked_id] = distance + 1
+                        frontier.append(linked_id)
+        del distances[term_id]
+        return distances
+
+    def components(self, min_size=2):
+        """
+        Clusters the glossary into the groups of connected terms
+        :return: list of sets of term ids, the largest first
+        """
+        indexes = self._get_indexes() if self.in_memory else self.load()
+        seen = set()
+        clusters = []
+        for index in indexes.values():
+            for term_id in index.term_ids():
+                if term_id in seen:
+                    continue
+                cluster = {term_id}
+                frontier = [term_id]
+                while frontier:
+                    current = frontier.pop()
+                    for kind_index in indexes.values():
+                        for linked_id in kind_index.neighbours(current):
+                            if linked_id not in cluster:
+                                cluster.add(linked_id)
+                                frontier.append(linked_id)
+                seen |= cluster
+                if len(cluster) >= min_size:
+                    clusters.append(cluster)
+        clusters.sort(key=len, reverse=True)
+        return clusters
+
+    def profile(self, term_id, hops=2):
+        """
+        Collects the neighbourhood of the term for the /related command
+        :return: dictionary with (id, name) lists 'syn', 'sim' and 'synonym_closure' (indirect synonyms only),
+                 'related' list of (id, name, number of links) and 'cluster_size'
+        """
+        direct = {kind: self.neighbours(term_id, kind) for kind in self.KINDS}
+        closure = self.synonym_closure(term_id) - set(direct['syn'])
+        related = self.related(term_id, hops=hops)
+        cluster = self.component(term_id)
+
+        names = self.names(set(related) | closure)
+
+        def by_name(ids):
+            return sorted(((i, names[i]) for i in ids if i in names), key=lambda term: term[1])
+
+        return {
+            'syn': by_name(direct['syn']),
+            'sim': by_name(direct['sim']),
+            'synonym_closure': by_name(closure),
+            'related': sorted(((i, names[i], distance) for i, distance in related.items() if i in names),
+                              key=lambda term: (term[2], term[1])),
+            'cluster_size': len(cluster),
+        }
+
+    def names(self, term_ids):
+        """
+        :return: dictionary {id: name} of the terms
+        """
+        if not term_ids:
+            return {}
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            return dict(db.session.query(Term.id, Term.name).filter(Term.id.in_(list(term_ids))))
+
+    @staticmethod
+    def _edges_sql(kinds):
+        """
+        :return: SELECT of the links of the kinds in both directions as (a, b) rows
+        """
+        return ' UNION ALL '.join(
+            f'SELECT term_id AS a, {column} AS b FROM {table.__tablename__} '
+            f'UNION ALL SELECT {column}, term_id FROM {table.__tablename__}'
+            for table, column in (TermCollection.LINK_TABLES[kind] for kind in kinds))
+
+    def _closure_sql(self, term_id, kinds):
+        """
+        Walks the links in the database with a recursive CTE, PostgreSQL and SQLite support it.
+        The walk stops when no new terms are found, as UNION drops the repeated rows.
+        :return: set of the ids of the reachable terms
+        """
+        statement = text(f"""
+            WITH RECURSIVE edges(a, b) AS ({self._edges_sql(kinds)}),
+            walk(id) AS (
+                SELECT :term_id
+                UNION
+                SELECT edges.b FROM walk JOIN edges ON edges.a = walk.id
+            )
+            SELECT id FROM walk WHERE id != :term_id
+        """)
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            return {row.id for row in db.session.execute(statement, {'term_id': term_id})}
+
+    def _walk_sql(self, term_id, kinds, hops):
+        """
+        Walks at most `hops` links in the database with a recursive CTE
+        :return: dictionary {term id: number of links from the term}
+        """
+        statement = text(f"""
+            WITH RECURSIVE edges(a, b) AS ({self._edges_sql(kinds)}),
+            walk(id, depth) AS (
+                SELECT :term_id, 0
+                UNION
+                SELECT edges.b, walk.depth + 1 FROM walk JOIN edges ON edges.a = walk.id
+                WHERE walk.depth < :hops
+            )
+            SELECT id, min(depth) AS depth FROM walk WHERE id != :term_id GROUP BY id
+        """)
+        with SQLAlchemyDBConnection(self.connection_string) as db:
+            rows = db.session.execute(statement, {'term_id': term_id, 'hops': hops})
+            return {row.id: row.depth for row in rows}
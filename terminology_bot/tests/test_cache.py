@@ -0,0 +1,96 @@
+import time
+
+from cache import LRUCache
+
+
+def test_get_and_set():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b', 'missing') == 'missing'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_evicted():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_entries_expire(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cache = LRUCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_get_or_load_caches_the_loaded_value():
+    cache = LRUCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return 'value'
+
+    assert cache.get_or_load('key', loader) == 'value'
+    assert cache.get_or_load('key', loader) == 'value'
+    assert len(calls) == 1
+
+
+def test_pop_clear_and_stats():
+    cache = LRUCache(maxsize=3)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.pop('a')
+    cache.pop('missing')
+    assert cache.stats() == {'size': 1, 'maxsize': 3, 'hits': 0, 'misses': 0, 'evictions': 0}
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_get_or_load_does_not_cache_none():
+    cache = LRUCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return None
+
+    assert cache.get_or_load('key', loader) is None
+    assert cache.get_or_load('key', loader) is None
+    assert len(calls) == 2
+    assert len(cache) == 0
+
+
+def test_value_loaded_during_an_invalidation_is_not_cached():
+    cache = LRUCache()
+
+    def loader():
+        # another thread writes the row and invalidates it while this one is reading the old value
+        cache.pop('key')
+        return 'stale'
+
+    assert cache.get_or_load('key', loader) == 'stale'
+    assert cache.get('key') is None
+    assert cache.get_or_load('key', lambda: 'fresh') == 'fresh'
+    assert cache.get('key') == 'fresh'
+
+
+def test_set_drops_the_value_of_an_earlier_generation():
+    cache = LRUCache()
+    generation = cache.generation
+    cache.clear()
+    cache.set('key', 'stale', generation)
+    assert cache.get('key') is None
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
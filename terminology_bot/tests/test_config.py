@@ -0,0 +1,84 @@
+import pytest
+
+import config
+
+
+def test_defaults():
+    settings = config.load_settings({'postgresql': {'url': 'sqlite://'}})
+    assert settings.database_url == 'sqlite://'
+    assert settings.pool.size == 5
+    assert settings.cache.ttl is None
+    assert settings.graph.in_memory is True
+    assert settings.metrics.profiler is False
+    assert settings.webhook.url is None
+    assert settings.sessions.timeout == 3600
+    assert settings.state == config.StateSettings(backend='memory', sqlite_path=config.resolve_path('data/state.db'))
+    assert settings.bot.terms_order == 'name'
+    assert settings.bot.token is None
+    assert settings.bot.base_url is None
+
+
+def test_url_from_the_connection_options():
+    settings = config.load_settings({'postgresql': {'user': 'u', 'password': 'p', 'host': 'h', 'database': 'd'}})
+    assert settings.database_url == 'postgresql://u:p@h/d'
+
+
+def test_options_are_converted():
+    settings = config.load_settings({
+        'postgresql': {'url': 'sqlite://', 'pool_pre_ping': 'off', 'replicas': 'a, ,b'},
+        'cache': {'ttl': '30', 'notify_channel': 'terms'},
+        'graph': {'in_memory': 'No', 'hops': '3'},
+        'outbox': {'rate': '12.5'},
+        'state': {'conversation_timeout': '0'},
+    })
+    assert settings.pool.pre_ping is False
+    assert settings.replicas.urls == ('a', 'b')
+    assert settings.cache.ttl == 30.0
+    assert settings.cache.notify_channel == 'terms'
+    assert settings.graph == config.GraphSettings(in_memory=False, refresh_interval=300.0, hops=3)
+    assert settings.outbox.rate == 12.5
+    assert settings.sessions.timeout is None
+
+
+def test_all_invalid_options_are_reported():
+    with pytest.raises(ValueError) as error:
+        config.load_settings({
+            'postgresql': {'user': 'u'},
+            'cache': {'term_cache_size': 'many'},
+            'media': {'retries': '-1'},
+            'metrics': {'enabled': 'maybe'},
+            'bot': {'mode': 'push', 'terms_order': 'date'},
+            'state': {'backend': 'redis'},
+        })
+    message = str(error.value)
+    assert '[postgresql] password, host, database' in message
+    assert '[cache] term_cache_size = many' in message
+    assert '[media] retries = -1: must be at least 0' in message
+    assert '[metrics] enabled = maybe' in message
+    assert '[bot] mode = push' in message
+    assert '[bot] terms_order = date: must be one of name, id' in message
+    assert '[state] backend = redis: must be one of memory, sqlite, postgresql' in message
+
+
+@pytest.mark.parametrize('value, expected', [('yes', True), ('ON', True), ('1', True), ('no', False), (' off ', False)])
+def test_as_bool(value, expected):
+    assert config.as_bool(value) is expected
+
+
+def test_as_bool_rejects_other_values():
+    with pytest.raises(ValueError):
+        config.as_bool('sometimes')
+
+
+def test_environment_overrides_the_file(tmp_path, monkeypatch):
+    (tmp_path / 'test.ini').write_text('[cache]\nttl = 300\nterm_cache_size = 10\n')
+    monkeypatch.setattr(config, 'CONFIG_DIR', str(tmp_path))
+    monkeypatch.setattr(config, '_sections', {})
+    monkeypatch.setenv('TERMINOLOGY_CACHE_TTL', '5')
+    monkeypatch.setenv('TERMINOLOGY_CACHE_NOTIFY_CHANNEL', 'terms')
+
+    options = config.get_config('cache', filename='test.ini')
+    assert options == {'ttl': '5', 'term_cache_size': '10', 'notify_channel': 'terms'}
+    settings = config.load_settings(dict(config.load_sections('test.ini'), postgresql={'url': 'sqlite://'}))
+    assert settings.cache.ttl == 5.0
+    assert settings.cache.term_cache_size == 10
@@ -0,0 +1,154 @@
+import asyncio
+from collections import namedtuple
+from types import SimpleNamespace
+
+import pytest
+
+import conversation
+from conversation import Conversation, TermStore, run_sync
+from state_store import Session
+from term_collection import TermPage, TermProfile
+
+
+FakeTerm = namedtuple('FakeTerm', ['id', 'name', 'pos_tag', 'description', 'image', 'audiofile', 'videofile'])
+
+OPTIONS = {'new_term': 'Add new term', 'list_term': 'Get list of terms', 'pos_tag': 'POS-tag',
+           'description': 'Description', 'synonyms': 'Synonyms', 'similars': 'Similar words',
+           'image': 'Image', 'audio': 'Audio', 'video': 'Video'}
+LOCALE = SimpleNamespace(key='en', gettext=lambda text: text, options=OPTIONS, pos_tags={'noun': 'noun'},
+                         start_markup='start', term_markup='term', pos_markup='pos')
+
+
+class FakeCollection:
+    def __init__(self, terms):
+        self.terms = {term.id: term for term in terms}
+
+    def get(self, term_id):
+        return self.terms.get(term_id)
+
+    def get_page(self, after=None, before=None, limit=20, order_by='name'):
+        terms = sorted((term.id, term.name) for term in self.terms.values())
+        return TermPage(terms[:limit], has_prev=False, has_next=len(terms) > limit)
+
+    def profile(self, term_id):
+        term = self.terms.get(term_id)
+        if term is None:
+            return None
+        return TermProfile(id=term.id, name=term.name, pos_tag=None, description=term.description, media={},
+                           synonyms=[], similars=[])
+
+    def update(self, term_id, dictionary):
+        self.terms[term_id] = self.terms[term_id]._replace(**dictionary)
+
+
+class AsyncStore(TermStore):
+    async def get(self, term_id):
+        # gives the event loop a turn, like a query of the database
+        await asyncio.sleep(0)
+        return self.term_collection.get(term_id)
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, chat_id, text, reply_markup=None):
+        self.messages.append(text)
+
+
+class FakeBot(Conversation):
+    def __init__(self, terms, store=TermStore):
+        self.terms = store(FakeCollection(terms), graph=None)
+        self.outbox = FakeOutbox()
+        self.locales = SimpleNamespace(get=lambda key: LOCALE)
+
+    def send_media(self, update, kind, key, file_id=None):
+        self.outbox.messages.append(f'<{kind} {key}>')
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(conversation, 'get_settings', lambda: SimpleNamespace(
+        bot=SimpleNamespace(terms_order='name', terms_page_size=20, search_limit=10),
+        graph=SimpleNamespace(hops=2)))
+
+
+def message(text):
+    user = SimpleNamespace(id=1, first_name='user', language_code='en')
+    return SimpleNamespace(message=SimpleNamespace(text=text, from_user=user, chat_id=1),
+                           effective_chat=SimpleNamespace(id=1))
+
+
+def test_run_sync_returns_the_result_of_the_handler():
+    async def handler():
+        return 42
+
+    assert run_sync(handler()) == 42
+
+
+def test_run_sync_refuses_a_suspended_handler():
+    with pytest.raises(RuntimeError):
+        run_sync(asyncio.sleep(1))
+
+
+def test_menu_option_sends_the_media_of_the_term():
+    bot = FakeBot([FakeTerm(1, 'alpha', None, None, 'blob', None, None)])
+    user_data = Session(term_id=1)
+
+    assert run_sync(bot.choose_menu_option(None, message('Image'), user_data)) == bot.IMAGE
+    assert bot.outbox.messages == ['<image blob>', 'Let\'s upload an image for the term "alpha".']
+
+
+@pytest.mark.parametrize('handler', ['choose_menu_option', 'pos_tag', 'description', 'synonyms', 'similars',
+                                     'related_terms', 'image', 'audio', 'video'])
+def test_handlers_of_a_deleted_term_go_back_to_the_list(handler):
+    bot = FakeBot([FakeTerm(2, 'beta', None, None, None, None, None)])
+    user_data = Session(term_id=1)
+
+    assert run_sync(getattr(bot, handler)(None, message('Image'), user_data)) == bot.CHOOSE_TERM
+    assert bot.outbox.messages[0] == 'This term no longer exists.'
+    assert bot.outbox.messages[1].startswith('These are the terms I know:\n1. beta')
+    assert user_data.term_id is None
+    assert user_data.term_list.ids == (2,)
+
+
+def test_term_deleted_in_the_middle_of_a_conversation():
+    bot = FakeBot([FakeTerm(1, 'alpha', None, None, None, None, None),
+                   FakeTerm(2, 'beta', None, None, None, None, None)])
+    collection = bot.terms.term_collection
+    user_data = Session()
+
+    assert run_sync(bot.list_of_terms_option(None, message('Get list of terms'), user_data)) == bot.CHOOSE_TERM
+    assert run_sync(bot.choose_term(None, message('1'), user_data)) == bot.CHOOSE_OPTION
+    assert run_sync(bot.show_term(None, message('/show'), user_data)) == bot.CHOOSE_OPTION
+    assert run_sync(bot.choose_menu_option(None, message('Description'), user_data)) == bot.DESCRIPTION
+
+    # another user deletes the term while this one is typing its description
+    del collection.terms[1]
+    bot.outbox.messages.clear()
+    assert run_sync(bot.description(None, message('a description'), user_data)) == bot.CHOOSE_TERM
+    assert bot.outbox.messages == ['This term no longer exists.',
+                                   'These are the terms I know:\n1. beta\n\nPlease, choose one of them.']
+
+    # the term is gone for /show too, and the conversation goes on with the new list
+    user_data.term_id = 1
+    bot.outbox.messages.clear()
+    assert run_sync(bot.show_term(None, message('/show'), user_data)) == bot.CHOOSE_TERM
+    assert bot.outbox.messages[0] == 'This term no longer exists.'
+    assert run_sync(bot.choose_term(None, message('1'), user_data)) == bot.CHOOSE_OPTION
+    assert user_data.term_id == 2
+
+
+def test_asyncio_mode_runs_the_same_handlers():
+    bot = FakeBot([FakeTerm(1, 'alpha', None, None, None, None, None)], store=AsyncStore)
+    user_data = Session()
+
+    async def talk():
+        await bot.list_of_terms_option(None, message('Get list of terms'), user_data)
+        await bot.choose_term(None, message('1'), user_data)
+        return await bot.choose_menu_option(None, message('Description'), user_data)
+
+    assert asyncio.run(talk()) == bot.DESCRIPTION
+    assert bot.outbox.messages[1:] == ['Let\'s make the profile of the term "alpha".\n'
+                                       'Feel free to go back to the /menu and to the list of /terms.',
+                                       'Give a description to the term "alpha".']
@@ -0,0 +1,38 @@
+import io
+
+import pytest
+
+from database import POSEnum
+from glossary_io import normalize_record, read_records
+
+
+def test_normalize_record():
+    record = normalize_record({'name': ' Fixation  Agent ', 'pos_tag': 'Noun', 'description': '  ',
+                               'synonyms': ['Fixer', 'fixation agent', ''], 'similars': None})
+    assert record == {'name': 'fixation agent', 'pos_tag': POSEnum.noun, 'description': None, 'image': None,
+                      'audiofile': None, 'videofile': None, 'synonyms': ['fixer'], 'similars': []}
+
+
+@pytest.mark.parametrize('record, error', [
+    ({'name': '  '}, 'no name'),
+    ({'name': 5}, 'name is not a string'),
+    ({'name': 'a', 'pos_tag': 3}, 'pos_tag is not a string'),
+    ({'name': 'a', 'pos_tag': 'gerund'}, 'unknown part of speech'),
+    ({'name': 'a', 'synonyms': 'b'}, 'synonyms is not a list of strings'),
+    ({'name': 'a', 'similars': [1]}, 'similars is not a list of strings'),
+    (['a'], 'not an object'),
+])
+def test_invalid_records(record, error):
+    with pytest.raises(ValueError, match=error):
+        normalize_record(record)
+
+
+def test_read_csv_splits_the_links():
+    file = io.StringIO('name,synonyms\nvalet,servant;attendant\nwallet,\n')
+    assert list(read_records(file, 'csv')) == [{'name': 'valet', 'synonyms': ['servant', 'attendant']},
+                                               {'name': 'wallet', 'synonyms': ['']}]
+
+
+def test_read_jsonl_skips_blank_lines():
+    file = io.StringIO('{"name": "juba"}\n\n{"name": "valet", "pos_tag": "noun"}\n')
+    assert list(read_records(file, 'jsonl')) == [{'name': 'juba'}, {'name': 'valet', 'pos_tag': 'noun'}]
@@ -0,0 +1,48 @@
+from rate_limit import TokenBucket, split_text
+
+
+def test_short_text_is_one_chunk():
+    assert split_text('hello', limit=10) == ['hello']
+
+
+def test_split_at_line_breaks():
+    text = 'aaaa\nbbbb\ncccc'
+    assert split_text(text, limit=9) == ['aaaa\nbbbb', 'cccc']
+
+
+def test_long_lines_are_cut():
+    chunks = split_text('ab\n' + 'x' * 25, limit=10)
+    assert chunks == ['ab', 'x' * 10, 'x' * 10, 'x' * 5]
+    assert all(len(chunk) <= 10 for chunk in chunks)
+
+
+def test_split_keeps_the_text():
+    text = '\n'.join(f'line {i} ' * (i % 7 + 1) for i in range(200))
+    chunks = split_text(text, limit=100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert '\n'.join(chunks) == text
+
+
+def test_bucket_allows_a_burst():
+    bucket = TokenBucket(rate=1, capacity=3)
+    now = bucket.updated
+    assert [bucket.reserve(now) for _ in range(3)] == [0, 0, 0]
+
+
+def test_bucket_delays_after_the_burst():
+    bucket = TokenBucket(rate=2, capacity=1)
+    now = bucket.updated
+    assert bucket.reserve(now) == 0
+    assert bucket.reserve(now) == 0.5
+    assert bucket.reserve(now) == 1.0
+
+
+def test_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(rate=10, capacity=2)
+    now = bucket.updated
+    bucket.reserve(now)
+    bucket.reserve(now)
+    # an hour of refill doesn't allow more than the capacity
+    later = now + 3600
+    assert [bucket.reserve(later) for _ in range(2)] == [0, 0]
+    assert bucket.reserve(later) > 0
@@ -0,0 +1,27 @@
+from term_collection import PrefixIndex, TermCollection
+
+
+def test_prefix_search_in_alphabetical_order():
+    index = PrefixIndex()
+    index.build([(1, 'wallet'), (2, 'valet'), (3, 'walnut'), (4, 'juba')])
+    assert not index.stale
+    assert index.search('wal') == [(1, 'wallet'), (3, 'walnut')]
+    assert index.search('') == [(4, 'juba'), (2, 'valet'), (1, 'wallet'), (3, 'walnut')]
+
+
+def test_prefix_search_limit_and_no_match():
+    index = PrefixIndex()
+    index.build([(i, f'term {i:03}') for i in range(50)])
+    assert index.search('term', limit=3) == [(0, 'term 000'), (1, 'term 001'), (2, 'term 002')]
+    assert index.search('zzz') == []
+
+
+def test_prefix_index_invalidate():
+    index = PrefixIndex()
+    index.build([(1, 'a')])
+    index.invalidate()
+    assert index.stale
+
+
+def test_normalize_words():
+    assert TermCollection.normalize_words([' Foo  Bar ', 'foo bar', '', 'Baz']) == ['foo bar', 'baz']
@@ -0,0 +1,57 @@
+from term_graph import AdjacencyIndex, TermGraph
+
+
+def make_graph(syn=(), sim=()):
+    """
+    :return: TermGraph with in-memory indexes of the links, without a database
+    """
+    graph = TermGraph(connection_string=None, in_memory=True, refresh_interval=0)
+    graph.indexes = {'syn': AdjacencyIndex(), 'sim': AdjacencyIndex()}
+    graph.indexes['syn'].build(syn)
+    graph.indexes['sim'].build(sim)
+    return graph
+
+
+def test_links_are_symmetric():
+    index = AdjacencyIndex()
+    index.build([(1, 2), (1, 3), (2, 2)])
+    assert list(index.neighbours(1)) == [2, 3]
+    assert list(index.neighbours(2)) == [1]
+    assert list(index.neighbours(4)) == []
+    assert sorted(index.term_ids()) == [1, 2, 3]
+
+
+def test_add_links():
+    index = AdjacencyIndex()
+    index.build([(1, 2)])
+    index.add(3, [1, 3, 2])
+    index.add(3, [1])
+    assert sorted(index.neighbours(1)) == [2, 3]
+    assert sorted(index.neighbours(3)) == [1, 2]
+
+
+def test_related_counts_the_links():
+    # chain 1 - 2 - 3 - 4 of synonyms and a similar word 5 of 2
+    graph = make_graph(syn=[(1, 2), (2, 3), (3, 4)], sim=[(2, 5)])
+    assert graph.related(1, hops=2) == {2: 1, 3: 2, 5: 2}
+    assert graph.related(1, hops=None, kinds=('syn',)) == {2: 1, 3: 2, 4: 3}
+    assert graph.neighbours(2, 'syn') == [1, 3]
+
+
+def test_synonym_closure_and_component():
+    graph = make_graph(syn=[(1, 2), (2, 3)], sim=[(3, 4), (7, 8)])
+    assert graph.synonym_closure(1) == {2, 3}
+    assert graph.component(1) == {1, 2, 3, 4}
+    assert graph.component(9) == {9}
+
+
+def test_components_largest_first():
+    graph = make_graph(syn=[(1, 2), (2, 3), (10, 11)], sim=[(3, 4), (20, 20)])
+    assert graph.components() == [{1, 2, 3, 4}, {10, 11}]
+    assert graph.components(min_size=3) == [{1, 2, 3, 4}]
+
+
+def test_add_links_updates_the_loaded_graph():
+    graph = make_graph(syn=[(1, 2)])
+    graph.add_links(2, [3], kind='syn')
+    assert graph.synonym_closure(1) == {2, 3}
@@ -0,0 +1,119 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# errors of Update.de_json for an update with the right shape but fields of wrong types
+MALFORMED_UPDATE_ERRORS = (ValueError, TypeError, KeyError, AttributeError)
+
+
+def parse_updates(data):
+    """
+    Telegram sends one update per request, the replay tool and the router may send batches
+    :param data: decoded JSON body of a webhook request
+    :return: list of update dictionaries, None if the body is neither an update nor a list of updates
+    """
+    updates = data if isinstance(data, list) else [data]
+    if all(isinstance(update, dict) and isinstance(update.get('update_id'), int) for update in updates):
+        return updates
+    return None
+
+
+class DispatcherSink:
+    """
+    Puts the received updates into the update queue of the local dispatcher,
+    refusing them when the queue already holds max_queue updates
+    """
+
+    def __init__(self, bot, update_queue, max_queue=1000):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.max_queue = max_queue
+
+    def __call__(self, updates):
+        """
+        :param updates: list of update dictionaries as sent by Telegram
+        :return: False if the updates were refused
+        """
+        if self.update_queue.qsize() + len(updates) > self.max_queue:
+            return False
+        # all updates are parsed first, so a malformed one doesn't leave a part of the batch queued
+        for update in [Update.de_json(data, self.bot) for data in updates]:
+            self.update_queue.put(update)
+        return True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server_version = 'TerminologyBot'
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            return self._respond(404)
+
+        if server.secret and not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), server.secret):
+            logger.warning('Webhook request from %s with a wrong secret token.', self.client_address[0])
+            return self._respond(403)
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return self._respond(400)
+        if length < 0:
+            return self._respond(400)
+        if length > server.max_body:
+            return self._respond(413)
+
+        try:
+            updates = parse_updates(json.loads(self.rfile.read(length).decode('utf-8')))
+        except ValueError:
+            updates = None
+        if updates is None:
+            return self._respond(400)
+
+        try:
+            accepted = server.sink(updates)
+        except MALFORMED_UPDATE_ERRORS as e:
+            logger.warning('Malformed update from %s: %s', self.client_address[0], e)
+            return self._respond(400)
+        if not accepted:
+            # Telegram retries the delivery later
+            return self._respond(503, headers={'Retry-After': '1'})
+        self._respond(200)
+
+    def do_GET(self):
+        self._respond(404)
+
+    def _respond(self, code, headers=None):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.client_address[0], format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Embedded HTTP server receiving updates from Telegram. The updates are passed to the sink,
+    e.g. DispatcherSink for the dispatcher of this process.
+    """
+    daemon_threads = True
+
+    def __init__(self, sink, listen='0.0.0.0', port=8443, path='/', secret=None, max_body=1024 * 1024):
+        """
+        :param secret: the token Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+        """
+        self.sink = sink
+        self.path = path if path.startswith('/') else '/' + path
+        self.secret = secret
+        self.max_body = max_body
+        super().__init__((listen, port), WebhookHandler)